@@ -0,0 +1,39 @@
+# vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+asyncio 后端的echo服务, bench_e2e/bench_memory 指定 --backend asyncio 时
+在子进程里启动(不能在打过gevent补丁的进程里运行). 安装了uvloop时使用uvloop
+
+    python -m benchmarks.aio_server PORT PATH [SERVER_OPTIONS_JSON]
+"""
+import sys
+import json
+import asyncio
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from geventwbs.core import Resource
+from geventwbs.aio import AsyncWebSocketApplication, AsyncWebSocketServer
+
+
+class EchoApplication(AsyncWebSocketApplication):
+    def on_message(self, message, *args, **kwargs):
+        return message
+
+
+def main():
+    port, path = int(sys.argv[1]), sys.argv[2]
+    options = json.loads(sys.argv[3]) if len(sys.argv) > 3 else {}
+
+    if uvloop is not None:
+        uvloop.install()
+
+    server = AsyncWebSocketServer(
+        ('127.0.0.1', port), Resource([(path, EchoApplication)]), **options)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+# vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+帧编解码微基准
+在bin目录下执行:
+
+    python -m benchmarks.bench_codec
+    python -m benchmarks.bench_codec --filter read_ --output codec.json
+
+数据全部在内存里(假的rfile/socket), 不经过网络和事件循环.
+每个用例重复多轮取最小值和中位数, 计时时关闭gc;
+alloc 为单次操作期间 tracemalloc 记录的内存峰值(字节)
+"""
+import io
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+
+from geventwbs import mask
+from geventwbs.websocket import WebSocket, Stream, Header
+from geventwbs.deflate import PerMessageDeflateFactory
+from geventwbs.protocol import Connection
+
+KEY = b'\x12\x34\x56\x78'
+
+
+class FakeSocket(object):
+    """从内存里读数据, 丢弃写入的数据, 只统计字节数
+    """
+
+    def __init__(self, data=b''):
+        self.recv_into = io.BytesIO(data).readinto
+        self.written = 0
+
+    def gettimeout(self):
+        return None
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        self.written += len(data)
+
+    def sendmsg(self, buffers):
+        size = sum(len(b) for b in buffers)
+        self.written += size
+        return size
+
+
+class FakeHandler(object):
+
+    def __init__(self, data=b''):
+        self.rfile = io.BufferedReader(io.BytesIO())
+        self.socket = FakeSocket(data)
+        self.server = None
+        self.client_address = ('127.0.0.1', 0)
+
+
+def payload(size, seed=0):
+    # 固定种子, 每次运行数据相同
+    rnd = random.Random(seed + size)
+    return rnd.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def client_frame(data, opcode=WebSocket.OPCODE_BINARY, fin=True):
+    """客户端发来的带掩码的帧
+    """
+    header = Header.encode_header(fin, opcode, KEY, len(data), 0)
+    return bytes(header) + mask.mask_payload(KEY, data)
+
+
+def make_websocket(data=b'', deflate=None):
+    handler = FakeHandler(data)
+    return WebSocket({}, Stream(handler), handler, deflate)
+
+
+# 用例: name -> setup(ops), setup 返回执行ops次操作的函数
+
+def case_decode_header(size):
+    frame = bytes(Header.encode_header(True, 2, KEY, size, 0))
+
+    def setup(ops):
+        stream = io.BytesIO(frame * ops)
+        decode = Header.decode_header
+
+        def run():
+            for _ in range(ops):
+                decode(stream)
+        return run
+    return setup
+
+
+def case_encode_header(size, key):
+    def setup(ops):
+        encode = Header.encode_header
+
+        def run():
+            for _ in range(ops):
+                encode(True, 2, key, size, 0)
+        return run
+    return setup
+
+
+def case_mask(size):
+    data = payload(size)
+
+    def setup(ops):
+        func = mask.mask_payload
+
+        def run():
+            for _ in range(ops):
+                func(KEY, data)
+        return run
+    return setup
+
+
+def case_read_frame(size):
+    frame = client_frame(payload(size))
+
+    def setup(ops):
+        ws = make_websocket(frame * ops)
+
+        def run():
+            read = ws.read_frame
+            for _ in range(ops):
+                read()
+        return run
+    return setup
+
+
+def case_read_message(size, fragments):
+    data = payload(size)
+    step = max(1, size // fragments)
+    chunks = [data[i:i + step] for i in range(0, size, step)]
+    message = b''.join(
+        client_frame(chunk, WebSocket.OPCODE_BINARY if i == 0 else
+                     WebSocket.OPCODE_CONTINUATION, i == len(chunks) - 1)
+        for i, chunk in enumerate(chunks))
+
+    def setup(ops):
+        ws = make_websocket(message * ops)
+
+        def run():
+            read = ws.read_message
+            for _ in range(ops):
+                read()
+        return run
+    return setup
+
+
+def case_send_frame(size, text=False, compress=False):
+    data = payload(size)
+    if text:
+        data = data.hex()[:size]
+    opcode = WebSocket.OPCODE_TEXT if text else WebSocket.OPCODE_BINARY
+
+    def setup(ops):
+        deflate = None
+        if compress:
+            deflate = PerMessageDeflateFactory().negotiate(
+                'permessage-deflate')[1]
+        ws = make_websocket(deflate=deflate)
+
+        def run():
+            send = ws.send_frame
+            for _ in range(ops):
+                send(data, opcode)
+        return run
+    return setup
+
+
+def case_send_many(size, count):
+    """count条小消息 send_many 一次写出, ns/op 为整批的耗时
+    """
+    data = payload(size)
+    messages = [data] * count
+
+    def setup(ops):
+        ws = make_websocket()
+
+        def run():
+            send_many = ws.send_many
+            for _ in range(ops):
+                send_many(messages)
+        return run
+    return setup
+
+
+def case_connection_receive(size, fragments=1):
+    """sans-IO Connection 解析同样的数据, 和 read_message 对比
+    """
+    data = payload(size)
+    step = max(1, size // fragments)
+    chunks = [data[i:i + step] for i in range(0, size, step)]
+    message = b''.join(
+        client_frame(chunk, WebSocket.OPCODE_BINARY if i == 0 else
+                     WebSocket.OPCODE_CONTINUATION, i == len(chunks) - 1)
+        for i, chunk in enumerate(chunks))
+
+    def setup(ops):
+        connection = Connection()
+        # 按16KiB分块喂入, 和 FrameReader 每次读入的大小一致
+        stream = message * ops
+        blocks = [stream[i:i + 16384] for i in range(0, len(stream), 16384)]
+
+        def run():
+            receive = connection.receive_data
+            events = connection.events
+            for block in blocks:
+                receive(block)
+                for _ in events():
+                    pass
+        return run
+    return setup
+
+
+def case_connection_send(size):
+    data = payload(size)
+
+    def setup(ops):
+        connection = Connection()
+
+        def run():
+            send = connection.send
+            for _ in range(ops):
+                send(data, True)
+        return run
+    return setup
+
+
+CASES = [
+    ('decode_header/125', case_decode_header(125), 10000),
+    ('decode_header/16bit', case_decode_header(1024), 10000),
+    ('decode_header/64bit', case_decode_header(70000), 10000),
+    ('encode_header/125', case_encode_header(125, b''), 10000),
+    ('encode_header/16bit', case_encode_header(1024, b''), 10000),
+    ('encode_header/64bit+mask', case_encode_header(70000, KEY), 10000),
+    ('mask/125', case_mask(125), 5000),
+    ('mask/4KiB', case_mask(4096), 1000),
+    ('mask/64KiB', case_mask(64 * 1024), 100),
+    ('mask/1MiB', case_mask(1024 * 1024), 10),
+    ('read_frame/125', case_read_frame(125), 5000),
+    ('read_frame/4KiB', case_read_frame(4096), 1000),
+    ('read_frame/64KiB', case_read_frame(64 * 1024), 100),
+    ('read_message/4KiB/1', case_read_message(4096, 1), 1000),
+    ('read_message/4KiB/4', case_read_message(4096, 4), 1000),
+    ('read_message/64KiB/16', case_read_message(64 * 1024, 16), 100),
+    ('send_frame/text/125', case_send_frame(125, text=True), 5000),
+    ('send_frame/binary/4KiB', case_send_frame(4096), 1000),
+    ('send_frame/binary/64KiB', case_send_frame(64 * 1024), 200),
+    ('send_frame/deflate/4KiB', case_send_frame(4096, text=True,
+                                                compress=True), 500),
+    ('send_many/125x32', case_send_many(125, 32), 500),
+    ('connection/receive/125', case_connection_receive(125), 5000),
+    ('connection/receive/4KiB', case_connection_receive(4096), 1000),
+    ('connection/receive/64KiB/16', case_connection_receive(64 * 1024, 16),
+     100),
+    ('connection/send/4KiB', case_connection_send(4096), 1000),
+]
+
+
+def measure(setup, ops, repeat):
+    samples = []
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            run = setup(ops)
+            start = time.perf_counter()
+            run()
+            samples.append((time.perf_counter() - start) / ops * 1e9)
+    finally:
+        gc.enable()
+    samples.sort()
+    return samples[0], samples[len(samples) // 2]
+
+
+def measure_alloc(setup):
+    run = setup(1)
+    # 预热一次, 不统计缓存和延迟初始化
+    setup(1)()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='frame codec microbenchmarks')
+    parser.add_argument('--filter', default='', help='substring of case names')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--output', help='write results to this json file')
+    args = parser.parse_args()
+
+    print('%-28s %12s %12s %10s' % ('case', 'min(ns/op)', 'median', 'alloc(B)'))
+    results = {}
+    for name, setup, ops in CASES:
+        if args.filter not in name:
+            continue
+        # 预热
+        setup(min(ops, 100))()
+        best, median = measure(setup, ops, args.repeat)
+        alloc = measure_alloc(setup)
+        results[name] = {'min_ns': best, 'median_ns': median, 'alloc_bytes': alloc}
+        print('%-28s %12.0f %12.0f %10d' % (name, best, median, alloc))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'numpy': mask.numpy is not None,
+                    'repeat': args.repeat,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+端到端压测: 握手速率, 固定负载下的往返延迟, 不同消息大小/连接数的吞吐
+在bin目录下执行:
+
+    python -m benchmarks.bench_e2e --output result.json
+    python -m benchmarks.bench_e2e --quick --compare result.json
+
+默认在子进程里启动 WebSocketServer(echo), --backend asyncio 时启动 asyncio
+后端的echo服务(benchmarks.aio_server), 也可以用 --address 压已有的服务.
+--compare 和保存的结果对比, 变差超过 --threshold 的指标标记为回归, 退出码为1
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import subprocess
+
+import gevent
+
+from benchmarks import loadgen
+
+PATH = '/bench/echo'
+
+SIZES = (16, 1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+CONNECTIONS = (1, 100, 1000, 10000, 50000)
+LATENCY_RATES = (1000, 5000)
+
+QUICK_SIZES = (16, 1024, 64 * 1024)
+QUICK_CONNECTIONS = (1, 100)
+QUICK_LATENCY_RATES = (1000,)
+
+# 单个场景同时在途的数据上限, 大消息多连接时减少窗口
+MAX_INFLIGHT_BYTES = 256 * 1024 * 1024
+
+# 指标名后缀 -> 越大越好
+HIGHER_IS_BETTER = ('_per_sec',)
+LOWER_IS_BETTER = ('_ms',)
+
+
+def serve(port, options):
+    """子进程: 启动echo服务
+    """
+    from geventwbs.core import WebSocketApplication, Resource, WebSocketServer
+
+    class EchoApplication(WebSocketApplication):
+        def on_message(self, message):
+            return message
+
+    server = WebSocketServer(
+        ('127.0.0.1', port), application=Resource([(PATH, EchoApplication)]),
+        log=None, **options)
+    server.serve_forever()
+
+
+def raise_nofile():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(options, backend='gevent'):
+    port = free_port()
+    if backend == 'asyncio':
+        command = ['benchmarks.aio_server', str(port), PATH,
+                   json.dumps(options)]
+    else:
+        command = ['benchmarks.bench_e2e', '--serve', str(port),
+                   '--server-options', json.dumps(options)]
+    proc = subprocess.Popen(
+        [sys.executable, '-m'] + command,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return proc, ('127.0.0.1', port)
+        except socket.error:
+            gevent.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('benchmark server did not start')
+
+
+def fmt_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%d%s' % (size, unit)
+        size //= 1024
+    return '%dGiB' % size
+
+
+def run(args):
+    address = args.address
+    results = {}
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    connections = QUICK_CONNECTIONS if args.quick else CONNECTIONS
+    rates = QUICK_LATENCY_RATES if args.quick else LATENCY_RATES
+    if args.sizes:
+        sizes = [int(s) for s in args.sizes.split(',')]
+    if args.connections:
+        connections = [int(c) for c in args.connections.split(',')]
+
+    name = 'handshake/c%d' % args.handshake_concurrency
+    results[name] = loadgen.handshake_rate(
+        address, PATH, args.duration, args.handshake_concurrency)
+    report(name, results[name])
+
+    for rate in rates:
+        name = 'latency/%drps/c%d' % (rate, args.latency_connections)
+        results[name] = loadgen.echo_latency(
+            address, PATH, rate, args.latency_connections, args.duration, 64)
+        report(name, results[name])
+
+    for count in connections:
+        for size in sizes:
+            window = max(1, min(8, MAX_INFLIGHT_BYTES // (size * count)))
+            name = 'throughput/%s/c%d' % (fmt_size(size), count)
+            try:
+                results[name] = loadgen.throughput(
+                    address, PATH, size, count, args.duration, window)
+            except (socket.error, loadgen.HandshakeError) as e:
+                # 连接数超过系统限制时跳过
+                print('%-32s skipped: %s' % (name, e))
+                continue
+            report(name, results[name])
+
+    return results
+
+
+def report(name, result):
+    values = ' '.join('%s=%.2f' % (k, v) for k, v in sorted(result.items())
+                      if isinstance(v, float))
+    print('%-32s %s' % (name, values))
+    sys.stdout.flush()
+
+
+def compare(results, baseline, threshold, higher=HIGHER_IS_BETTER,
+            lower=LOWER_IS_BETTER):
+    """返回回归的指标 [(场景, 指标, 基准值, 当前值, 变化比例)]
+    higher/lower: 越大越好/越小越好的指标名后缀
+    """
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key, value in sorted(metrics.items()):
+            old = base.get(key)
+            if not isinstance(value, float) or not old:
+                continue
+
+            change = (value - old) / old
+            if key.endswith(higher) and change < -threshold or \
+                    key.endswith(lower) and change > threshold:
+                regressions.append((name, key, old, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--address', help='host:port of a running server')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--sizes', help='comma separated payload sizes')
+    parser.add_argument('--connections', help='comma separated counts')
+    parser.add_argument('--handshake-concurrency', type=int, default=50)
+    parser.add_argument('--latency-connections', type=int, default=100)
+    parser.add_argument('--server-options', default='{}',
+                        help='WebSocketServer kwargs as json')
+    parser.add_argument('--backend', choices=('gevent', 'asyncio'),
+                        default='gevent')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--compare', help='baseline json file')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    raise_nofile()
+    options = json.loads(args.server_options)
+
+    if args.serve:
+        serve(args.serve, options)
+        return 0
+
+    proc = None
+    if args.address:
+        host, port = args.address.rsplit(':', 1)
+        args.address = (host, int(port))
+    else:
+        proc, args.address = start_server(options, args.backend)
+
+    try:
+        results = run(args)
+    finally:
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+
+    document = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'gevent': gevent.__version__,
+            'platform': platform.platform(),
+            'duration': args.duration,
+            'backend': args.backend,
+            'server_options': options,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.threshold)
+        for name, key, old, value, change in regressions:
+            print('REGRESSION %-32s %-20s %.2f -> %.2f (%+.1f%%)' % (
+                name, key, old, value, change * 100))
+        if regressions:
+            return 1
+        print('no regressions (threshold %.0f%%)' % (args.threshold * 100))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+握手速率压测
+在bin目录下执行:
+
+    python -m benchmarks.bench_handshake
+    python -m benchmarks.bench_handshake --concurrency 1,50 --compression
+
+服务端在子进程里运行, 除了每秒握手数, 在linux上还会从 /proc 读取服务端进程
+的CPU时间, 换算成每次握手的服务端耗时(us)
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import argparse
+
+from benchmarks import loadgen
+from benchmarks.bench_e2e import PATH, start_server, raise_nofile
+
+# 模拟浏览器握手时常带的头部
+BROWSER_HEADERS = (
+    ('Origin', 'http://localhost'),
+    ('User-Agent', 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36'),
+    ('Accept-Language', 'zh-CN,zh;q=0.9'),
+    ('Cache-Control', 'no-cache'),
+)
+
+EXTENSION_HEADER = (
+    'Sec-WebSocket-Extensions', 'permessage-deflate; client_max_window_bits')
+
+
+def cpu_time(pid):
+    """进程累计的用户态+内核态CPU时间(秒), 不支持时返回None
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return (int(fields[11]) + int(fields[12])) / float(ticks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='handshake rate benchmark')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--concurrency', default='1,10,50,200')
+    parser.add_argument('--compression', action='store_true',
+                        help='enable and offer permessage-deflate')
+    parser.add_argument('--output', help='write results to this json file')
+    args = parser.parse_args()
+
+    raise_nofile()
+    options = {'compression': True} if args.compression else {}
+    headers = BROWSER_HEADERS
+    if args.compression:
+        headers += (EXTENSION_HEADER,)
+
+    proc, address = start_server(options)
+    results = {}
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            before = cpu_time(proc.pid)
+            result = loadgen.handshake_rate(
+                address, PATH, args.duration, concurrency, headers)
+            after = cpu_time(proc.pid)
+
+            if before is not None and result['handshakes']:
+                result['server_us_per_handshake'] = \
+                    (after - before) / result['handshakes'] * 1e6
+
+            name = 'handshake/c%d' % concurrency
+            results[name] = result
+            print('%-20s %10.0f/s %8s errors=%d' % (
+                name, result['handshakes_per_sec'],
+                '%.1fus' % result['server_us_per_handshake']
+                if 'server_us_per_handshake' in result else '-',
+                result['errors']))
+            sys.stdout.flush()
+    finally:
+        proc.kill()
+        proc.wait()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': options, 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+掩码处理性能对比
+在bin目录下执行: python -m benchmarks.bench_mask
+"""
+import os
+import sys
+import time
+
+from geventwbs import mask
+
+SIZES = (125, 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+
+
+def mask_loop(key, data):
+    """原来的逐字节实现, 作为对比基准
+    """
+    payload = bytearray(data)
+    for i in range(len(payload)):
+        payload[i] ^= key[i % 4]
+    return payload
+
+
+def timeit(func, key, data, budget=0.5):
+    """在budget秒内尽量多跑几轮, 返回单次平均耗时(秒)
+    """
+    rounds = 0
+    start = time.perf_counter()
+    while True:
+        func(key, data)
+        rounds += 1
+        cost = time.perf_counter() - start
+        if cost >= budget:
+            return cost / rounds
+
+
+def fmt_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%d%s' % (size, unit)
+        size //= 1024
+    return '%dGiB' % size
+
+
+def main():
+    key = os.urandom(4)
+    engines = [('int', mask._mask_int)]
+    if mask.numpy is not None:
+        engines.append(('numpy', mask._mask_numpy))
+
+    print('%-8s %12s' % ('size', 'loop(us)') + ''.join(
+        '%12s %8s' % (name + '(us)', 'speedup') for name, _ in engines))
+
+    for size in SIZES:
+        data = os.urandom(size)
+        expect = bytes(mask_loop(key, data))
+        base = timeit(mask_loop, key, data)
+        line = '%-8s %12.1f' % (fmt_size(size), base * 1e6)
+
+        for name, func in engines:
+            assert func(key, data) == expect, name
+            cost = timeit(func, key, data)
+            line += '%12.1f %7.1fx' % (cost * 1e6, base / cost)
+        print(line)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+空闲连接内存压测: 建立大量空闲websocket连接, 统计服务进程每个连接占用的RSS
+在bin目录下执行:
+
+    python -m benchmarks.bench_memory --connections 100000
+    python -m benchmarks.bench_memory --connections 10000 --active --output mem.json
+    python -m benchmarks.bench_memory --connections 10000 --active --compare mem.json
+
+服务端在子进程里启动(同 bench_e2e), 先建 --warmup 个连接预热, 记录RSS作为基准,
+再建满 --connections 个连接, 空闲 --settle 秒后记录RSS.
+--active 时每个连接先收发一条消息再空闲, 统计用过一次之后的内存.
+需要 ulimit -n 大于连接数, 超过2万个连接时自动使用多个 127.0.0.x 源地址
+--compare 和保存的结果对比(同 bench_e2e), 每个连接的内存增加或者建连速率下降
+超过 --threshold 时标记为回归, 退出码为1. 连接数和 --active 要和基准一致
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import json
+import time
+import platform
+import argparse
+
+import gevent
+
+from gevent.pool import Pool
+
+from benchmarks import loadgen
+from benchmarks.bench_e2e import PATH, start_server, raise_nofile, compare
+
+# 对比时检查的指标, 只看新增连接的部分, 基准RSS和运行环境有关
+HIGHER_IS_BETTER = ('_per_sec',)
+LOWER_IS_BETTER = ('_per_conn',)
+
+
+def rss(pid):
+    """进程的RSS(字节)
+    """
+    with open('/proc/{0}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError('VmRSS not found')
+
+
+def echo_all(conns, concurrency=500):
+    payload = b'x' * 64
+
+    def echo(conn):
+        conn.send(payload)
+        conn.recv()
+
+    pool = Pool(concurrency)
+    for conn in conns:
+        pool.spawn(echo, conn)
+    pool.join(raise_error=True)
+
+
+def measure(pid, address, count, warmup, settle, active):
+    warm = loadgen.open_connections(address, PATH, warmup)
+    if active:
+        echo_all(warm)
+    gevent.sleep(settle)
+    base = rss(pid)
+
+    start = time.time()
+    conns = loadgen.open_connections(address, PATH, count - warmup)
+    cost = time.time() - start
+    if active:
+        echo_all(conns)
+    gevent.sleep(settle)
+    loaded = rss(pid)
+
+    for conn in warm + conns:
+        conn.close()
+
+    added = count - warmup
+    return {
+        'connections': count,
+        'active': active,
+        'rss_base_mb': base / 1048576.0,
+        'rss_loaded_mb': loaded / 1048576.0,
+        'bytes_per_conn': float(loaded - base) / added,
+        'connect_per_sec': added / cost,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--connections', type=int, default=100000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--settle', type=float, default=2)
+    parser.add_argument('--active', action='store_true',
+                        help='exchange one message on every connection first')
+    parser.add_argument('--server-options', default='{}',
+                        help='WebSocketServer kwargs as json')
+    parser.add_argument('--backend', choices=('gevent', 'asyncio'),
+                        default='gevent')
+    parser.add_argument('--output', help='write results to this json file')
+    parser.add_argument('--compare', help='baseline json file')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    raise_nofile()
+    options = json.loads(args.server_options)
+    proc, address = start_server(options, args.backend)
+    try:
+        result = measure(proc.pid, address, args.connections, args.warmup,
+                         args.settle, args.active)
+    finally:
+        proc.kill()
+        proc.wait()
+
+    for key, value in sorted(result.items()):
+        print('%-16s %s' % (key, '%.2f' % value if isinstance(value, float)
+                            else value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': platform.python_version(),
+                    'gevent': gevent.__version__,
+                    'platform': platform.platform(),
+                    'backend': args.backend,
+                    'server_options': options,
+                },
+                'results': result,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        for key in ('connections', 'active'):
+            if baseline.get(key) != result[key]:
+                print('baseline %s=%s differs from %s, not comparable' % (
+                    key, baseline.get(key), result[key]))
+                return 2
+
+        regressions = compare({'memory': result}, {'memory': baseline},
+                              args.threshold, HIGHER_IS_BETTER,
+                              LOWER_IS_BETTER)
+        for _, key, old, value, change in regressions:
+            print('REGRESSION %-20s %.2f -> %.2f (%+.1f%%)' % (
+                key, old, value, change * 100))
+        if regressions:
+            return 1
+        print('no regressions (threshold %.0f%%)' % (args.threshold * 100))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
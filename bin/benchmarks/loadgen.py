@@ -0,0 +1,248 @@
+# vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+压测客户端
+基于gevent的最小websocket客户端, 只实现压测需要的部分:
+掩码固定为全0, 客户端不用真正做异或, 服务端的解掩码开销不变
+"""
+import os
+import time
+import base64
+import struct
+
+import gevent
+
+from gevent import socket
+from gevent.lock import Semaphore, BoundedSemaphore
+from gevent.pool import Pool
+
+ZERO_MASK = b'\x00\x00\x00\x00'
+
+OPCODE_TEXT = 0x01
+OPCODE_BINARY = 0x02
+OPCODE_CLOSE = 0x08
+
+
+def frame(payload, opcode=OPCODE_BINARY):
+    """编码客户端数据帧(带全0掩码)
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+    return header + ZERO_MASK + payload
+
+
+class HandshakeError(Exception):
+    pass
+
+
+class Connection(object):
+
+    def __init__(self, address, path='/', source=None, timeout=30,
+                 headers=()):
+        self.address = address
+        self.path = path
+        self.source = source
+        self.timeout = timeout
+        self.headers = headers
+        self.sock = None
+        self.rfile = None
+        self.lock = Semaphore()
+
+    def connect(self):
+        source = (self.source, 0) if self.source else None
+        self.sock = socket.create_connection(
+            self.address, self.timeout, source_address=source)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+
+        key = base64.b64encode(os.urandom(16)).decode('latin-1')
+        request = (
+            'GET {0} HTTP/1.1\r\n'
+            'Host: {1}:{2}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: {3}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            '{4}\r\n'
+        ).format(self.path, self.address[0], self.address[1], key,
+                 ''.join('%s: %s\r\n' % h for h in self.headers))
+        self.sock.sendall(request.encode('latin-1'))
+
+        status = self.rfile.readline()
+        if b' 101 ' not in status:
+            raise HandshakeError(status)
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+
+    def send(self, payload, opcode=OPCODE_BINARY):
+        data = frame(payload, opcode)
+        with self.lock:
+            self.sock.sendall(data)
+
+    def recv(self):
+        """返回 (opcode, payload) 连接断开返回 (None, None)
+        """
+        read = self.rfile.read
+        head = read(2)
+        if len(head) < 2:
+            return None, None
+
+        opcode = head[0] & 0x0f
+        length = head[1] & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', read(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', read(8))
+
+        payload = read(length) if length else b''
+        return opcode, payload
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock.sendall(frame(struct.pack('!H', 1000), OPCODE_CLOSE))
+        except socket.error:
+            pass
+        self.rfile.close()
+        self.sock.close()
+        self.sock = None
+
+
+def source_addresses(count):
+    """连接数超过单个源地址的临时端口数量时, 轮流使用 127.0.0.x 作为源地址
+    """
+    if count <= 20000:
+        return [None]
+    return ['127.0.0.%d' % i for i in range(1, 2 + count // 20000)]
+
+
+def open_connections(address, path, count, concurrency=500):
+    """并发建立count个连接
+    """
+    sources = source_addresses(count)
+    conns = [Connection(address, path, sources[i % len(sources)])
+             for i in range(count)]
+
+    pool = Pool(concurrency)
+    for conn in conns:
+        pool.spawn(conn.connect)
+    pool.join(raise_error=True)
+    return conns
+
+
+def percentile(samples, pct):
+    """samples 已排序
+    """
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(len(samples) * pct / 100.0))
+    return samples[index]
+
+
+def handshake_rate(address, path, duration, concurrency, headers=()):
+    """concurrency个greenlet循环 建连->握手->关闭, 返回每秒握手数
+    """
+    count = [0, 0]
+    deadline = time.time() + duration
+
+    def worker():
+        while time.time() < deadline:
+            conn = Connection(address, path, headers=headers)
+            try:
+                conn.connect()
+                count[0] += 1
+            except (socket.error, HandshakeError):
+                count[1] += 1
+            finally:
+                conn.close()
+
+    start = time.time()
+    gevent.joinall([gevent.spawn(worker) for _ in range(concurrency)])
+    cost = time.time() - start
+    return {'handshakes_per_sec': count[0] / cost, 'handshakes': count[0],
+            'errors': count[1]}
+
+
+def echo_latency(address, path, rate, connections, duration, size):
+    """固定发送速率下的往返延迟
+    每个连接按计划时间发送, 延迟从计划时间算起, 避免服务端变慢时少发请求
+    """
+    conns = open_connections(address, path, connections)
+    payload = os.urandom(size)
+    interval = connections / float(rate)
+    samples = []
+
+    def worker(conn, offset):
+        next_send = time.time() + offset
+        deadline = time.time() + duration
+        while next_send < deadline:
+            delay = next_send - time.time()
+            if delay > 0:
+                gevent.sleep(delay)
+            conn.send(payload)
+            opcode, _ = conn.recv()
+            if opcode is None:
+                break
+            samples.append(time.time() - next_send)
+            next_send += interval
+
+    gevent.joinall([gevent.spawn(worker, conn, interval * i / connections)
+                    for i, conn in enumerate(conns)])
+    for conn in conns:
+        conn.close()
+
+    samples.sort()
+    return {
+        'rate': rate,
+        'messages': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'p999_ms': percentile(samples, 99.9) * 1000,
+    }
+
+
+def throughput(address, path, size, connections, duration, window=8):
+    """每个连接保持window条消息在途, 统计每秒消息数和字节数
+    """
+    conns = open_connections(address, path, connections)
+    payload = os.urandom(size)
+    received = [0]
+    deadline = time.time() + duration
+
+    def sender(conn, slots):
+        while time.time() < deadline:
+            slots.acquire()
+            conn.send(payload)
+
+    def receiver(conn, slots):
+        while time.time() < deadline:
+            opcode, _ = conn.recv()
+            if opcode is None:
+                break
+            received[0] += 1
+            slots.release()
+
+    start = time.time()
+    senders = []
+    receivers = []
+    for conn in conns:
+        slots = BoundedSemaphore(window)
+        senders.append(gevent.spawn(sender, conn, slots))
+        receivers.append(gevent.spawn(receiver, conn, slots))
+    gevent.joinall(receivers, timeout=duration + 5)
+    cost = time.time() - start
+    gevent.killall(senders + receivers)
+    for conn in conns:
+        conn.close()
+
+    return {
+        'size': size,
+        'connections': connections,
+        'messages_per_sec': received[0] / cost,
+        'mb_per_sec': received[0] * size / cost / (1024 * 1024),
+    }
@@ -0,0 +1,166 @@
+"""
+消息访问日志
+~~~~~~~~~~
+每条消息同步格式化完整请求/响应写日志的代价比业务逻辑还高, 这里改为:
+
+1. 按 sample_rate 采样, 没采中的消息不做任何格式化
+2. 请求/响应只保留前 max_payload 个字符
+3. 记录放进有界队列, 由后台greenlet每 flush_interval 秒(或攒够 batch_size 条)
+   格式化成json行后一次写出; 队列满时丢弃并计数
+
+    WebSocketServer(addr, application=app,
+                     access_log={'sample_rate': 0.01, 'max_payload': 128})
+
+"""
+
+import json
+import time
+import random
+import logging
+
+from collections import deque
+
+import gevent
+
+from gevent.event import Event
+
+log = logging.getLogger()
+
+
+_BUFFERS = (str, bytes, bytearray, memoryview)
+
+
+def _size(payload):
+    # 帧数据的字节数, 文本响应发送时才按utf-8编码
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload.encode('utf-8'))
+    return memoryview(payload).nbytes
+
+
+def _text(payload):
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return bytes(payload).decode('utf-8', 'replace')
+    return payload if payload is None or isinstance(payload, str) else str(payload)
+
+
+class AccessLog(object):
+
+    def __init__(self, sample_rate=1.0, max_payload=256, max_queue=10000,
+                 batch_size=500, flush_interval=1, logger=None):
+        """
+        sample_rate: 采样比例 0~1
+        max_payload: 请求/响应最多记录的长度, 0 不记录内容
+        max_queue: 等待写出的记录上限, 超过时丢弃
+        batch_size/flush_interval: 攒够多少条或者多少秒写一次
+        logger: 写出使用的logger, 默认 logging.getLogger('access')
+        """
+        self.sample_rate = sample_rate
+        self.max_payload = max_payload
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logger or logging.getLogger('access')
+
+        self.queue = deque()
+        self.dropped = 0
+        self._reported = 0
+
+        self._wakeup = Event()
+        self._flusher = None
+
+    def _truncate(self, payload):
+        if payload is None or not self.max_payload:
+            return None
+        if not isinstance(payload, _BUFFERS):
+            payload = str(payload)
+        if len(payload) > self.max_payload:
+            return payload[:self.max_payload], True
+        return payload, False
+
+    @staticmethod
+    def context(environ):
+        """连接建立时取出日志需要的字段, 连接关闭后 ws.environ 为None
+        """
+        return (environ.get('X-Req-Id') or environ.get('HTTP_X_REQ_ID', ''),
+                environ.get('wsgi.websocket_route'),
+                environ.get('REMOTE_ADDR'))
+
+    def record(self, context, request, response, latency, request_payload=None,
+               response_payload=None):
+        """context: context(environ) 的返回值
+        request/response: 解码后的消息和 on_message 的返回值, 记录内容
+        request_payload/response_payload: 收到的(解压后)和编码后要发出的帧数据,
+            记录大小; 只在采中时计算
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        queue = self.queue
+        if len(queue) >= self.max_queue:
+            self.dropped += 1
+            return
+
+        reqid, route, addr = context
+        queue.append((
+            time.time(), reqid, route, addr,
+            _size(request_payload), _size(response_payload), latency,
+            self._truncate(request), self._truncate(response),
+        ))
+
+        if self._flusher is None:
+            self._flusher = self._start()
+        if len(queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def _start(self):
+        """启动后台写出, 返回的对象在 close 时停止
+        """
+        return gevent.spawn(self._run)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    @staticmethod
+    def _format(item):
+        ts, reqid, route, addr, req_size, resp_size, latency, req, resp = item
+        record = {
+            'time': round(ts, 3),
+            'req_id': reqid,
+            'route': route,
+            'addr': addr,
+            'req_size': req_size,
+            'resp_size': resp_size,
+            'latency_ms': round(latency * 1000, 3),
+        }
+        if req is not None:
+            record['req'] = _text(req[0])
+            if req[1]:
+                record['req_truncated'] = True
+        if resp is not None:
+            record['resp'] = _text(resp[0])
+            if resp[1]:
+                record['resp_truncated'] = True
+        return json.dumps(record, ensure_ascii=False)
+
+    def flush(self):
+        queue = self.queue
+        while queue:
+            count = min(len(queue), self.batch_size)
+            lines = [self._format(queue.popleft()) for _ in range(count)]
+            self.logger.info('\n'.join(lines))
+
+        if self.dropped != self._reported:
+            log.warning('access log queue full, dropped %d records',
+                        self.dropped - self._reported)
+            self._reported = self.dropped
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+        self.flush()
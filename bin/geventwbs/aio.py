@@ -0,0 +1,689 @@
+"""
+asyncio 后端
+~~~~~~~~~~
+和 gevent 的 WebSocketServer 共用 protocol.py 的协议实现(握手检查, 帧编解码,
+MessageParser 的帧检查和分片状态), 路由同样使用 Resource,
+应用继承 AsyncWebSocketApplication, on_open/on_message/on_close
+可以是协程, 也可以是普通函数:
+
+    class Echo(AsyncWebSocketApplication):
+        CODEC = 'json'
+
+        async def on_message(self, message, *args, **kwargs):
+            return message
+
+    server = AsyncWebSocketServer(('0.0.0.0', 8000),
+                                  Resource([('/echo', Echo)]))
+    asyncio.run(server.serve_forever())
+
+只依赖asyncio的接口, 可以运行在 uvloop 等兼容的事件循环上. 不要和gevent的
+monkey.patch_all 一起使用.
+
+支持的参数和 WebSocketServer 相同: compression, max_frame_size,
+max_message_size, access_log, auth(access_log 使用 AsyncAccessLog, auth 使用
+AsyncSessionAuthenticator); 发送队列/合并写/心跳/指标/backplane 只在 gevent
+后端提供. 自定义鉴权的 authenticate 在事件循环里调用, 可以返回协程.
+没有 Upgrade 头的http请求交给 Resource 里的wsgi应用, 在事件循环里同步执行,
+只适合 /metrics 这类很快返回的请求.
+"""
+
+import io
+import sys
+import time
+import asyncio
+import inspect
+import logging
+
+from collections import deque
+from urllib.parse import unquote
+
+from .core import WebSocketApplication
+from .protocol import Connection, Message, Close, encode_frame
+from .protocol import HandshakeError, check_request, requested_protocols
+from .protocol import handshake_response
+from .exceptions import WebSocketError
+from .deflate import PerMessageDeflateFactory
+from .accesslog import AccessLog
+from .auth import SessionAuthenticator, AuthUnavailable, TTLCache
+from .registry import Client, ClientRegistry
+
+log = logging.getLogger()
+
+MSG_ALREADY_CLOSED = "Connection is already closed"
+MSG_SOCKET_DEAD = "Socket is dead"
+
+# 请求头的大小上限
+MAX_REQUEST_HEAD = 64 * 1024
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+class AsyncWebSocket(object):
+    """asyncio 连接上的websocket, 接口和 websocket.WebSocket 对应, 收发是协程
+    """
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, environ, reader, writer, connection, handler):
+        self.environ = environ
+        self.reader = reader
+        self.writer = writer
+        self.connection = connection
+        self.handler = handler
+        self.closed = False
+        self.events = deque()
+
+    async def receive_raw(self):
+        """返回 (binary, payload), 连接关闭时返回None
+        """
+        if self.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        connection = self.connection
+        events = self.events
+        while True:
+            while events:
+                event = events.popleft()
+                if isinstance(event, Message):
+                    return event.binary, event.data
+                if isinstance(event, Close):
+                    await self._flush()
+                    self._abort()
+                    return None
+                # ping 已经自动回复
+
+            try:
+                data = await self.reader.read(self.READ_SIZE)
+            except (ConnectionError, OSError):
+                data = b''
+            connection.receive_data(data)
+            events.extend(connection.events())
+            await self._flush()
+
+    async def receive(self):
+        message = await self.receive_raw()
+        if message is None:
+            return None
+
+        binary, payload = message
+        if binary:
+            return payload
+        try:
+            return payload.decode('utf-8')
+        except UnicodeDecodeError:
+            await self.close(1007)
+            raise
+
+    async def _flush(self):
+        data = self.connection.data_to_send()
+        if data:
+            await self._write(data)
+
+    async def _write(self, data):
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            self._abort()
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
+    async def send(self, message, binary=None):
+        if self.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+        await self._write(self.connection.send(message, binary))
+
+    def send_raw(self, frame):
+        """发送 encode_frame 编码好的帧, 不等待写完, 广播时使用
+        """
+        if self.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+        self.writer.write(frame)
+
+    async def ping(self, payload=b''):
+        await self._write(self.connection.ping(payload))
+
+    async def close(self, code=1000, message=b''):
+        if self.closed:
+            return
+        try:
+            await self._write(self.connection.close(code, message))
+        except WebSocketError:
+            log.debug("Failed to write closing frame -> closing socket")
+        finally:
+            self._abort()
+
+    def _abort(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class _AsyncPipeline(object):
+    """和 core._Pipeline 相同: 单个连接上最多 concurrency 条消息同时处理
+    """
+
+    _SKIP = object()
+
+    def __init__(self, app, concurrency, ordered):
+        self.app = app
+        self.ordered = ordered
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+
+        self.seq = 0
+        self.next_seq = 0
+        self.pending = {}
+
+    async def submit(self, message, stime, payload=None):
+        await self.slots.acquire()
+        seq = self.seq
+        self.seq += 1
+        task = asyncio.ensure_future(self._run(seq, message, stime, payload))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, seq, message, stime, payload):
+        try:
+            resp = await self.app.process_message(message, stime, payload)
+        except Exception:
+            log.exception('on_message failed: req=%s', message)
+            resp = self._SKIP
+
+        if not self.ordered:
+            await self._send(resp)
+            return
+
+        pending = self.pending
+        pending[seq] = resp
+        while self.next_seq in pending:
+            resp = pending.pop(self.next_seq)
+            self.next_seq += 1
+            await self._send(resp)
+
+    async def _send(self, resp):
+        try:
+            if resp is not self._SKIP and resp is not None:
+                await self.app.ws.send(*resp)
+        except WebSocketError:
+            pass
+        except Exception:
+            # 不能让有序模式下后面的响应卡住
+            log.exception('send response failed: resp=%r', resp)
+        finally:
+            self.slots.release()
+
+    async def join(self):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks))
+
+
+class AsyncWebSocketApplication(WebSocketApplication):
+    """asyncio 后端的应用, 类属性(CODEC/CODECS/CONCURRENCY/ORDERED/
+    AUTH_REQUIRED/PROTOCOL_NAME)和 WebSocketApplication 含义相同
+    """
+
+    async def handle(self):
+        self.access_log = getattr(self.server, 'access_log', None)
+        if self.access_log is not None:
+            self.log_context = self.access_log.context(self.ws.environ)
+        self.codec = self.select_codec(
+            self.ws.environ.get('wsgi.websocket_protocol'))
+
+        await _maybe_await(self.on_open())
+
+        pipeline = None
+        if self.CONCURRENCY > 1:
+            pipeline = _AsyncPipeline(self, self.CONCURRENCY, self.ORDERED)
+
+        while not self.ws.closed:
+            try:
+                frame = await self.ws.receive_raw()
+                stime = time.time()
+            except WebSocketError:
+                break
+            # 连接关闭或者空消息
+            if not frame or not frame[1]:
+                continue
+
+            binary, payload = frame
+            try:
+                message = self.codec.decode(payload, binary)
+            except ValueError as e:
+                log.warning('decode message failed: codec=%s|%s',
+                            self.codec.name, e)
+                # 已经在处理的消息先回复完再关闭
+                if pipeline is not None:
+                    await pipeline.join()
+                await self.ws.close(1007)
+                break
+
+            if pipeline is not None:
+                await pipeline.submit(message, stime, payload)
+                continue
+            resp = await self.process_message(message, stime, payload)
+            if resp is not None:
+                try:
+                    await self.ws.send(*resp)
+                except WebSocketError:
+                    break
+                except Exception:
+                    log.exception('send response failed: resp=%r', resp)
+
+        if pipeline is not None:
+            await pipeline.join()
+        await _maybe_await(self.on_close('close'))
+
+    async def process_message(self, message, stime, payload=None):
+        resp = await _maybe_await(self.on_message(message))
+        cost = time.time() - stime
+        encoded = self.encode(resp)
+
+        if self.access_log is not None:
+            self.access_log.record(self.log_context, message, resp, cost,
+                                   payload, encoded and encoded[0])
+        else:
+            log.debug('time=%s|req=%s|resp=%s', cost, message, resp)
+        return encoded
+
+    async def send(self, message):
+        payload, binary = self.codec.encode(message)
+        await self.ws.send(payload, binary)
+
+
+def parse_request(head, peer, local):
+    """解析请求行和请求头, 返回 (environ, http_version)
+    请求头转换和 gevent.pywsgi 相同, 名字里有下划线的头丢弃
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    words = lines[0].split()
+    if len(words) != 3:
+        raise ValueError('Invalid request line: {0!r}'.format(lines[0]))
+    method, target, version = words
+
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote(path, 'latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_PROTOCOL': version,
+        'SERVER_NAME': str(local[0]),
+        'SERVER_PORT': str(local[1]),
+        'REMOTE_ADDR': str(peer[0]),
+        'REMOTE_PORT': str(peer[1]),
+        'GATEWAY_INTERFACE': 'CGI/1.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ValueError('Invalid header line: {0!r}'.format(line))
+
+        name = name.strip()
+        if '_' in name:
+            continue
+        name = name.upper().replace('-', '_')
+        value = value.strip()
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+
+        key = 'HTTP_' + name
+        if key in environ:
+            environ[key] += ('; ' if name == 'COOKIE' else ',') + value
+        else:
+            environ[key] = value
+    return environ, version
+
+
+def http_response(status, headers=(), body=b''):
+    if not isinstance(body, bytes):
+        body = str(body).encode('utf-8')
+    lines = ['HTTP/1.1 ' + status]
+    lines.extend('{0}: {1}'.format(name, value) for name, value in headers)
+    lines.append('Content-Length: {0}'.format(len(body)))
+    lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+class AsyncHandler(object):
+    """一个客户端连接, 对应 core.WebSocketHandler
+    """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info('peername')
+        self.environ = None
+        self.websocket = None
+
+    async def handle(self):
+        try:
+            await self._handle()
+        except Exception:
+            log.exception('websocket connection failed: %s',
+                          self.client_address)
+        finally:
+            self.writer.close()
+
+    async def _respond(self, status, headers=(), body=b''):
+        try:
+            self.writer.write(http_response(status, headers, body))
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+
+    async def _handle(self):
+        try:
+            head = await self.reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            return await self._respond('431 Request Header Fields Too Large')
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            return
+
+        try:
+            self.environ, version = parse_request(
+                head, self.client_address,
+                self.writer.get_extra_info('sockname'))
+        except ValueError as e:
+            log.info('Bad request from %s: %s', self.client_address, e)
+            return await self._respond('400 Bad Request')
+
+        if not self.environ.get('HTTP_UPGRADE'):
+            return await self.run_wsgi()
+
+        try:
+            key = check_request(self.environ, version)
+        except HandshakeError as e:
+            log.warning('Websocket handshake failed: %s', e)
+            return await self._respond(e.status or '400 Bad Request',
+                                       e.headers, e.message or '')
+
+        await self.upgrade_connection(key)
+
+    async def run_wsgi(self):
+        environ = self.environ
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = await self.reader.readexactly(length) if length > 0 else b''
+        environ['wsgi.input'] = io.BytesIO(body)
+
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            return lambda data: None
+
+        result = self.server.application(environ, start_response)
+        try:
+            body = b''.join(
+                part if isinstance(part, bytes) else part.encode('utf-8')
+                for part in result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        status, headers = response
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ('content-length', 'connection')]
+        await self._respond(status, headers, body)
+
+    async def upgrade_connection(self, key):
+        server = self.server
+        environ = self.environ
+
+        application = server.application
+        app = application.resolve(environ) \
+            if hasattr(application, 'resolve') else None
+        if app is None:
+            return await self._respond('404 Not Found', (), 'Not Found')
+        if not (isinstance(app, type) and
+                issubclass(app, AsyncWebSocketApplication)):
+            log.error('%s is not an AsyncWebSocketApplication', app)
+            return await self._respond('500 Internal Server Error')
+
+        protocol = None
+        requested = requested_protocols(environ)
+        if requested:
+            protocol = app.select_protocol(requested)
+
+        # 鉴权在101之前, 失败时不建立连接
+        user = None
+        if server.authenticator is not None:
+            try:
+                user = await _maybe_await(
+                    server.authenticator.authenticate(environ))
+            except AuthUnavailable:
+                return await self._respond('503 Service Unavailable', (),
+                                           'Authentication unavailable')
+            if user is None and app.AUTH_REQUIRED:
+                return await self._respond('401 Unauthorized', (),
+                                           'Unauthorized')
+            environ['wsgi.websocket_user'] = user
+
+        deflate = None
+        extension = None
+        requested_extensions = environ.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+        if server.compression is not None and requested_extensions:
+            result = server.compression.negotiate(requested_extensions)
+            if result is not None:
+                extension, deflate = result
+
+        connection = Connection(deflate, server.max_frame_size,
+                                server.max_message_size)
+        self.websocket = ws = AsyncWebSocket(
+            environ, self.reader, self.writer, connection, self)
+        environ.update({
+            'wsgi.websocket_version': environ['HTTP_SEC_WEBSOCKET_VERSION'],
+            'wsgi.websocket_protocol': protocol,
+            'wsgi.websocket': ws,
+        })
+
+        self.writer.write(handshake_response(
+            key, environ.get('HTTP_ORIGIN', ''), protocol, extension))
+
+        client = Client(self.client_address, ws, ClientRegistry.user_key(user),
+                        environ.get('wsgi.websocket_route'))
+        server.clients[self.client_address] = client
+        try:
+            await app(ws).handle()
+        finally:
+            del server.clients[self.client_address]
+            if not ws.closed:
+                await ws.close()
+            environ['wsgi.websocket'] = None
+            self.websocket = None
+
+
+class AsyncAccessLog(AccessLog):
+    """AccessLog 的后台写出改为asyncio任务, 参数相同
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncAccessLog, self).__init__(*args, **kwargs)
+        self._wakeup = asyncio.Event()
+
+    def _start(self):
+        return asyncio.get_running_loop().create_task(self._run_async())
+
+    async def _run_async(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        self.flush()
+
+
+class AsyncSessionAuthenticator(SessionAuthenticator):
+    """SessionAuthenticator 的asyncio版本, 参数相同
+    缓存未命中时 store.get_user 在线程池里执行, 不阻塞事件循环;
+    同一个session同时到达的握手共用一个 Future
+    executor: run_in_executor 使用的线程池, None 为事件循环默认的线程池
+    """
+
+    def __init__(self, *args, executor=None, **kwargs):
+        super(AsyncSessionAuthenticator, self).__init__(*args, **kwargs)
+        self.executor = executor
+
+    async def authenticate(self, environ):
+        sid = self.session_id(environ)
+        if sid is None:
+            return None
+
+        user = self.cache.get(sid, TTLCache._MISSING)
+        if user is not TTLCache._MISSING:
+            return user
+
+        pending = self.pending.get(sid)
+        if pending is not None:
+            # 等待者被取消时不能取消共用的查询
+            return await asyncio.shield(pending)
+
+        loop = asyncio.get_running_loop()
+        pending = self.pending[sid] = loop.create_future()
+        try:
+            user = self._user_id(await loop.run_in_executor(
+                self.executor, self.store.get_user, sid))
+        except Exception as e:
+            log.warning('session store failed: %s', e)
+            error = AuthUnavailable(str(e))
+            pending.set_exception(error)
+            # 没有其他握手在等待时, 避免asyncio报告异常没有被读取
+            pending.exception()
+            raise error
+        else:
+            self.cache.set(sid, user,
+                           self.negative_ttl if user is None else None)
+            pending.set_result(user)
+            return user
+        finally:
+            self.pending.pop(sid, None)
+            # 发起查询的握手被取消, 等待的握手一起结束
+            if not pending.done():
+                pending.cancel()
+
+
+class AsyncWebSocketServer(object):
+
+    handler_class = AsyncHandler
+
+    def __init__(self, listener, application, backlog=1024, **kwargs):
+        self.address = listener
+        self.application = application
+        self.backlog = backlog
+        self.clients = ClientRegistry()
+
+        # 以下参数和 WebSocketServer 相同
+        compression = kwargs.pop('compression', None)
+        if compression is True:
+            compression = PerMessageDeflateFactory()
+        elif isinstance(compression, dict):
+            compression = PerMessageDeflateFactory(**compression)
+        self.compression = compression or None
+
+        self.max_frame_size = kwargs.pop('max_frame_size', None)
+        self.max_message_size = kwargs.pop('max_message_size', None)
+
+        access_log = kwargs.pop('access_log', None)
+        if access_log is True:
+            access_log = AsyncAccessLog()
+        elif isinstance(access_log, dict):
+            access_log = AsyncAccessLog(**access_log)
+        elif access_log and not isinstance(access_log, AsyncAccessLog):
+            # gevent 的后台greenlet在asyncio下不会运行, 记录永远写不出去
+            raise TypeError('asyncio server requires an AsyncAccessLog')
+        self.access_log = access_log or None
+
+        auth = kwargs.pop('auth', None)
+        if isinstance(auth, dict):
+            auth = AsyncSessionAuthenticator.from_config(auth)
+        elif isinstance(auth, SessionAuthenticator) and \
+                not isinstance(auth, AsyncSessionAuthenticator):
+            # 同步的store查询会阻塞整个事件循环
+            raise TypeError('asyncio server requires an '
+                            'AsyncSessionAuthenticator')
+        self.authenticator = auth
+
+        if kwargs:
+            raise TypeError('Unsupported options for asyncio server: {0}'.format(
+                ', '.join(sorted(kwargs))))
+
+        self.server = None
+
+    @property
+    def server_port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, reader, writer):
+        await self.handler_class(self, reader, writer).handle()
+
+    async def start(self):
+        host, port = self.address
+        self.server = await asyncio.start_server(
+            self._handle, host, port, backlog=self.backlog,
+            limit=MAX_REQUEST_HEAD)
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.access_log is not None:
+            self.access_log.close()
+
+    def subscribe(self, topic, ws):
+        client = self.clients.get(ws.handler.client_address)
+        if client is None or client.ws is not ws:
+            return False
+        self.clients.tag(client, topic)
+        return True
+
+    def unsubscribe(self, topic, ws):
+        client = self.clients.get(ws.handler.client_address)
+        if client is not None and client.ws is ws:
+            self.clients.untag(client, topic)
+
+    def publish(self, topic, message, binary=None):
+        """向topic的订阅者发送消息, 只编码一次, 返回订阅者数量
+        """
+        return self._send_clients(self.clients.by_tag(topic), message, binary)
+
+    def broadcast(self, message, binary=None):
+        return self._send_clients(list(self.clients.values()), message, binary)
+
+    def send_to_user(self, user, message, binary=None):
+        return self._send_clients(self.clients.by_user(user), message, binary)
+
+    def _send_clients(self, clients, message, binary):
+        frame = encode_frame(message, binary)
+        count = 0
+        for client in clients:
+            try:
+                client.ws.send_raw(frame)
+                count += 1
+            except WebSocketError:
+                pass
+        return count
@@ -0,0 +1,247 @@
+"""
+握手鉴权
+~~~~~~~~~~
+在返回101之前从cookie里取session id, 查出用户后放进
+environ['wsgi.websocket_user'], 应用里通过 self.user 使用. 查不到用户时
+返回401, 不建立websocket连接.
+
+    # 直接使用 webconfig.SESSION 配置, 经 zbase3.web.session 读取,
+    # 用户为session里 user_key(默认userid) 的值
+    WebSocketServer(addr, application=app, auth=config.SESSION)
+
+    # 或者自己指定store和缓存参数
+    WebSocketServer(addr, application=app, auth=SessionAuthenticator(
+        MemorySessionStore({'sid1': 'user1'}), ttl=30))
+
+查询结果缓存在进程内的 TTLCache 里(LRU, 有大小上限), 查不到的session也会
+缓存 negative_ttl 秒; 同一个session同时有多个握手时只查一次store.
+断线重连风暴时只有缓存未命中的session会访问redis.
+
+应用可以用 AUTH_REQUIRED = False 允许匿名连接, 此时 self.user 为None.
+"""
+
+import time
+import logging
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from gevent.event import AsyncResult
+
+try:
+    from zbase3.web import session as zsession
+except ImportError:
+    zsession = None
+
+log = logging.getLogger()
+
+
+class TTLCache(object):
+    """LRU + 过期时间, 超过 maxsize 时淘汰最久没有访问的
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize=100000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        item = self.data.get(key, self._MISSING)
+        if item is self._MISSING:
+            return default
+
+        expire, value = item
+        if expire < time.monotonic():
+            del self.data[key]
+            return default
+
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        data = self.data
+        data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl),
+                     value)
+        data.move_to_end(key)
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.data.clear()
+
+
+class SessionStore(ABC):
+    """session id -> 用户, 不存在返回None, 存储出错时抛出异常
+    """
+
+    @abstractmethod
+    def get_user(self, sid):
+        """返回sid对应的用户
+        """
+
+
+class MemorySessionStore(SessionStore):
+
+    def __init__(self, sessions=None):
+        self.sessions = dict(sessions or {})
+
+    def get_user(self, sid):
+        return self.sessions.get(sid)
+
+    def set(self, sid, user):
+        self.sessions[sid] = user
+
+    def delete(self, sid):
+        self.sessions.pop(sid, None)
+
+
+class ZbaseSessionStore(SessionStore):
+    """用 zbase3.web.session 读取session, 和web服务使用同一套存储和格式
+    session_class: zbase3 的session类, 如 SessionUser/SessionRedis
+    options: session类的构造参数, 即 webconfig.SESSION 里的 config/server
+    user_key: 用户id在session里的字段
+    """
+
+    def __init__(self, session_class, options=None, expire=3600,
+                 user_key='userid'):
+        if not user_key:
+            raise ValueError('user_key is required')
+
+        self.session_class = session_class
+        self.options = options or {}
+        self.expire = expire
+        self.user_key = user_key
+
+    @classmethod
+    def from_config(cls, session):
+        """webconfig.SESSION 格式的配置
+        """
+        if zsession is None:
+            raise RuntimeError('ZbaseSessionStore requires zbase3.web.session')
+
+        name = session.get('store')
+        session_class = getattr(zsession, name or '', None)
+        if session_class is None:
+            raise ValueError('Unsupported session store: {0}'.format(name))
+
+        if 'config' in session:
+            options = {'config': session['config']}
+        else:
+            options = {'server': session.get('server')}
+        conf = session.get('config') or {}
+        user_key = conf.get('user_key') or session.get('user_key') or 'userid'
+        return cls(session_class, options, session.get('expire', 3600),
+                   user_key)
+
+    def get_user(self, sid):
+        session = self.session_class(sid=sid, expire=self.expire,
+                                     **self.options)
+        return session.get(self.user_key)
+
+
+class AuthUnavailable(Exception):
+    """session store 出错, 握手返回503
+    """
+
+
+class Authenticator(ABC):
+    """握手鉴权, 返回用户或者None(未登录)
+    """
+
+    @abstractmethod
+    def authenticate(self, environ):
+        """从握手请求的environ里取出用户
+        """
+
+
+class SessionAuthenticator(Authenticator):
+
+    def __init__(self, store, cookie_name='sessionid', cache_size=100000,
+                 ttl=60, negative_ttl=5):
+        """
+        store: SessionStore
+        ttl: 查到的用户缓存秒数, 注销后最多这么久内旧session仍然有效,
+             可以调用 invalidate 立即失效
+        negative_ttl: 无效session缓存秒数
+        """
+        self.store = store
+        self.cookie_name = cookie_name
+        self.negative_ttl = negative_ttl
+        self.cache = TTLCache(cache_size, ttl)
+        # 正在查询的session, 同时到达的握手共用一次查询
+        self.pending = {}
+
+    @classmethod
+    def from_config(cls, session, **kwargs):
+        """使用 webconfig.SESSION 格式的配置
+        """
+        return cls(ZbaseSessionStore.from_config(session),
+                   session.get('cookie_name', 'sessionid'), **kwargs)
+
+    def session_id(self, environ):
+        cookie = environ.get('HTTP_COOKIE')
+        if not cookie:
+            return None
+
+        # 只取一个cookie, 不用SimpleCookie解析全部
+        for item in cookie.split(';'):
+            name, sep, value = item.partition('=')
+            if sep and name.strip() == self.cookie_name:
+                return value.strip().strip('"') or None
+        return None
+
+    def authenticate(self, environ):
+        sid = self.session_id(environ)
+        if sid is None:
+            return None
+
+        user = self.cache.get(sid, TTLCache._MISSING)
+        if user is not TTLCache._MISSING:
+            return user
+
+        pending = self.pending.get(sid)
+        if pending is not None:
+            return pending.get()
+
+        pending = self.pending[sid] = AsyncResult()
+        try:
+            user = self._user_id(self.store.get_user(sid))
+        except Exception as e:
+            # 出错不缓存, 等待同一个session的握手一起失败
+            log.warning('session store failed: %s', e)
+            error = AuthUnavailable(str(e))
+            pending.set_exception(error)
+            raise error
+        finally:
+            self.pending.pop(sid, None)
+
+        self.cache.set(sid, user, self.negative_ttl if user is None else None)
+        pending.set(user)
+        return user
+
+    @staticmethod
+    def _user_id(user):
+        # 用户要作为连接注册表的索引(send_to_user), 必须是可以hash的用户id
+        if user is None:
+            return None
+        try:
+            hash(user)
+        except TypeError:
+            log.warning('session user is not a hashable id: %s',
+                        type(user).__name__)
+            return None
+        return user
+
+    def invalidate(self, sid):
+        """注销时调用, 立即清除缓存
+        """
+        self.cache.pop(sid)
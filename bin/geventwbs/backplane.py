@@ -0,0 +1,330 @@
+"""
+消息总线(backplane)
+~~~~~~~~~~
+连接只存在于接受它的进程里, 多进程/多节点部署时 publish/broadcast/send_to/
+send_to_user 要经过总线才能到达其他进程的连接:
+
+1. 本地发起的消息由server先投递给本地连接, 再交给总线
+2. 总线把一个tick内的消息合并成一批发出, 其他进程收到后用 *_local 投递
+3. 自己发出的批次带有 origin, 收到时忽略
+
+MemoryBackplane: 同一进程内模拟多个节点, 用于测试和benchmark
+RedisBackplane: Redis pub/sub, 每个进程一个订阅连接
+multiproc.WorkerBus: 本机多进程之间的Unix socket总线
+
+    server = WebSocketServer(addr, application=app,
+                             backplane=RedisBackplane(REDIS_CONF))
+
+"""
+
+import os
+import struct
+import logging
+
+from abc import ABC, abstractmethod
+from collections import deque
+
+import gevent
+
+from gevent.event import Event
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+log = logging.getLogger()
+
+# 总线消息类型
+PUBLISH = 1
+BROADCAST = 2
+SEND = 3
+SEND_USER = 4
+
+_LEN = struct.Struct('!I')
+_INT = struct.Struct('!q')
+_ORIGIN_SIZE = 8
+
+# 值的类型标记
+_NONE = 0
+_TRUE = 1
+_FALSE = 2
+_STR = 3
+_BYTES = 4
+_INT_TAG = 5
+_TUPLE = 6
+
+
+def _dump(value, out):
+    if value is None:
+        out.append(bytes((_NONE,)))
+    elif value is True:
+        out.append(bytes((_TRUE,)))
+    elif value is False:
+        out.append(bytes((_FALSE,)))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(bytes((_STR,)) + _LEN.pack(len(data)))
+        out.append(data)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        data = bytes(value)
+        out.append(bytes((_BYTES,)) + _LEN.pack(len(data)))
+        out.append(data)
+    elif isinstance(value, int):
+        out.append(bytes((_INT_TAG,)) + _INT.pack(value))
+    elif isinstance(value, (tuple, list)):
+        out.append(bytes((_TUPLE,)) + _LEN.pack(len(value)))
+        for item in value:
+            _dump(item, out)
+    else:
+        raise TypeError('Unsupported backplane value: {0!r}'.format(type(value)))
+
+
+def _load(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _INT_TAG:
+        return _INT.unpack_from(data, pos)[0], pos + _INT.size
+
+    length, = _LEN.unpack_from(data, pos)
+    pos += _LEN.size
+    if tag == _STR:
+        return str(data[pos:pos + length], 'utf-8'), pos + length
+    if tag == _BYTES:
+        return bytes(data[pos:pos + length]), pos + length
+    if tag == _TUPLE:
+        items = []
+        for _ in range(length):
+            item, pos = _load(data, pos)
+            items.append(item)
+        return tuple(items), pos
+
+    raise ValueError('Invalid backplane value tag: {0}'.format(tag))
+
+
+def encode_batch(origin, messages):
+    """messages: [(kind, args), ...] 编码成一个批次
+    不用pickle, 总线上的数据可能来自其他机器
+    """
+    out = [origin]
+    for message in messages:
+        _dump(message, out)
+    return b''.join(out)
+
+
+def decode_batch(data):
+    """返回 (origin, [(kind, args), ...])
+    """
+    data = memoryview(data)
+    origin = bytes(data[:_ORIGIN_SIZE])
+    pos = _ORIGIN_SIZE
+    messages = []
+    while pos < len(data):
+        message, pos = _load(data, pos)
+        messages.append(message)
+    return origin, messages
+
+
+class Backplane(ABC):
+    """总线基类, 子类实现 _write 发送批次, 收到批次时调用 _receive
+
+    tick: 合并发送的时间窗口(秒), 0 表示有消息就立刻发送
+    max_pending: 等待发送的消息上限, 超过时丢弃新消息
+    max_batch: 单个批次最多包含的消息数
+    """
+
+    def __init__(self, tick=0.005, max_pending=100000, max_batch=512):
+        self.tick = tick
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+
+        self.origin = os.urandom(_ORIGIN_SIZE)
+        self.server = None
+        self.pending = deque()
+        self.dropped = 0
+
+        self._wakeup = Event()
+        self._flusher = None
+
+    def attach(self, server):
+        """绑定server并开始工作, 收到的消息投递给这个server的连接
+        """
+        # 主进程创建的实例会被fork到每个worker, origin 要在worker里重新生成,
+        # 否则worker之间互相当作自己发出的批次丢弃
+        self.origin = os.urandom(_ORIGIN_SIZE)
+        self.server = server
+        self.start()
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = gevent.spawn(self._run_flush)
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+
+    def publish(self, topic, message, binary=None):
+        self._put(PUBLISH, (topic, message, binary))
+
+    def broadcast(self, message, binary=None):
+        self._put(BROADCAST, (message, binary))
+
+    def send(self, address, message, binary=None):
+        self._put(SEND, (address, message, binary))
+
+    def send_user(self, user, message, binary=None):
+        self._put(SEND_USER, (user, message, binary))
+
+    def _put(self, kind, args):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            if self.dropped & 0x3ff == 1:
+                log.warning('backplane pending full, dropped=%d', self.dropped)
+            return
+
+        self.pending.append((kind, args))
+        self._wakeup.set()
+
+    def _run_flush(self):
+        while True:
+            self._wakeup.wait()
+            if self.tick:
+                # 等一个tick, 这段时间内的消息合并成一批
+                gevent.sleep(self.tick)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        pending = self.pending
+        while pending:
+            count = min(len(pending), self.max_batch)
+            messages = [pending.popleft() for _ in range(count)]
+            try:
+                self._write(encode_batch(self.origin, messages))
+            except Exception:
+                self.dropped += count
+                log.exception('backplane write failed, dropped %d messages',
+                              count)
+
+    @abstractmethod
+    def _write(self, batch):
+        """发送编码好的批次
+        """
+
+    def _receive(self, batch):
+        try:
+            origin, messages = decode_batch(batch)
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+            log.warning('invalid backplane batch: %d bytes', len(batch))
+            return
+
+        if origin == self.origin or self.server is None:
+            return
+
+        for message in messages:
+            try:
+                self._deliver(*message)
+            except Exception:
+                log.exception('backplane deliver failed: %r', message[0])
+
+    def _deliver(self, kind, args):
+        server = self.server
+        if kind == PUBLISH:
+            server.publish_local(*args)
+        elif kind == BROADCAST:
+            server.broadcast_local(*args)
+        elif kind == SEND:
+            server.send_local(*args)
+        elif kind == SEND_USER:
+            server.send_user_local(*args)
+        else:
+            log.warning('unknown backplane message kind: %r', kind)
+
+
+class MemoryBackplane(Backplane):
+    """进程内的总线, 同一个 channel 的实例相当于不同节点
+    批次同样经过编码, 行为和网络总线一致
+    """
+
+    # channel -> 加入的实例
+    channels = {}
+
+    def __init__(self, channel='default', **kwargs):
+        super(MemoryBackplane, self).__init__(**kwargs)
+        self.channel = channel
+
+    def start(self):
+        self.channels.setdefault(self.channel, set()).add(self)
+        super(MemoryBackplane, self).start()
+
+    def close(self):
+        super(MemoryBackplane, self).close()
+        members = self.channels.get(self.channel)
+        if members is not None:
+            members.discard(self)
+            if not members:
+                del self.channels[self.channel]
+
+    def _write(self, batch):
+        for member in list(self.channels.get(self.channel, ())):
+            # 和Redis一样自己也会收到, 由origin过滤
+            gevent.spawn(member._receive, batch)
+
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub 总线
+    所有节点使用同一个channel, 每个进程一个订阅连接, 每个tick最多一次PUBLISH
+    redis_conf: redis.Redis 参数, 如 config.REDIS_CONF
+    """
+
+    # 订阅连接断开后重连的间隔(秒)
+    RECONNECT_DELAY = 1
+
+    def __init__(self, redis_conf=None, channel='geventwbs', client=None,
+                 **kwargs):
+        if client is None and redis is None:
+            raise RuntimeError('RedisBackplane requires the redis package')
+
+        super(RedisBackplane, self).__init__(**kwargs)
+        self.channel = channel
+        self.client = client or redis.Redis(**(redis_conf or {}))
+        self._subscriber = None
+
+    def start(self):
+        if self._subscriber is None:
+            self._subscriber = gevent.spawn(self._run_subscribe)
+        super(RedisBackplane, self).start()
+
+    def close(self):
+        super(RedisBackplane, self).close()
+        if self._subscriber is not None and \
+                self._subscriber is not gevent.getcurrent():
+            self._subscriber.kill(block=False)
+        self._subscriber = None
+
+    def _write(self, batch):
+        self.client.publish(self.channel, batch)
+
+    def _run_subscribe(self):
+        while True:
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                for item in pubsub.listen():
+                    if item and item.get('type') == 'message':
+                        self._receive(item['data'])
+            except Exception as e:
+                log.warning('redis backplane subscribe failed: %s', e)
+            finally:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            gevent.sleep(self.RECONNECT_DELAY)
@@ -0,0 +1,140 @@
+"""
+消息编解码
+~~~~~~~~~~
+WebSocketApplication 通过 CODEC 声明消息格式, on_message 收到的是解码后的
+对象, 返回值(以及 app.send 的参数)编码后发送:
+
+    class Chat(WebSocketApplication):
+        CODEC = 'json'
+
+也可以通过子协议让客户端选择, 客户端 Sec-WebSocket-Protocol 里第一个
+支持的子协议生效, 都不支持时使用 CODEC:
+
+    class Chat(WebSocketApplication):
+        CODECS = {'chat.v1+msgpack': 'msgpack', 'chat.v1+json': 'json'}
+
+raw: 默认, 和不使用编解码时一样, 文本帧为str, 二进制帧为bytes
+json: 安装了 orjson 时使用 orjson, 否则使用标准库json, 发送文本帧
+msgpack: 需要安装 msgpack, 发送二进制帧
+
+解码直接作用在收到的payload(bytes)上, 不先转成str; 编码直接得到bytes.
+"""
+
+import json
+
+from abc import ABC, abstractmethod
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(ABC):
+    """decode 失败时抛出 ValueError, 连接以1007关闭
+    """
+
+    name = None
+
+    @abstractmethod
+    def decode(self, data, binary):
+        """data: 消息payload, binary: 是否为二进制帧
+        """
+
+    @abstractmethod
+    def encode(self, message):
+        """返回 (payload, binary), binary 为 None 时按payload类型决定帧类型
+        """
+
+
+class RawCodec(Codec):
+    name = 'raw'
+
+    def decode(self, data, binary):
+        if binary:
+            return data
+        return data.decode('utf-8')
+
+    def encode(self, message):
+        return message, None
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def __init__(self, backend=None):
+        """backend: 'orjson' 或 'json', 默认有orjson时使用orjson
+        """
+        if backend is None:
+            backend = 'orjson' if orjson is not None else 'json'
+        if backend == 'orjson' and orjson is None:
+            raise RuntimeError('JsonCodec backend orjson is not installed')
+        if backend not in ('orjson', 'json'):
+            raise ValueError('Unknown json backend: {0}'.format(backend))
+
+        self.backend = backend
+        if backend == 'orjson':
+            self.decode = self._decode_orjson
+            self.encode = self._encode_orjson
+
+    def decode(self, data, binary):
+        return json.loads(data)
+
+    def encode(self, message):
+        return json.dumps(message, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8'), False
+
+    @staticmethod
+    def _decode_orjson(data, binary):
+        return orjson.loads(data)
+
+    @staticmethod
+    def _encode_orjson(message):
+        return orjson.dumps(message), False
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('MsgpackCodec requires the msgpack package')
+
+    def decode(self, data, binary):
+        return msgpack.unpackb(data, raw=False)
+
+    def encode(self, message):
+        return msgpack.packb(message, use_bin_type=True), True
+
+
+CODECS = {
+    'raw': RawCodec,
+    'json': JsonCodec,
+    'msgpack': MsgpackCodec,
+}
+
+# 编解码器没有状态, 同名的共用一个实例
+_instances = {}
+
+
+def get_codec(codec):
+    """codec 为名字时返回共用的实例, 为 Codec 实例时原样返回
+    """
+    if codec is None:
+        codec = 'raw'
+
+    if not isinstance(codec, str):
+        return codec
+
+    instance = _instances.get(codec)
+    if instance is None:
+        cls = CODECS.get(codec)
+        if cls is None:
+            raise ValueError('Unknown codec: {0}'.format(codec))
+        instance = _instances[codec] = cls()
+    return instance
@@ -1,46 +1,258 @@
-import re
+import copy
 import time
-import base64
-import hashlib
 import logging
 
+from collections import deque
+
+import gevent
+
+from gevent import Timeout
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Group
 from gevent.pywsgi import WSGIServer
 from gevent.pywsgi import WSGIHandler
-from .exceptions import WebSocketError
+from .exceptions import WebSocketError, SendQueueFull
 from .websocket import WebSocket, Stream
+from .protocol import SUPPORTED_VERSIONS, GUID, HANDSHAKE_STATUS
+from .protocol import HandshakeError, check_request, requested_protocols
+from .protocol import handshake_response
+from .deflate import PerMessageDeflateFactory
+from .sender import DROP_OLDEST, DROP_NEWEST
+from .routing import RouteTable
+from .heartbeat import Heartbeat
+from .drain import Drainer
+from .metrics import WebSocketMetrics
+from .accesslog import AccessLog
+from .codec import get_codec
+from .auth import SessionAuthenticator, AuthUnavailable
+from .registry import Client, ClientRegistry
 from zbase3.base import logger
 
 log = logging.getLogger()
 
 
-class Client(object):
-    def __init__(self, address, ws):
-        self.address = address
-        self.ws = ws
+class _Pipeline(object):
+    """单个连接上并发处理消息
+    最多 concurrency 条消息未完成(有序模式下包括已处理完等待前面响应的),
+    达到上限时 submit 阻塞, 不再读取新消息, 由TCP把压力传回客户端
+    """
+
+    # on_message 异常时占位, 有序模式下后面的响应不会被卡住
+    _SKIP = object()
+
+    def __init__(self, app, concurrency, ordered):
+        self.app = app
+        self.ordered = ordered
+        self.slots = BoundedSemaphore(concurrency)
+        self.group = Group()
+
+        self.seq = 0
+        self.next_seq = 0
+        self.pending = {}
+
+    def submit(self, message, stime, payload=None):
+        self.slots.acquire()
+        if self.app.client is not None:
+            self.app.client.inflight += 1
+        seq = self.seq
+        self.seq += 1
+        self.group.spawn(self._run, seq, message, stime, payload)
+
+    def _run(self, seq, message, stime, payload):
+        try:
+            resp = self.app.process_message(message, stime, payload)
+        except Exception:
+            log.exception('on_message failed: req=%s', message)
+            resp = self._SKIP
+
+        if not self.ordered:
+            self._send(resp)
+            return
+
+        pending = self.pending
+        pending[seq] = resp
+        # 轮到的响应按顺序发出, 发送前先推进序号, 避免其他greenlet重复发送
+        while self.next_seq in pending:
+            resp = pending.pop(self.next_seq)
+            self.next_seq += 1
+            self._send(resp)
+
+    def _send(self, resp):
+        try:
+            if resp is not self._SKIP and resp is not None:
+                self.app.ws.send(*resp)
+        except SendQueueFull:
+            self.app.send_queue_full(resp)
+        except WebSocketError:
+            # 连接已经断开 由读循环负责退出
+            pass
+        except Exception:
+            # 不能让有序模式下后面的响应卡住
+            log.exception('send response failed: resp=%r', resp)
+        finally:
+            self.slots.release()
+            if self.app.client is not None:
+                self.app.client.inflight -= 1
+
+    def join(self):
+        self.group.join()
 
 
 class WebSocketApplication(object):
     PROTOCOL_NAME = ''
 
+    # 同一连接上同时处理的消息数, 0/1 为收到一条处理一条
+    CONCURRENCY = 0
+    # 并发处理时是否按请求顺序发送响应, False 为谁先处理完先发送
+    ORDERED = True
+
+    # 消息编解码 codec.Codec 实例或名字 raw/json/msgpack
+    CODEC = 'raw'
+    # 通过子协议选择编解码 {子协议: codec}, 客户端没有请求其中的子协议时使用 CODEC
+    CODECS = None
+    # 服务端开启鉴权时是否必须登录, False 允许匿名连接
+    AUTH_REQUIRED = True
+
+    # 当前连接使用的编解码, 在 handle 里设置
+    codec = None
+    # 路由的 on_message 耗时直方图, 开启指标时在 handle 里设置
+    latency = None
+    # 服务端配置的 AccessLog, 在 handle 里设置
+    access_log = None
+    # 访问日志的连接字段, 见 AccessLog.context
+    log_context = None
+    # 连接在 server.clients 里的 Client, 用于统计处理中的消息数
+    client = None
+
     def __init__(self, ws):
         self.ws = ws
 
     def handle(self):
+        server = self.ws.handler.server
+        self.access_log = getattr(server, 'access_log', None)
+        if self.access_log is not None:
+            self.log_context = self.access_log.context(self.ws.environ)
+        if hasattr(server, 'client_of'):
+            self.client = server.client_of(self.ws)
+        self.codec = self.select_codec(
+            self.ws.environ.get('wsgi.websocket_protocol'))
+
+        metrics = self.ws.metrics
+        if metrics is not None:
+            self.latency = metrics.message_latency(
+                self.ws.environ.get('wsgi.websocket_route'))
+
         self.on_open()
+
+        pipeline = None
+        if self.CONCURRENCY > 1:
+            pipeline = _Pipeline(self, self.CONCURRENCY, self.ORDERED)
+
         while True:
             try:
                 # 如果已经关闭了直接跳出
                 if self.ws.closed:
                     break
-                message = self.ws.receive()
+                frame = self.ws.receive_raw()
                 stime = time.time()
             except WebSocketError:
                 self.on_close('close')
                 break
-            if message:
-                resp = self.on_message(message)
-                log.info('time=%s|req=%s|resp=%s', time.time()-stime, message, resp)
-                self.ws.send(resp)
+            # 连接关闭或者空消息
+            if not frame or not frame[1]:
+                continue
+
+            binary, payload = frame
+            message = self.decode(payload, binary, pipeline)
+            if self.ws.closed:
+                continue
+
+            if pipeline is not None:
+                pipeline.submit(message, stime, payload)
+                continue
+            if self.client is None:
+                self._handle_message(message, stime, payload)
+                continue
+            self.client.inflight += 1
+            try:
+                self._handle_message(message, stime, payload)
+            finally:
+                self.client.inflight -= 1
+
+        if pipeline is not None:
+            # 等待处理中的消息结束
+            pipeline.join()
+
+    def _handle_message(self, message, stime, payload=None):
+        resp = self.process_message(message, stime, payload)
+        # 只做publish/send_to的消息可以不回复
+        if resp is None:
+            return
+        try:
+            self.ws.send(*resp)
+        except SendQueueFull:
+            self.send_queue_full(resp)
+        except WebSocketError:
+            # 处理期间连接已经关闭(心跳回收/应用close) 由读循环负责退出
+            pass
+        except Exception:
+            # 和并发处理时一样只记录, 不断开连接
+            log.exception('send response failed: resp=%r', resp)
+
+    def process_message(self, message, stime, payload=None):
+        """处理一条消息, 返回编码后的响应 (payload, binary), 不回复时返回None
+        payload: 收到的帧数据, 访问日志按它记录请求大小
+        """
+        resp = self.on_message(message)
+        cost = time.time() - stime
+        if self.latency is not None:
+            self.latency.observe(cost)
+        encoded = self.encode(resp)
+
+        if self.access_log is not None:
+            self.access_log.record(self.log_context, message, resp, cost,
+                                   payload, encoded and encoded[0])
+        else:
+            log.debug('time=%s|req=%s|resp=%s', cost, message, resp)
+        return encoded
+
+    def encode(self, resp):
+        """编码响应, 无法编码时只记录, 不断开连接
+        """
+        if resp is None:
+            return None
+        try:
+            return self.codec.encode(resp)
+        except Exception:
+            log.exception('encode response failed: resp=%r', resp)
+            return None
+
+    def decode(self, payload, binary, pipeline=None):
+        """解码收到的消息, 格式错误时以1007关闭连接
+        pipeline 里已经在处理的消息先回复完再关闭
+        """
+        try:
+            return self.codec.decode(payload, binary)
+        except ValueError as e:
+            log.warning('decode message failed: codec=%s|%s',
+                        self.codec.name, e)
+            if pipeline is not None:
+                pipeline.join()
+            self.ws.close(1007)
+            return None
+
+    def send(self, message):
+        """编码后发送
+        """
+        payload, binary = self.codec.encode(message)
+        self.ws.send(payload, binary)
+
+    def send_queue_full(self, message):
+        """block策略下等待队列空间超时, 响应被丢弃
+        """
+        log.warning('send queue full, drop response: resp=%r', message)
+        if self.ws.metrics is not None:
+            self.ws.metrics.send_queue_full()
 
     def on_open(self, *args, **kwargs):
         pass
@@ -55,6 +267,43 @@ class WebSocketApplication(object):
     def protocol_name(cls):
         return cls.PROTOCOL_NAME
 
+    @classmethod
+    def select_protocol(cls, requested):
+        """从客户端请求的子协议列表里选择一个, 都不支持时返回None
+        CODECS 里的子协议优先, 按客户端给出的顺序
+        """
+        if cls.CODECS:
+            for protocol in requested:
+                if protocol in cls.CODECS:
+                    return protocol
+
+        protocol = cls.protocol_name()
+        if protocol and protocol in requested:
+            return protocol
+        return None
+
+    @classmethod
+    def check_codecs(cls):
+        """检查 CODEC/CODECS 都可用, 缺少依赖(如msgpack)时构造路由就失败,
+        而不是每个连接握手后出错
+        """
+        get_codec(cls.CODEC)
+        for codec in (cls.CODECS or {}).values():
+            get_codec(codec)
+
+    @classmethod
+    def select_codec(cls, protocol=None):
+        if cls.CODECS and protocol in cls.CODECS:
+            return get_codec(cls.CODECS[protocol])
+        return get_codec(cls.CODEC)
+
+    @property
+    def user(self):
+        """握手时鉴权得到的用户, 没有开启鉴权或者匿名连接时为None
+        """
+        environ = self.ws.environ
+        return environ.get('wsgi.websocket_user') if environ else None
+
     @property
     def server(self):
 
@@ -67,8 +316,31 @@ class WebSocketApplication(object):
 
 
 class Resource(object):
+    """路由: apps 为 [(path正则, application), ...] 按顺序匹配
+    路由表在构造时编译, 之后修改 apps 需要调用 compile()
+    """
+
+    # path -> app 查找结果缓存大小
+    CACHE_SIZE = 1024
+
     def __init__(self, apps=None):
         self.apps = apps if apps else []
+        self.compile()
+
+    def compile(self):
+        websocket_apps = []
+        wsgi_apps = []
+        for path, app in self.apps:
+            if self._is_websocket_app(app):
+                app.check_codecs()
+                websocket_apps.append((path, app))
+            else:
+                wsgi_apps.append((path, app))
+
+        self._tables = {
+            True: RouteTable(websocket_apps, self.CACHE_SIZE),
+            False: RouteTable(wsgi_apps, self.CACHE_SIZE),
+        }
 
     def _is_websocket_app(self, app):
         return isinstance(app, type) and issubclass(app, WebSocketApplication)
@@ -76,11 +348,23 @@ class Resource(object):
     def _app_by_path(self, environ_path, is_websocket_request):
         """匹配对应的application
         """
-        for path, app in self.apps:
-            if re.match(path, environ_path):
-                if is_websocket_request == self._is_websocket_app(app):
-                    return app
-        return None
+        return self._tables[bool(is_websocket_request)].match(environ_path)
+
+    def resolve(self, environ, is_websocket_request=True):
+        """匹配application 结果保存在environ里, 握手和处理时只匹配一次
+        """
+        app = environ.get('wsgi.websocket_app')
+        if app is None:
+            route = self._tables[bool(is_websocket_request)].lookup(
+                environ['PATH_INFO'])
+            if route is None:
+                return None
+
+            pattern, app = route
+            if is_websocket_request:
+                environ['wsgi.websocket_app'] = app
+                environ['wsgi.websocket_route'] = pattern
+        return app
 
     def app_protocol(self, path):
         """子协议匹配如果设置了子协议 客户端进行匹配
@@ -95,9 +379,12 @@ class Resource(object):
     def __call__(self, environ, start_response):
         environ = environ
         is_websocket_call = 'wsgi.websocket' in environ
-        current_app = self._app_by_path(environ['PATH_INFO'], is_websocket_call)
+        current_app = self.resolve(environ, is_websocket_call)
 
         if current_app is None:
+            if not is_websocket_call:
+                start_response('404 Not Found', [('Content-Type', 'text/plain')])
+                return [b'Not Found']
             raise Exception("No apps defined")
 
         if is_websocket_call:
@@ -115,8 +402,15 @@ class WebSocketHandler(WSGIHandler):
     def __init__(self, *args, **kwargs):
         super(WebSocketHandler, self).__init__(*args, **kwargs)
 
-    SUPPORTED_VERSIONS = ('13', '8', '7')
-    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    SUPPORTED_VERSIONS = SUPPORTED_VERSIONS
+    GUID = GUID
+
+    HANDSHAKE_STATUS = HANDSHAKE_STATUS
+
+    # 握手之后不再使用的environ项, 连接期间不保留
+    HANDSHAKE_ENVIRON = ('wsgi.input', 'HTTP_UPGRADE', 'HTTP_CONNECTION',
+                         'HTTP_SEC_WEBSOCKET_KEY',
+                         'HTTP_SEC_WEBSOCKET_EXTENSIONS')
 
     def run_websocket(self):
         """
@@ -126,22 +420,54 @@ class WebSocketHandler(WSGIHandler):
         if getattr(self, 'prevent_wsgi_call', False):
             return
 
+        self._release_handshake()
+
         if not hasattr(self.server, 'clients'):
-            self.server.clients = {}
+            self.server.clients = ClientRegistry()
+
+        send_queue = getattr(self.server, 'send_queue', None)
+        if send_queue is not None:
+            self.websocket.start_send_queue(**send_queue)
+
+        coalesce = getattr(self.server, 'coalesce', None)
+        if coalesce is not None:
+            self.websocket.coalesce(**coalesce)
+
+        heartbeat = getattr(self.server, 'heartbeat', None)
+        client = Client(
+            self.client_address, self.websocket,
+            ClientRegistry.user_key(self.environ.get('wsgi.websocket_user')),
+            self.environ.get('wsgi.websocket_route'))
 
         try:
-            self.server.clients[self.client_address] = Client(
-                self.client_address, self.websocket)
+            self.server.clients[self.client_address] = client
+            if heartbeat is not None:
+                heartbeat.add(client)
             list(self.application(self.environ, lambda s, h, e=None: []))
         finally:
+            if heartbeat is not None:
+                heartbeat.remove(client)
+            # 同时从用户/路由/标签(订阅)索引里删除
             del self.server.clients[self.client_address]
             if not self.websocket.closed:
                 self.websocket.close()
+            # 等待发送队列里的数据(包括close帧)发完再关闭socket
+            if self.websocket.send_queue is not None:
+                self.websocket.send_queue.join()
             self.environ.update({
                 'wsgi.websocket': None
             })
             self.websocket = None
 
+    def _release_handshake(self):
+        """释放只在握手时使用的请求状态, 长连接不必一直持有
+        rfile 已经由 Stream 关闭, 解析后的请求头都在environ里
+        """
+        environ = self.environ
+        for key in self.HANDSHAKE_ENVIRON:
+            environ.pop(key, None)
+        self.headers = None
+
     def run_application(self):
         """wsgi 复用run_application 方法
         """
@@ -149,6 +475,11 @@ class WebSocketHandler(WSGIHandler):
         reqid = self.environ.get('X-Req-Id', '')
         logger.set_req_id(reqid)
         log.debug('X-Req-Id: %s', reqid)
+
+        # 普通http请求(没有Upgrade头)交给 Resource 里的wsgi应用, 比如 /metrics
+        if not self.environ.get('HTTP_UPGRADE'):
+            return super(WebSocketHandler, self).run_application()
+
         # 获取请求结果
         self.result = self.upgrade_websocket()
 
@@ -158,134 +489,130 @@ class WebSocketHandler(WSGIHandler):
 
             self.run_websocket()
         else:
-            self.result = ['No Websocket protocol defined']
             self.close_connection = True
+            if self.status and not self.headers_sent:
+                # 握手失败并且设置了状态码(400/401/426...), 把原因返回给客户端
+                body = (self.result or [''])[0]
+                if not isinstance(body, bytes):
+                    body = str(body).encode('utf-8')
+                self.result = [body]
+                self.process_result()
+            else:
+                self.result = ['No Websocket protocol defined']
 
     def upgrade_websocket(self):
         """判断请求头部信息是否正确 返回处理结果
         """
-        if self.environ.get('REQUEST_METHOD', '') != 'GET':
-            # websocket 必须是GET方法
-            log.info('Can only upgrade connection if using GET method.')
-            return
-
-        upgrade = self.environ.get('HTTP_UPGRADE', '').lower()
-
-        if upgrade == 'websocket':
-            connection = self.environ.get('HTTP_CONNECTION', '').lower()
-
-            if 'upgrade' not in connection:
-                # 值必须为upgrade
-                log.warning("Client didn't ask for a connection "
-                                    "upgrade")
-                return ['Websocket protocol Error']
-        else:
-            # 不是websocket 连接 不处理直接返回
-            return ['Websocket protocol Error']
-
-        # websocket 协议必须是http1.1
-        if self.request_version != 'HTTP/1.1':
-            self.start_response('402 Bad Request', [])
-            log.warning("Bad server protocol in headers")
-            return ['Bad protocol version']
-
-        if self.environ.get('HTTP_SEC_WEBSOCKET_VERSION'):
-            return self.upgrade_connection()
-        else:
-            log.warning("No protocol defined")
-            self.start_response('426 Upgrade Required', [
-                ('Sec-WebSocket-Version', ', '.join(self.SUPPORTED_VERSIONS))])
+        try:
+            check_request(self.environ, self.request_version)
+        except HandshakeError as e:
+            log.warning('Websocket handshake failed: %s', e)
+            self._handshake_failed(e.reason)
+            if e.status is not None:
+                self.start_response(e.status, list(e.headers))
+            return [e.message]
 
-            return ['No Websocket protocol version defined']
+        return self.upgrade_connection()
 
     def upgrade_connection(self):
         """
-        1. 判断支持websocket协议版本
-        2. 判断是否传入HTTP_SEC_WEBSOCKET_KEY值 记录着握手过程中必不可少的键值
-        3. Sec-WebSocket-Protocol: chat, superchat 协议支持
+        1. 匹配应用, Sec-WebSocket-Protocol: chat, superchat 协议支持
+        2. 鉴权和压缩扩展协商
+        3. 返回101
         """
 
-        log.info("Attempting to upgrade connection")
-
-        version = self.environ.get("HTTP_SEC_WEBSOCKET_VERSION")
-
-        if version not in self.SUPPORTED_VERSIONS:
-            msg = "Unsupported WebSocket Version: {0}".format(version)
-
-            log.warning(msg)
-            self.start_response('400 Bad Request', [
-                ('Sec-WebSocket-Version', ', '.join(self.SUPPORTED_VERSIONS))
-            ])
-
-            return [msg]
-
-        key = self.environ.get("HTTP_SEC_WEBSOCKET_KEY", '').strip()
-
-        if not key:
-            # 5.2.1 (3)
-            msg = "Sec-WebSocket-Key header is missing/empty"
-
-            log.warning(msg)
-            self.start_response('400 Bad Request', [])
-
-            return [msg]
-
-        try:
-            key_len = len(base64.b64decode(key))
-        except TypeError:
-            msg = "Invalid key: {0}".format(key)
-
-            log.warning(msg)
-            self.start_response('400 Bad Request', [])
-
-            return [msg]
+        log.debug("Attempting to upgrade connection")
 
-        if key_len != 16:
-            msg = "Invalid key: {0}".format(key)
-
-            log.warning(msg)
-            self.start_response('400 Bad Request', [])
-
-            return [msg]
+        version = self.environ["HTTP_SEC_WEBSOCKET_VERSION"]
+        key = self.environ["HTTP_SEC_WEBSOCKET_KEY"].strip()
 
         # Check for WebSocket Protocols
-        requested_protocols = self.environ.get(
-            'HTTP_SEC_WEBSOCKET_PROTOCOL', '')
+        requested = requested_protocols(self.environ)
         protocol = None
+        app = None
+
+        if hasattr(self.application, 'resolve'):
+            # 匹配结果保存在environ里, 处理请求时不再重新匹配
+            app = self.application.resolve(self.environ)
+
+            if requested and hasattr(app, 'select_protocol'):
+                protocol = app.select_protocol(requested)
+                if protocol:
+                    log.debug("Protocol allowed: %s", protocol)
 
-        if hasattr(self.application, 'app_protocol'):
+        elif hasattr(self.application, 'app_protocol'):
             allowed_protocol = self.application.app_protocol(
                 self.environ['PATH_INFO'])
 
-            if allowed_protocol and allowed_protocol in requested_protocols:
+            if allowed_protocol and allowed_protocol in requested:
                 protocol = allowed_protocol
-                log.info("Protocol allowed: {0}".format(protocol))
+                log.debug("Protocol allowed: %s", protocol)
 
-        self.websocket = WebSocket(self.environ, Stream(self), self)
+        # 鉴权在101之前, 失败时不建立连接
+        authenticator = getattr(self.server, 'authenticator', None)
+        if authenticator is not None:
+            try:
+                user = authenticator.authenticate(self.environ)
+            except AuthUnavailable:
+                self._handshake_failed('auth_unavailable')
+                self.start_response('503 Service Unavailable', [])
+                return ['Authentication unavailable']
+
+            if user is None and getattr(app, 'AUTH_REQUIRED', True):
+                log.debug('Unauthorized websocket request: %s',
+                          self.environ.get('PATH_INFO'))
+                self._handshake_failed('unauthorized')
+                self.start_response('401 Unauthorized', [])
+                return ['Unauthorized']
+            self.environ['wsgi.websocket_user'] = user
+
+        # 压缩扩展协商
+        deflate = None
+        extension = None
+        compression = getattr(self.server, 'compression', None)
+        requested_extensions = self.environ.get(
+            'HTTP_SEC_WEBSOCKET_EXTENSIONS', '')
+
+        if compression is not None and requested_extensions:
+            result = compression.negotiate(requested_extensions)
+            if result is not None:
+                extension, deflate = result
+                log.debug("Extension accepted: %s", extension)
+
+        self.websocket = WebSocket(
+            self.environ, Stream(self), self, deflate,
+            max_frame_size=getattr(self.server, 'max_frame_size', None),
+            max_message_size=getattr(self.server, 'max_message_size', None),
+            metrics=getattr(self.server, 'metrics', None))
         self.environ.update({
             'wsgi.websocket_version': version,
+            'wsgi.websocket_protocol': protocol,
             'wsgi.websocket': self.websocket
         })
 
-        accept = base64.b64encode(
-            hashlib.sha1((key + self.GUID).encode("latin-1")).digest()
-        ).decode("latin-1")
+        log.debug("WebSocket request accepted, switching protocols")
+        self._send_handshake(
+            key, self.environ.get('HTTP_ORIGIN', ''), protocol, extension)
 
-        # 默认支持跨域
-        http_origin = self.environ.get('HTTP_ORIGIN', '')
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is not None:
+            metrics.handshakes.inc()
 
-        headers = [
-            ("Upgrade", "websocket"),
-            ("Connection", "Upgrade"),
-            ("Sec-WebSocket-Accept", accept),
-            ("Access-Control-Allow-Origin", http_origin),
-        ]
+    def _send_handshake(self, key, origin, protocol, extension):
+        """101 响应一次写出, 不经过 start_response 和gevent的头部处理
+        """
+        response = handshake_response(key, origin, protocol, extension)
 
-        if protocol:
-            headers.append(("Sec-WebSocket-Protocol", protocol))
+        self._prepare_response()
+        self.status = self.HANDSHAKE_STATUS
+        self.response_headers = []
+        self.headers_sent = True
+        self.socket.sendall(response)
 
-        log.info("WebSocket request accepted, switching protocols")
-        self.start_response("101 Switching Protocols", headers)
+    def _handshake_failed(self, reason):
+        metrics = getattr(self.server, 'metrics', None)
+        if metrics is not None:
+            metrics.handshake_failed(reason)
 
     def log_request(self):
         if '101' not in str(self.status):
@@ -332,15 +659,290 @@ class WebSocketHandler(WSGIHandler):
 class WebSocketServer(WSGIServer):
     handler_class = WebSocketHandler
 
+    # 广播时同时发送的greenlet数, 慢连接只占用其中一个
+    FANOUT_CONCURRENCY = 1000
+    # 单个连接的广播发送超时(秒), 超时认为对端卡死并断开, 避免卡住的连接
+    # 一直占着发送的并发数
+    FANOUT_TIMEOUT = 10
+
     def __init__(self, *args, **kwargs):
-        self.clients = {}
+        # address -> Client, 带用户/路由/标签索引, 订阅的topic保存为标签
+        self.clients = ClientRegistry()
+        # 广播发送的greenlet, 总数不超过 FANOUT_CONCURRENCY
+        self.fanout_group = Group()
+        self.fanout_slots = BoundedSemaphore(self.FANOUT_CONCURRENCY)
+        # 并发数占满时还没发出的 (连接列表, 帧), 由 _fanout_runner 按顺序发送
+        self.fanout_backlog = deque()
+        self._fanout_runner = None
+
+        # 跨进程/跨节点的消息总线(backplane.Backplane), 多进程模式下默认由
+        # multiproc 设置为本机总线
+        self.backplane = kwargs.pop('backplane', None)
+
+        # permessage-deflate 压缩: None 不启用, True 默认参数, dict 自定义参数
+        compression = kwargs.pop('compression', None)
+        if compression is True:
+            compression = PerMessageDeflateFactory()
+        elif isinstance(compression, dict):
+            compression = PerMessageDeflateFactory(**compression)
+        self.compression = compression or None
+
+        # 单帧/单条消息大小限制(字节), None 不限制
+        self.max_frame_size = kwargs.pop('max_frame_size', None)
+        self.max_message_size = kwargs.pop('max_message_size', None)
+
+        # 发送队列: None 直接在调用者greenlet里写socket, True 默认参数,
+        # dict 为 SendQueue 参数
+        send_queue = kwargs.pop('send_queue', None)
+        if send_queue is True:
+            send_queue = {}
+        self.send_queue = send_queue
+
+        # 丢弃策略丢掉的是已经压缩好的帧, 压缩上下文接管时客户端的解压窗口会错乱,
+        # 之后的消息都解不开, 所以改为每条消息独立压缩
+        if self.compression is not None and self.send_queue is not None and \
+                self.send_queue.get('policy') in (DROP_OLDEST, DROP_NEWEST) and \
+                not self.compression.server_no_context_takeover:
+            log.info('send queue policy %s drops compressed frames, '
+                     'use server_no_context_takeover',
+                     self.send_queue['policy'])
+            self.compression = copy.copy(self.compression)
+            self.compression.server_no_context_takeover = True
+
+        # 合并写: None 不启用, True 默认参数, dict 为 Coalescer 参数
+        # 启用后发送的帧最多延迟 max_delay 秒, 攒在一起写出
+        coalesce = kwargs.pop('coalesce', None)
+        if coalesce is True:
+            coalesce = {}
+        self.coalesce = coalesce
+
+        # 指标: None 不收集, True 使用默认registry, 也可以传入 metrics.Registry
+        metrics = kwargs.pop('metrics', None)
+        if metrics is True:
+            metrics = WebSocketMetrics(self)
+        elif metrics:
+            metrics = WebSocketMetrics(self, metrics)
+        self.metrics = metrics or None
+
+        # 消息访问日志: None 只在debug级别记录, True 默认参数, dict 为 AccessLog 参数
+        access_log = kwargs.pop('access_log', None)
+        if access_log is True:
+            access_log = AccessLog()
+        elif isinstance(access_log, dict):
+            access_log = AccessLog(**access_log)
+        self.access_log = access_log or None
+
+        # 心跳: None 不启用, True 默认参数, dict 为 Heartbeat 参数
+        heartbeat = kwargs.pop('heartbeat', None)
+        if heartbeat is True:
+            heartbeat = Heartbeat()
+        elif isinstance(heartbeat, dict):
+            heartbeat = Heartbeat(**heartbeat)
+        self.heartbeat = heartbeat or None
+
+        # 握手鉴权: None 不鉴权, dict 为 webconfig.SESSION 格式的配置,
+        # 也可以传入 auth.Authenticator
+        auth = kwargs.pop('auth', None)
+        if isinstance(auth, dict):
+            auth = SessionAuthenticator.from_config(auth)
+        self.authenticator = auth
+
+        # 优雅下线: None 不启用, True 默认参数, dict 为 Drainer 参数
+        # 启用后 serve_forever 收到 SIGTERM 时开始drain
+        self.drainer = Drainer.create(kwargs.pop('drain', None))
 
         super(WebSocketServer, self).__init__(*args, **kwargs)
 
+        if self.backplane is not None:
+            self.backplane.attach(self)
+
+    def client_of(self, ws):
+        client = self.clients.get(ws.handler.client_address)
+        if client is None or client.ws is not ws:
+            return None
+        return client
+
+    def subscribe(self, topic, ws):
+        """连接订阅topic(房间) 连接断开时自动取消
+        """
+        client = self.client_of(ws)
+        if client is None:
+            log.warning('subscribe %s: websocket not registered', topic)
+            return False
+        self.clients.tag(client, topic)
+        return True
+
+    def unsubscribe(self, topic, ws):
+        client = self.client_of(ws)
+        if client is not None:
+            self.clients.untag(client, topic)
+
+    def unsubscribe_all(self, ws):
+        client = self.client_of(ws)
+        if client is not None and client.tags:
+            self.clients.untag(client, *list(client.tags))
+
+    def publish(self, topic, message, binary=None):
+        """向topic的所有订阅者发送消息, 返回本进程内的订阅者数量
+        配置了backplane时同时转发给其他进程/节点
+        """
+        count = self.publish_local(topic, message, binary)
+        if self.backplane is not None:
+            self.backplane.publish(topic, message, binary)
+        return count
+
+    def broadcast(self, message, binary=None):
+        """向所有连接发送消息
+        """
+        count = self.broadcast_local(message, binary)
+        if self.backplane is not None:
+            self.backplane.broadcast(message, binary)
+        return count
+
+    def send_to_user(self, user, message, binary=None):
+        """向用户的所有连接发送消息, 返回本进程内的连接数
+        """
+        count = self.send_user_local(user, message, binary)
+        if self.backplane is not None:
+            self.backplane.send_user(user, message, binary)
+        return count
+
+    def send_to(self, address, message, binary=None):
+        """向指定地址的连接发送消息, 连接在本进程返回True
+        不在本进程时经backplane转发
+        """
+        if self.send_local(address, message, binary):
+            return True
+        if self.backplane is not None:
+            self.backplane.send(address, message, binary)
+        return False
+
+    def publish_local(self, topic, message, binary=None):
+        """帧只编码一次, 并发发送, 不等待发送完成, 调用者不会阻塞
+        """
+        subscribers = self.clients.by_tag(topic)
+        if not subscribers:
+            return 0
+
+        return self._fanout([client.ws for client in subscribers],
+                            message, binary)
+
+    def broadcast_local(self, message, binary=None):
+        return self._fanout(
+            [client.ws for client in list(self.clients.values())],
+            message, binary)
+
+    def send_user_local(self, user, message, binary=None):
+        clients = self.clients.by_user(user)
+        if not clients:
+            return 0
+        return self._fanout([client.ws for client in clients], message, binary)
+
+    def send_local(self, address, message, binary=None):
+        client = self.clients.get(address)
+        if client is None:
+            return False
+        return self._fanout([client.ws], message, binary) > 0
+
+    def _fanout(self, sockets, message, binary):
+        frame = WebSocket.encode_frame(message, binary)
+        count = len(sockets)
+
+        # 没有积压时直接发送; 并发数占满后剩下的连接排队, 由后台greenlet等待
+        # 空闲的并发数, 发布者不阻塞. 有积压时新的广播也排队, 保持消息顺序
+        start = 0
+        if not self.fanout_backlog:
+            acquire = self.fanout_slots.acquire
+            spawn = self.fanout_group.spawn
+            while start < count and acquire(blocking=False):
+                spawn(self._send_raw, sockets[start], frame)
+                start += 1
+
+        if start < count:
+            self.fanout_backlog.append((sockets[start:], frame))
+            if self._fanout_runner is None:
+                self._fanout_runner = gevent.spawn(self._run_fanout_backlog)
+        return count
+
+    def _run_fanout_backlog(self):
+        backlog = self.fanout_backlog
+        acquire = self.fanout_slots.acquire
+        spawn = self.fanout_group.spawn
+        try:
+            while backlog:
+                sockets, frame = backlog[0]
+                for ws in sockets:
+                    acquire()
+                    spawn(self._send_raw, ws, frame)
+                backlog.popleft()
+        finally:
+            self._fanout_runner = None
+
+    def _send_raw(self, ws, frame):
+        timeout = Timeout(self.FANOUT_TIMEOUT)
+        timeout.start()
+        try:
+            ws.send_raw(frame)
+        except WebSocketError:
+            # 连接已经断开 由run_websocket负责清理
+            pass
+        except Timeout as e:
+            if e is not timeout:
+                raise
+            # 帧可能只写出了一部分, 连接已经不能再用
+            log.warning('fanout to %s timeout after %ss, abort connection',
+                        ws.handler.client_address, self.FANOUT_TIMEOUT)
+            stream = ws.stream
+            if stream is not None:
+                stream.shutdown()
+        finally:
+            timeout.close()
+            self.fanout_slots.release()
+
     def handle(self, socket, address):
         handler = self.handler_class(socket, address, self)
         handler.handle()
     
     def serve_forever(self):
         log.info('%s server started at:%d', self.address[0], self.address[1])
+        if self.drainer is not None:
+            for sig in self.drainer.signals:
+                gevent.signal_handler(sig, self.drain)
         super().serve_forever()
+
+    def drain(self, **options):
+        """停止接受新连接, 在 window 秒内分散关闭已有连接, 结束后关闭server
+        options 覆盖 Drainer 参数, 返回drain的greenlet
+        """
+        drainer = self.drainer
+        if drainer is None:
+            drainer = self.drainer = Drainer(**options)
+        elif not drainer.draining:
+            for name, value in options.items():
+                if not hasattr(drainer, name):
+                    raise TypeError('unknown drain option: {0}'.format(name))
+                setattr(drainer, name, value)
+
+        if not drainer.draining:
+            # 关闭监听socket, 新连接由其他进程/节点接受
+            self.stop_accepting()
+            try:
+                self.socket.close()
+            except Exception:
+                pass
+        return drainer.start(self)
+
+    def start_accepting(self):
+        # pool 有空位时会重新开始accept, drain 期间不再接受
+        if self.drainer is not None and self.drainer.draining:
+            return
+        super(WebSocketServer, self).start_accepting()
+
+    def stop(self, timeout=None):
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+        if self.backplane is not None:
+            self.backplane.close()
+        if self.access_log is not None:
+            self.access_log.close()
+        super(WebSocketServer, self).stop(timeout)
@@ -0,0 +1,232 @@
+"""
+permessage-deflate 压缩扩展 (RFC 7692)
+~~~~~~~~~~
+握手时客户端通过 Sec-WebSocket-Extensions 提出压缩参数, 服务端选择
+第一个可以接受的方案返回; 之后数据帧首帧设置RSV1(Header.RSV0_MASK)
+表示整条消息经过压缩
+
+"""
+
+import zlib
+
+from .exceptions import ProtocolError
+from .exceptions import FrameTooLargeException
+
+EXTENSION_NAME = 'permessage-deflate'
+
+# 每条压缩消息末尾的4个字节, 发送时去掉, 接收时补上
+EMPTY_BLOCK = b'\x00\x00\xff\xff'
+
+
+def parse_extensions(value):
+    """解析 Sec-WebSocket-Extensions 头部
+    返回 [(name, [(key, value), ...]), ...] 参数没有值时value为None
+    """
+    result = []
+    for item in value.split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if not parts[0]:
+            continue
+
+        params = []
+        for part in parts[1:]:
+            if not part:
+                continue
+            key, sep, val = part.partition('=')
+            val = val.strip().strip('"') if sep else None
+            params.append((key.strip().lower(), val))
+
+        result.append((parts[0].lower(), params))
+    return result
+
+
+def _window_bits(value):
+    """窗口参数必须是 8~15 的十进制数字
+    """
+    if value is None or not value.isdigit() or value.startswith('0'):
+        return None
+
+    bits = int(value)
+    if 8 <= bits <= 15:
+        return bits
+    return None
+
+
+class PerMessageDeflateFactory(object):
+    """服务端压缩配置, 负责握手协商
+
+    server_no_context_takeover: 服务端每条消息使用新的压缩上下文, 省内存但压缩率低
+    client_no_context_takeover: 要求客户端每条消息使用新的压缩上下文
+    server_max_window_bits: 服务端压缩窗口(9~15), zlib不支持8位窗口的raw deflate压缩
+    client_max_window_bits: 要求客户端压缩窗口(8~15), 客户端声明支持时才生效
+    min_size: 小于这个长度的消息不压缩
+    level/mem_level: zlib 压缩等级和内存等级
+    """
+
+    def __init__(self, server_no_context_takeover=False,
+                 client_no_context_takeover=False, server_max_window_bits=15,
+                 client_max_window_bits=15, min_size=128, level=6, mem_level=8):
+        if not 9 <= server_max_window_bits <= 15:
+            raise ValueError('server_max_window_bits must be in 9~15')
+
+        if not 8 <= client_max_window_bits <= 15:
+            raise ValueError('client_max_window_bits must be in 8~15')
+
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.min_size = min_size
+        self.level = level
+        self.mem_level = mem_level
+
+    def negotiate(self, header_value):
+        """按顺序选择第一个可接受的压缩方案
+        返回 (响应头部值, PerMessageDeflate) 都不接受返回None
+        """
+        for name, params in parse_extensions(header_value):
+            if name != EXTENSION_NAME:
+                continue
+
+            result = self._accept(params)
+            if result is not None:
+                return result
+
+        return None
+
+    def _accept(self, params):
+        server_no_context_takeover = self.server_no_context_takeover
+        client_no_context_takeover = self.client_no_context_takeover
+        server_bits = self.server_max_window_bits
+        client_bits = 15
+        client_bits_offered = False
+
+        seen = set()
+        for key, value in params:
+            # 同一个参数出现两次 该方案无效
+            if key in seen:
+                return None
+            seen.add(key)
+
+            if key == 'server_no_context_takeover':
+                if value is not None:
+                    return None
+                server_no_context_takeover = True
+
+            elif key == 'client_no_context_takeover':
+                if value is not None:
+                    return None
+                client_no_context_takeover = True
+
+            elif key == 'server_max_window_bits':
+                bits = _window_bits(value)
+                if bits is None or bits < 9:
+                    return None
+                server_bits = min(server_bits, bits)
+
+            elif key == 'client_max_window_bits':
+                if value is not None:
+                    bits = _window_bits(value)
+                    if bits is None:
+                        return None
+                    client_bits = bits
+                client_bits_offered = True
+
+            else:
+                return None
+
+        # 客户端声明支持时才能限制客户端窗口
+        if client_bits_offered:
+            client_bits = min(client_bits, self.client_max_window_bits)
+
+        response = [EXTENSION_NAME]
+        if server_no_context_takeover:
+            response.append('server_no_context_takeover')
+        if client_no_context_takeover:
+            response.append('client_no_context_takeover')
+        if 'server_max_window_bits' in seen or server_bits < 15:
+            response.append('server_max_window_bits=%d' % server_bits)
+        if client_bits_offered and client_bits < 15:
+            response.append('client_max_window_bits=%d' % client_bits)
+
+        deflate = PerMessageDeflate(
+            server_no_context_takeover, client_no_context_takeover,
+            server_bits, client_bits, self.min_size, self.level, self.mem_level)
+
+        return '; '.join(response), deflate
+
+
+class PerMessageDeflate(object):
+    """单个连接的压缩/解压上下文
+    """
+    __slots__ = ('server_no_context_takeover', 'client_no_context_takeover',
+                 'server_max_window_bits', 'client_max_window_bits',
+                 'min_size', 'level', 'mem_level', '_compressor', '_decompressor')
+
+    def __init__(self, server_no_context_takeover, client_no_context_takeover,
+                 server_max_window_bits, client_max_window_bits,
+                 min_size, level, mem_level):
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.min_size = min_size
+        self.level = level
+        self.mem_level = mem_level
+
+        # 压缩上下文第一次使用时才创建
+        self._compressor = None
+        self._decompressor = None
+
+    def should_compress(self, length):
+        return length >= self.min_size
+
+    def compress(self, data):
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, -self.server_max_window_bits,
+                self.mem_level)
+            if not self.server_no_context_takeover:
+                self._compressor = compressor
+
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(EMPTY_BLOCK):
+            data = data[:-4]
+        return data
+
+    def decompressor(self):
+        """当前消息使用的解压对象, 流式解压时逐块调用 decompress
+        消息结束时需要再解压一次 EMPTY_BLOCK
+        """
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-self.client_max_window_bits)
+            if not self.client_no_context_takeover:
+                self._decompressor = decompressor
+        return decompressor
+
+    def decompress(self, data, max_size=None):
+        """解压整条消息, 解压后超过 max_size 抛出 FrameTooLargeException
+        """
+        decompressor = self.decompressor()
+
+        try:
+            if max_size is None:
+                return (decompressor.decompress(data) +
+                        decompressor.decompress(EMPTY_BLOCK))
+
+            # 多解压一个字节用来判断是否超过限制, 避免压缩炸弹占满内存
+            allowed = max_size + 1
+            result = decompressor.decompress(data, allowed)
+            if len(result) <= max_size and not decompressor.unconsumed_tail:
+                result += decompressor.decompress(
+                    EMPTY_BLOCK, allowed - len(result))
+        except zlib.error as e:
+            raise ProtocolError('Invalid compressed message: {0}'.format(e))
+
+        if len(result) > max_size or decompressor.unconsumed_tail:
+            raise FrameTooLargeException(
+                'Message exceeds max_message_size {0}'.format(max_size))
+
+        return result
@@ -0,0 +1,241 @@
+"""
+优雅下线
+~~~~~~~~~~
+滚动发布时如果同时断开所有连接, 客户端会在同一时刻重连, 压垮剩下的节点.
+drain 先停止接受新连接(监听socket关闭后, SO_REUSEPORT 的其他worker/节点
+继续接受), 再把已有连接打乱后在 window 秒内分散关闭:
+
+1. 连接i在 [i, i+1) * window/N 之间随机一个时刻发送close帧(默认1012),
+   关闭速率均匀, 客户端的重连也分散在 window 秒内
+2. 正在处理消息(Client.inflight > 0)的连接推迟到处理完再关闭,
+   最多推迟到 window + grace 秒
+3. close帧发出 close_timeout 秒之后对端还没有断开的直接断开socket
+4. 所有连接清理完后关闭server, serve_forever 返回
+
+    server = WebSocketServer(listener, app, drain={'window': 60})
+    server.serve_forever()      # 收到 SIGTERM 开始drain
+
+也可以直接调用 server.drain(), 进度见 server.drainer.progress()
+
+"""
+
+import time
+import random
+import signal
+import logging
+
+import gevent
+
+from gevent.pool import Pool
+
+from .exceptions import WebSocketError
+
+log = logging.getLogger()
+
+
+class Drainer(object):
+
+    def __init__(self, window=30, close_code=1012, reason='service restart',
+                 grace=10, close_timeout=5, report_interval=5, tick=0.1,
+                 concurrency=1000, signals=(signal.SIGTERM,),
+                 on_progress=None):
+        """
+        window: 在多少秒内关闭完所有连接
+        close_code: close帧的状态码, 1012 服务重启, 1001 服务下线
+        grace: 忙碌的连接最多再推迟多少秒关闭
+        close_timeout: 发出close帧后等待对端断开的秒数
+        report_interval: 每隔多少秒记录一次进度
+        tick: 调度精度(秒)
+        concurrency: 同时发送close帧的greenlet数
+        signals: 收到这些信号时开始drain
+        on_progress: 进度回调, 参数为 progress() 的返回值
+        """
+        self.window = window
+        self.close_code = close_code
+        self.reason = reason
+        self.grace = grace
+        self.close_timeout = close_timeout
+        self.report_interval = report_interval
+        self.tick = tick
+        self.signals = signals
+        self.on_progress = on_progress
+
+        # 发送close帧可能阻塞在慢连接上, 不能在调度greenlet里做
+        self.pool = Pool(concurrency)
+        self.server = None
+        self.state = 'idle'
+        self.total = 0
+        self.closed = 0
+        self.deferred = []
+        self.started = None
+        self._streams = {}
+        self._runner = None
+        self._reported = 0
+
+    @classmethod
+    def create(cls, value):
+        """server参数转换: None 不启用, True 默认参数, dict 为 Drainer 参数
+        """
+        if value is True:
+            return cls()
+        if isinstance(value, dict):
+            return cls(**value)
+        return value or None
+
+    @property
+    def duration(self):
+        """drain最长需要的时间(秒)
+        """
+        return self.window + self.grace + self.close_timeout
+
+    @property
+    def draining(self):
+        return self._runner is not None
+
+    def start(self, server):
+        """开始drain, 重复调用返回同一个greenlet
+        """
+        if self._runner is None:
+            self.server = server
+            self._runner = gevent.spawn(self._run)
+        return self._runner
+
+    def progress(self):
+        clients = getattr(self.server, 'clients', None) or {}
+        return {
+            'state': self.state,
+            'total': self.total,
+            'closed': self.closed,
+            'remaining': len(clients),
+            'deferred': len(self.deferred),
+            'inflight': sum(client.inflight for client in clients.values()),
+            'elapsed': time.monotonic() - self.started
+            if self.started is not None else 0,
+        }
+
+    def _run(self):
+        server = self.server
+        self.started = time.monotonic()
+        self.state = 'draining'
+
+        clients = list(getattr(server, 'clients', {}).values())
+        random.shuffle(clients)
+        self.total = len(clients)
+        log.info('drain %d connections in %ss, close code %d', self.total,
+                 self.window, self.close_code)
+
+        try:
+            self._spread(clients)
+            self._settle()
+        except Exception:
+            log.exception('drain failed')
+        finally:
+            self.state = 'done'
+            self._report(force=True)
+            server.close()
+
+    def _spread(self, clients):
+        # 分层抖动: 每个连接在自己的时间片内随机一个时刻关闭
+        step = float(self.window) / max(1, len(clients))
+        for i, client in enumerate(clients):
+            delay = self.started + step * (i + random.random()) - \
+                time.monotonic()
+            if delay > self.tick:
+                gevent.sleep(delay)
+                self._retry_deferred()
+                self._report()
+
+            if client.inflight:
+                self.deferred.append(client)
+            else:
+                self._close(client)
+
+        delay = self.started + self.window - time.monotonic()
+        if delay > 0:
+            gevent.sleep(delay)
+
+    def _settle(self):
+        server = self.server
+        self.state = 'closing'
+
+        # 快照之后才完成握手的连接, 以及推迟的忙碌连接
+        deadline = time.monotonic() + self.grace
+        while True:
+            for client in list(server.clients.values()):
+                if client not in self._streams and client not in self.deferred:
+                    self.deferred.append(client)
+            if time.monotonic() >= deadline:
+                break
+            self._retry_deferred()
+            if not self.deferred:
+                break
+            gevent.sleep(self.tick)
+            self._report()
+
+        if self.deferred:
+            log.warning('drain: %d connections still busy after %ss, close',
+                        len(self.deferred), self.grace)
+            deferred, self.deferred = self.deferred, []
+            for client in deferred:
+                self._close(client)
+        self.pool.join()
+
+        # 等待对端回复close帧后断开
+        deadline = time.monotonic() + self.close_timeout
+        while server.clients and time.monotonic() < deadline:
+            gevent.sleep(self.tick)
+            self._report()
+
+        if server.clients:
+            log.warning('drain: %d connections did not close in %ss, '
+                        'shutdown', len(server.clients), self.close_timeout)
+            for client in list(server.clients.values()):
+                stream = self._streams.get(client)
+                if stream is not None:
+                    stream.shutdown()
+
+            # 读greenlet收到EOF后由 run_websocket 清理
+            deadline = time.monotonic() + 1
+            while server.clients and time.monotonic() < deadline:
+                gevent.sleep(self.tick)
+
+    def _retry_deferred(self):
+        if not self.deferred:
+            return
+        busy = []
+        for client in self.deferred:
+            if client.inflight:
+                busy.append(client)
+            else:
+                self._close(client)
+        self.deferred = busy
+
+    def _close(self, client):
+        ws = client.ws
+        if client in self._streams or ws is None or ws.closed:
+            return
+        self._streams[client] = ws.stream
+        self.closed += 1
+        self.pool.spawn(self._send_close, ws)
+
+    def _send_close(self, ws):
+        try:
+            ws.close(self.close_code, self.reason)
+        except WebSocketError:
+            pass
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._reported < self.report_interval:
+            return
+        self._reported = now
+
+        progress = self.progress()
+        log.info('drain %(state)s: closed %(closed)d/%(total)d, '
+                 'remaining %(remaining)d, deferred %(deferred)d, '
+                 'inflight %(inflight)d, elapsed %(elapsed).1fs', progress)
+        if self.on_progress is not None:
+            try:
+                self.on_progress(progress)
+            except Exception:
+                log.exception('drain progress callback failed')
@@ -17,3 +17,38 @@ class FrameTooLargeException(ProtocolError):
     """
     Raised if a frame is received that is too large.
     """
+
+
+class SendQueueFull(WebSocketError):
+    """
+    Raised if the outbound queue stays full longer than the block timeout.
+    """
+
+
+class RpcError(Exception):
+    """
+    Raised if a backend rpc call fails, code is returned to the client.
+    """
+
+    def __init__(self, message, code=500):
+        super(RpcError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class RpcTimeout(RpcError):
+    """
+    Raised if a backend does not answer within the configured timeout.
+    """
+
+    def __init__(self, message, code=504):
+        super(RpcTimeout, self).__init__(message, code)
+
+
+class RpcUnavailable(RpcError):
+    """
+    Raised if no backend address accepts the request or the connection is lost.
+    """
+
+    def __init__(self, message, code=503):
+        super(RpcUnavailable, self).__init__(message, code)
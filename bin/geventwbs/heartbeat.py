@@ -0,0 +1,145 @@
+"""
+心跳
+~~~~~~~~~~
+整个server只用一个时间轮greenlet调度所有连接的ping, 而不是每个连接一个定时器.
+时间轮每 tick 秒前进一格, 连接放在 interval 秒之后的格子里:
+
+1. 连续 max_missed 次ping没有收到pong, 认为连接已经断开
+2. 超过 idle_timeout 秒没有收到数据帧, 认为连接空闲
+两种情况都会用 close_code 关闭连接并断开socket, 由 run_websocket 清理
+
+pong 的往返时间记录在 Client.rtt
+
+"""
+
+import time
+import struct
+import logging
+
+import gevent
+
+from gevent.pool import Group
+
+from .exceptions import WebSocketError
+
+log = logging.getLogger()
+
+_PING = struct.Struct('!d')
+
+
+class Heartbeat(object):
+
+    def __init__(self, interval=30, max_missed=2, idle_timeout=None, tick=1,
+                 close_code=1001, close_timeout=1):
+        """
+        interval: ping间隔(秒)
+        max_missed: 连续多少次没有收到pong断开连接
+        idle_timeout: 多少秒没有收到数据帧断开连接, None 不检查
+        tick: 时间轮精度(秒)
+        close_timeout: 开启发送队列时最多等待多少秒让close帧写出
+        """
+        self.interval = interval
+        self.max_missed = max_missed
+        self.idle_timeout = idle_timeout
+        self.tick = tick
+        self.close_code = close_code
+        self.close_timeout = close_timeout
+
+        self.wheel = [set() for _ in range(max(1, int(round(interval / tick))))]
+        self.cursor = 0
+
+        # ping/断开连接可能阻塞在socket上, 不能在时间轮greenlet里做
+        self.group = Group()
+        self._runner = None
+
+    def _schedule(self, client):
+        # 当前格子刚处理完, 放到转一圈之后的位置
+        slot = (self.cursor + len(self.wheel)) % len(self.wheel)
+        client.slot = slot
+        self.wheel[slot].add(client)
+
+    def add(self, client):
+        if self._runner is None:
+            self.start()
+
+        client.missed = 0
+        client.ping_payload = None
+        self._schedule(client)
+
+    def remove(self, client):
+        slot = getattr(client, 'slot', None)
+        if slot is not None:
+            self.wheel[slot].discard(client)
+            client.slot = None
+
+    def start(self):
+        if self._runner is None:
+            self._runner = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._runner is not None:
+            self._runner.kill()
+            self._runner = None
+        self.group.kill()
+
+    def _run(self):
+        size = len(self.wheel)
+        while True:
+            gevent.sleep(self.tick)
+            self.cursor = (self.cursor + 1) % size
+
+            slot = self.wheel[self.cursor]
+            if not slot:
+                continue
+            self.wheel[self.cursor] = set()
+
+            now = time.monotonic()
+            for client in slot:
+                client.slot = None
+                self._check(client, now)
+
+    def _check(self, client, now):
+        ws = client.ws
+        if ws is None or ws.closed:
+            return
+
+        if client.missed >= self.max_missed:
+            log.info('%s missed %d pongs, reap', client.address, client.missed)
+            self.group.spawn(self._reap, ws)
+            return
+
+        if self.idle_timeout is not None and \
+                now - ws.last_active > self.idle_timeout:
+            log.info('%s idle for %ss, reap', client.address, self.idle_timeout)
+            self.group.spawn(self._reap, ws)
+            return
+
+        client.missed += 1
+        client.ping_payload = _PING.pack(now)
+        self.group.spawn(self._ping, ws, client.ping_payload)
+        self._schedule(client)
+
+    def _ping(self, ws, payload):
+        try:
+            ws.send_frame(payload, ws.OPCODE_PING)
+        except WebSocketError:
+            pass
+
+    def _reap(self, ws):
+        stream = ws.stream
+        send_queue = ws.send_queue
+        try:
+            ws.close(self.close_code)
+            # close帧只是入队, 等writer写出后再断开
+            if send_queue is not None:
+                send_queue.join(self.close_timeout)
+        finally:
+            # 对端已经没有响应, 直接断开让读greenlet退出
+            if stream is not None:
+                stream.shutdown()
+
+    def on_pong(self, client, payload):
+        client.missed = 0
+        if client.ping_payload is not None and payload == client.ping_payload:
+            client.rtt = time.monotonic() - _PING.unpack(payload)[0]
+            client.ping_payload = None
@@ -0,0 +1,89 @@
+"""
+websocket 掩码处理
+~~~~~~~~~~
+客户端发送的每一帧都带有4字节掩码, 逐字节异或在python里非常慢,
+这里把整个payload当成一个大整数按字(word)异或, 安装了numpy时
+大payload走numpy的uint64向量化路径
+
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 小于这个长度numpy的调用开销比整数异或还大
+NUMPY_THRESHOLD = 4096
+
+# 纯python路径的分块大小, 必须是4的倍数
+MASK_CHUNK = 64 * 1024
+
+
+def _mask_int(mask, data):
+    """纯python实现: 掩码扩展到payload长度后做一次大整数异或
+    超过MASK_CHUNK的payload分块处理, 整块共用同一个掩码整数
+    """
+    length = len(data)
+    from_bytes = int.from_bytes
+
+    if length <= MASK_CHUNK:
+        count, rest = divmod(length, 4)
+        key = from_bytes(mask * count + mask[:rest], 'little')
+        return (from_bytes(data, 'little') ^ key).to_bytes(length, 'little')
+
+    view = memoryview(data)
+    key = from_bytes(mask * (MASK_CHUNK >> 2), 'little')
+    rest = length % MASK_CHUNK
+    chunks = []
+
+    for start in range(0, length - rest, MASK_CHUNK):
+        value = from_bytes(view[start:start + MASK_CHUNK], 'little') ^ key
+        chunks.append(value.to_bytes(MASK_CHUNK, 'little'))
+
+    if rest:
+        # MASK_CHUNK是4的倍数, 尾部的掩码相位不变
+        chunks.append(_mask_int(mask, view[length - rest:]))
+
+    return b''.join(chunks)
+
+
+def _mask_numpy(mask, data):
+    """numpy实现: 按8字节一组异或, 剩余不足8字节的尾部单独处理
+    """
+    length = len(data)
+    words = length >> 3
+
+    src = numpy.frombuffer(data, dtype=numpy.uint8)
+    out = numpy.empty(length, dtype=numpy.uint8)
+
+    if words:
+        key = numpy.frombuffer(mask * 2, dtype=numpy.uint64)
+        numpy.bitwise_xor(src[:words << 3].view(numpy.uint64), key,
+                          out=out[:words << 3].view(numpy.uint64))
+
+    tail = length & 7
+    if tail:
+        key = numpy.frombuffer(mask * 2, dtype=numpy.uint8)[:tail]
+        numpy.bitwise_xor(src[words << 3:], key, out=out[words << 3:])
+
+    return out.tobytes()
+
+
+def mask_payload(mask, data, offset=0):
+    """对payload做掩码/反掩码(异或运算两者相同), 返回bytes
+
+    mask: 4字节掩码
+    data: bytes/bytearray/memoryview
+    offset: data 在整个payload中的偏移, 分块处理时使用
+    """
+    if not data:
+        return b''
+
+    mask = bytes(mask)
+    offset &= 3
+    if offset:
+        mask = mask[offset:] + mask[:offset]
+    if numpy is not None and len(data) >= NUMPY_THRESHOLD:
+        return _mask_numpy(mask, data)
+
+    return _mask_int(mask, data)
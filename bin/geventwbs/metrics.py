@@ -0,0 +1,341 @@
+"""
+指标
+~~~~~~~~~~
+Counter/Gauge/Histogram 和 Prometheus 文本格式输出, 不依赖 prometheus_client.
+Histogram 使用固定的2倍递增桶, observe 只需要一次 frexp 和一次数组加法.
+
+WebSocketServer(metrics=True) 时收集:
+
+websocket_connections: 当前连接数(server.clients), 共用一个registry的多个server相加
+websocket_handshakes_total: 握手成功次数
+websocket_handshake_failures_total{reason}: 握手失败次数
+websocket_frames_received_total/websocket_frames_sent_total{opcode}: 帧数
+websocket_bytes_received_total/websocket_bytes_sent_total{opcode}: payload字节数
+websocket_message_seconds{route}: on_message 耗时
+
+MetricsApp 是普通的wsgi应用, 可以和websocket路由一起挂在 Resource 上:
+
+    Resource([('/metrics', MetricsApp()), ('/con/msg', EchoApplication)])
+
+"""
+
+import math
+import weakref
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 默认桶: 100us 开始每个桶翻倍, 最大约210秒
+BUCKET_BASE = 0.0001
+BUCKET_COUNT = 22
+
+OPCODE_NAMES = {
+    0x00: 'continuation',
+    0x01: 'text',
+    0x02: 'binary',
+    0x08: 'close',
+    0x09: 'ping',
+    0x0a: 'pong',
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{0}="{1}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{0}="{1}"'.format(*extra))
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue(object):
+    __slots__ = ('base', 'counts', 'sum', 'count')
+
+    def __init__(self, base, size):
+        self.base = base
+        # 最后一个是超出所有桶的计数
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+
+        if value <= self.base:
+            index = 0
+        else:
+            mantissa, index = math.frexp(value / self.base)
+            # 刚好落在边界上时属于下一个桶(le 包含边界)
+            if mantissa == 0.5:
+                index -= 1
+            if index >= len(self.counts):
+                index = len(self.counts) - 1
+        self.counts[index] += 1
+
+
+class _Metric(object):
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._new_value()
+
+    def _new_value(self):
+        return _Value()
+
+    def labels(self, *values):
+        """按标签值取子指标, 热点路径上应该保存返回值重复使用
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError('{0} expects labels {1}'.format(
+                self.name, self.labelnames))
+
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self._new_value()
+        return child
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, _format_labels(self.labelnames, values), child.value
+
+    def expose(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, _escape(self.documentation)),
+            '# TYPE {0} {1}'.format(self.name, self.TYPE),
+        ]
+        for name, labels, value in self.samples():
+            lines.append('{0}{1} {2}'.format(name, labels, _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+class Gauge(_Metric):
+    """注册了 func 时采集时调用所有 func() 相加取值
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.funcs = []
+        if func is not None:
+            self.funcs.append(func)
+
+    def add_func(self, func):
+        self.funcs.append(func)
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+    def samples(self):
+        if self.funcs:
+            yield self.name, '', sum(func() for func in self.funcs)
+            return
+        for sample in super(Gauge, self).samples():
+            yield sample
+
+
+class Histogram(_Metric):
+    """桶的上界为 base * 2**i, i = 0..size-1
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), base=BUCKET_BASE,
+                 size=BUCKET_COUNT):
+        self.base = base
+        self.size = size
+        self.bounds = [base * 2 ** i for i in range(size)] + [math.inf]
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def _new_value(self):
+        return _HistogramValue(self.base, self.size)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds, child.counts):
+                cumulative += count
+                yield self.name + '_bucket', _format_labels(
+                    self.labelnames, values, ('le', _format_value(bound))), \
+                    cumulative
+
+            labels = _format_labels(self.labelnames, values)
+            yield self.name + '_sum', labels, child.sum
+            yield self.name + '_count', labels, child.count
+
+
+class Registry(object):
+    """同名指标只创建一次, 重复获取返回已有的指标
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, documentation, labelnames, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(
+                name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError('Metric {0} already registered as {1}'.format(
+                name, metric.TYPE))
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), func=None):
+        gauge = self._get(Gauge, name, documentation, labelnames)
+        if func is not None:
+            gauge.add_func(func)
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        return self._get(Histogram, name, documentation, labelnames, **kwargs)
+
+    def expose(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].expose())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+class MetricsApp(object):
+    """输出 Prometheus 文本格式的wsgi应用
+    """
+
+    def __init__(self, registry=None):
+        self.registry = registry or REGISTRY
+
+    def __call__(self, environ, start_response):
+        body = self.registry.expose().encode('utf-8')
+        start_response('200 OK', [
+            ('Content-Type', CONTENT_TYPE),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
+
+class WebSocketMetrics(object):
+    """WebSocketServer 使用的指标, 按opcode预先取好子指标
+    """
+
+    def __init__(self, server, registry=None):
+        registry = registry or REGISTRY
+        self.registry = registry
+
+        # 只持有server的弱引用, 回收后计为0
+        server = weakref.ref(server)
+        registry.gauge(
+            'websocket_connections', 'Active websocket connections',
+            func=lambda: len(getattr(server(), 'clients', ())))
+        self.handshakes = registry.counter(
+            'websocket_handshakes_total', 'Successful websocket handshakes')
+        self.handshake_failures = registry.counter(
+            'websocket_handshake_failures_total',
+            'Failed websocket handshakes', ('reason',))
+        self.message_seconds = registry.histogram(
+            'websocket_message_seconds', 'on_message latency in seconds',
+            ('route',))
+        self.queue_full = registry.counter(
+            'websocket_send_queue_full_total',
+            'Responses dropped because the send queue stayed full')
+
+        self.received = self._by_opcode(
+            registry.counter('websocket_frames_received_total',
+                             'Frames received', ('opcode',)),
+            registry.counter('websocket_bytes_received_total',
+                             'Payload bytes received', ('opcode',)))
+        self.sent = self._by_opcode(
+            registry.counter('websocket_frames_sent_total',
+                             'Frames sent', ('opcode',)),
+            registry.counter('websocket_bytes_sent_total',
+                             'Payload bytes sent', ('opcode',)))
+
+    @staticmethod
+    def _by_opcode(frames, size):
+        return dict(
+            (opcode, (frames.labels(name), size.labels(name)))
+            for opcode, name in OPCODE_NAMES.items())
+
+    def handshake_failed(self, reason):
+        self.handshake_failures.labels(reason).inc()
+
+    def send_queue_full(self):
+        self.queue_full.inc()
+
+    def frame_received(self, opcode, length):
+        counters = self.received.get(opcode)
+        if counters is not None:
+            counters[0].value += 1
+            counters[1].value += length
+
+    def frame_sent(self, opcode, length):
+        counters = self.sent.get(opcode)
+        if counters is not None:
+            counters[0].value += 1
+            counters[1].value += length
+
+    def raw_frame_sent(self, frame):
+        """encode_frame 编码好的完整帧, 去掉帧头长度
+        """
+        length = frame[1] & 0x7f
+        header = 2 + (2 if length == 126 else 8 if length == 127 else 0)
+        self.frame_sent(frame[0] & 0x0f, len(frame) - header)
+
+    def message_latency(self, route):
+        return self.message_seconds.labels(route or '')
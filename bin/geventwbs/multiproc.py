@@ -0,0 +1,366 @@
+"""
+多进程模式
+~~~~~~~~~~
+主进程预先fork N个worker, 每个worker用 SO_REUSEPORT 单独监听同一个端口,
+由内核在进程之间分配连接; 主进程负责监控, worker异常退出后重新拉起.
+
+连接只存在于接受它的worker里, publish/broadcast/send_to 需要经过总线:
+主进程在Unix socket上运行 BusHub, 每个worker用 WorkerBus 连接上来,
+一个worker发出的消息由hub原样转发给其他所有worker, 各自投递给本地连接.
+
+总线帧格式: 4字节长度 + backplane 批次
+如果server已经配置了其他backplane(比如Redis), 每个worker直接使用它, 不再经过hub
+
+    Supervisor(('0.0.0.0', 8000), Resource([...]), workers=4).run()
+
+"""
+
+import os
+import time
+import errno
+import signal
+import struct
+import logging
+import tempfile
+
+import gevent
+
+from gevent import socket
+from gevent.os import fork
+from gevent.os import waitpid
+from gevent.pool import Pool
+from gevent.queue import Queue, Full
+from gevent.server import StreamServer
+
+from .core import WebSocketServer
+from .backplane import Backplane
+from .drain import Drainer
+
+log = logging.getLogger()
+
+_LENGTH = struct.Struct('!I')
+
+def reuseport_listener(address, backlog=1024):
+    """每个worker自己的监听socket, 多个进程可以绑定同一个地址
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+
+    family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def _read_frame(rfile):
+    """读取一个总线帧, 返回 (长度头, 内容) 连接断开返回None
+    """
+    head = rfile.read(_LENGTH.size)
+    if len(head) < _LENGTH.size:
+        return None
+
+    length, = _LENGTH.unpack(head)
+    body = rfile.read(length)
+    if len(body) < length:
+        return None
+    return head, body
+
+
+class _Channel(object):
+    """总线连接的发送端, 有界队列 + writer greenlet
+    队列满说明对端处理不过来, 丢弃消息而不是阻塞业务
+    """
+
+    def __init__(self, sock, max_pending):
+        self.sock = sock
+        self.queue = Queue(max_pending)
+        self.dropped = 0
+        self._writer = gevent.spawn(self._run)
+
+    def put(self, frame):
+        try:
+            self.queue.put_nowait(frame)
+        except Full:
+            self.dropped += 1
+            if self.dropped & 0x3ff == 1:
+                log.warning('bus channel full, dropped=%d', self.dropped)
+
+    def _run(self):
+        queue = self.queue
+        sendall = self.sock.sendall
+        try:
+            while True:
+                frames = [queue.get()]
+                # 已经排队的帧合并成一次写
+                while not queue.empty() and len(frames) < 64:
+                    frames.append(queue.get_nowait())
+                sendall(b''.join(frames))
+        except socket.error as e:
+            log.warning('bus channel write failed: %s', e)
+
+    def close(self):
+        self._writer.kill(block=False)
+        # 只关闭本进程的fd, fork出来的进程里不能影响父进程的连接
+        self.sock.close()
+
+
+class BusHub(object):
+    """主进程里的总线, 把每个worker发来的帧转发给其他worker
+    """
+
+    def __init__(self, path, max_pending=10000):
+        self.path = path
+        self.max_pending = max_pending
+        self.channels = set()
+        self.server = None
+
+    def start(self):
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(128)
+
+        self.server = StreamServer(sock, self._handle, spawn=Pool())
+        self.server.start()
+
+    def _handle(self, sock, address):
+        channel = _Channel(sock, self.max_pending)
+        self.channels.add(channel)
+        rfile = sock.makefile('rb')
+
+        try:
+            while True:
+                frame = _read_frame(rfile)
+                if frame is None:
+                    break
+
+                data = b''.join(frame)
+                for other in list(self.channels):
+                    if other is not channel:
+                        other.put(data)
+        except socket.error as e:
+            log.warning('bus hub read failed: %s', e)
+        finally:
+            self.channels.discard(channel)
+            rfile.close()
+            channel.close()
+
+    def close(self, unlink=True):
+        if self.server is not None:
+            self.server.stop(timeout=0)
+            self.server = None
+
+        for channel in list(self.channels):
+            channel.close()
+        self.channels.clear()
+
+        if unlink:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class WorkerBus(Backplane):
+    """worker进程里的总线客户端, 经主进程的hub和其他worker交换批次
+    channel 已经会合并写, 默认不再等待tick
+    """
+
+    def __init__(self, path, tick=0, max_pending=10000, **kwargs):
+        super(WorkerBus, self).__init__(
+            tick=tick, max_pending=max_pending, **kwargs)
+        self.path = path
+        self.channel = None
+        self._reader = None
+
+    def start(self):
+        if self.channel is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self.channel = _Channel(sock, self.max_pending)
+            self._reader = gevent.spawn(self._run, sock)
+        super(WorkerBus, self).start()
+
+    def _write(self, batch):
+        if self.channel is not None:
+            self.channel.put(_LENGTH.pack(len(batch)) + batch)
+
+    def _run(self, sock):
+        rfile = sock.makefile('rb')
+        try:
+            while True:
+                frame = _read_frame(rfile)
+                if frame is None:
+                    break
+                self._receive(frame[1])
+        except socket.error as e:
+            log.warning('bus read failed: %s', e)
+        finally:
+            rfile.close()
+
+        # hub 在主进程里, 总线断开说明主进程已经退出
+        log.error('bus disconnected, stop worker %s', os.getpid())
+        if self.server is not None:
+            self.server.stop()
+
+    def close(self):
+        super(WorkerBus, self).close()
+        if self._reader is not None and \
+                self._reader is not gevent.getcurrent():
+            self._reader.kill(block=False)
+        self._reader = None
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+
+class Supervisor(object):
+    """预先fork worker并监控, worker退出后 restart_delay 秒重新拉起
+    收到 SIGTERM/SIGINT 时通知所有worker退出, 超过 stop_timeout 强制结束
+    server_kwargs 配置了 drain 时worker分散关闭连接, stop_timeout 至少为drain时长
+    """
+
+    def __init__(self, address, application, workers=None, server_class=None,
+                 bus_path=None, restart_delay=1, stop_timeout=10, backlog=1024,
+                 **server_kwargs):
+        self.address = address
+        self.application = application
+        self.num_workers = workers or os.cpu_count() or 1
+        self.server_class = server_class or WebSocketServer
+        self.bus_path = bus_path or os.path.join(
+            tempfile.gettempdir(), 'geventwbs-%d.sock' % os.getpid())
+        self.restart_delay = restart_delay
+        # drain 期间worker不能被强制结束
+        drainer = Drainer.create(server_kwargs.get('drain'))
+        if drainer is not None:
+            stop_timeout = max(stop_timeout, drainer.duration + 5)
+        self.stop_timeout = stop_timeout
+        self.backlog = backlog
+        self.server_kwargs = server_kwargs
+
+        self.hub = BusHub(self.bus_path)
+        # pid -> worker编号
+        self.workers = {}
+        # worker编号 -> 重新拉起的时间
+        self.pending = {}
+        self.stopping = False
+        self._signals = []
+
+    def run(self):
+        self.hub.start()
+        self._signals = [gevent.signal_handler(sig, self.stop)
+                         for sig in (signal.SIGTERM, signal.SIGINT)]
+
+        log.info('master %d start %d workers at %s:%d', os.getpid(),
+                 self.num_workers, self.address[0], self.address[1])
+        for index in range(self.num_workers):
+            self._spawn(index)
+
+        try:
+            while not self.stopping:
+                self._reap()
+                now = time.monotonic()
+                for index, due in list(self.pending.items()):
+                    if due <= now:
+                        del self.pending[index]
+                        self._spawn(index)
+                gevent.sleep(0.5)
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        self.stopping = True
+
+    def _spawn(self, index):
+        pid = fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(index)
+            except BaseException:
+                log.exception('worker %d crashed', index)
+                code = 1
+            finally:
+                os._exit(code)
+
+        self.workers[pid] = index
+        log.info('worker %d started, pid=%d', index, pid)
+
+    def _run_worker(self, index):
+        # 清理从主进程继承的状态
+        for watcher in self._signals:
+            watcher.cancel()
+        self.hub.close(unlink=False)
+
+        listener = reuseport_listener(self.address, self.backlog)
+        server = self.server_class(
+            listener, application=self.application, **self.server_kwargs)
+        server.worker_id = index
+
+        if server.backplane is None:
+            server.backplane = WorkerBus(self.bus_path)
+            server.backplane.attach(server)
+
+        # 配置了drain时 SIGTERM 分散关闭连接, SIGINT 仍然立即退出
+        gevent.signal_handler(signal.SIGINT, server.stop)
+        if server.drainer is not None:
+            gevent.signal_handler(signal.SIGTERM, server.drain)
+        else:
+            gevent.signal_handler(signal.SIGTERM, server.stop)
+
+        try:
+            server.serve_forever()
+        finally:
+            server.backplane.close()
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+
+            index = self.workers.pop(pid, None)
+            if index is None:
+                continue
+
+            log.warning('worker %d (pid=%d) exited with status %d',
+                        index, pid, status)
+            if not self.stopping:
+                self.pending[index] = time.monotonic() + self.restart_delay
+
+    def _shutdown(self):
+        log.info('master %d stopping workers', os.getpid())
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.monotonic() + self.stop_timeout
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            gevent.sleep(0.1)
+
+        for pid in list(self.workers):
+            log.warning('worker pid=%d did not exit, kill', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self._reap()
+
+        for watcher in self._signals:
+            watcher.cancel()
+        self.hub.close()
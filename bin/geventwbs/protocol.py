@@ -0,0 +1,771 @@
+"""
+websocket 协议 (sans-IO)
+~~~~~~~~~~
+不做任何IO的协议实现: 帧头编解码, 握手检查和101响应, 服务端连接状态机.
+gevent 后端(core/websocket)和 asyncio 后端(aio)共用这里的代码.
+
+Connection 只处理字节: 收到的数据交给 receive_data, 解析出的事件从 events
+取出; 要发送的数据由 send/ping/close 返回, 自动回复的pong和close帧从
+data_to_send 取出, 由调用者写到连接上:
+
+    conn = Connection(deflate, max_frame_size, max_message_size)
+    conn.receive_data(data)          # b'' 表示对端断开
+    for event in conn.events():      # Message/Ping/Pong/Close
+        ...
+    transport.write(conn.data_to_send())
+    transport.write(conn.send('hello'))
+
+协议错误时 Connection 自己生成对应的close帧(1002/1007/1009), 并产生
+Close 事件, 调用者写出 data_to_send 之后关闭连接即可.
+"""
+
+import zlib
+import struct
+import base64
+import hashlib
+
+from .exceptions import ProtocolError
+from .exceptions import WebSocketError
+from .exceptions import FrameTooLargeException
+from .mask import mask_payload
+
+# 预编译的帧头格式
+_HEAD = struct.Struct('!BB')
+_LEN16 = struct.Struct('!H')
+_LEN64 = struct.Struct('!Q')
+_CLOSE_CODE = struct.Struct('!H')
+
+OPCODE_CONTINUATION = 0x00
+OPCODE_TEXT = 0x01
+OPCODE_BINARY = 0x02
+OPCODE_CLOSE = 0x08
+OPCODE_PING = 0x09
+OPCODE_PONG = 0x0a
+
+SUPPORTED_VERSIONS = ('13', '8', '7')
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+HANDSHAKE_STATUS = b'101 Switching Protocols'
+HANDSHAKE_HEAD = (b'HTTP/1.1 ' + HANDSHAKE_STATUS + b'\r\n'
+                  b'Upgrade: websocket\r\n'
+                  b'Connection: Upgrade\r\n'
+                  b'Sec-WebSocket-Accept: ')
+
+
+class Header(object):
+    __slots__ = ('fin', 'mask', 'opcode', 'flags', 'length')
+
+    FIN_MASK = 0x80
+    OPCODE_MASK = 0x0f
+    MASK_MASK = 0x80
+    LENGTH_MASK = 0x7f
+
+    RSV0_MASK = 0x40
+    RSV1_MASK = 0x20
+    RSV2_MASK = 0x10
+
+    HEADER_FLAG_MASK = RSV0_MASK | RSV1_MASK | RSV2_MASK
+
+    def __init__(self, fin=0, opcode=0, flags=0, length=0):
+        self.mask = ''
+        self.fin = fin
+        self.opcode = opcode
+        self.flags = flags
+        self.length = length
+
+    def mask_payload(self, payload):
+        return mask_payload(self.mask, payload)
+
+    unmask_payload = mask_payload
+
+    def check_control(self, data):
+        # 0x07 之后都是 连接关闭 ping pong 所以都是fin都应该是消息结果 并且length不应该超过125
+        if self.opcode > 0x07:
+            if not self.fin:
+                raise ProtocolError(
+                    "Received fragmented control frame: {0!r}".format(data))
+
+            # Control frames MUST have a payload length of 125 bytes or less
+            if self.length > 125:
+                raise FrameTooLargeException(
+                    "Control frame cannot be larger than 125 bytes: "
+                    "{0!r}".format(data))
+
+    @staticmethod
+    def size(buffer, start):
+        """buffer[start:] 至少有2个字节时, 返回完整帧头的长度
+        """
+        second_byte = buffer[start + 1]
+        length = second_byte & Header.LENGTH_MASK
+        if length < 126:
+            size = 2
+        elif length == 126:
+            size = 4
+        else:
+            size = 10
+
+        if second_byte & Header.MASK_MASK:
+            size += 4
+        return size
+
+    def parse(self, buffer, start, size):
+        """从 buffer[start:start+size] 解析帧头, size 由 Header.size 得到
+        """
+        first_byte, second_byte = _HEAD.unpack_from(buffer, start)
+
+        length = second_byte & self.LENGTH_MASK
+        if length == 126:
+            length = _LEN16.unpack_from(buffer, start + 2)[0]
+        elif length == 127:
+            length = _LEN64.unpack_from(buffer, start + 2)[0]
+
+        self.fin = first_byte & self.FIN_MASK == self.FIN_MASK
+        self.opcode = first_byte & self.OPCODE_MASK
+        self.flags = first_byte & self.HEADER_FLAG_MASK
+        self.length = length
+        if second_byte & self.MASK_MASK:
+            self.mask = buffer[start + size - 4:start + size]
+        else:
+            self.mask = ''
+
+        if self.opcode > 0x07:
+            self.check_control(buffer[start:start + 2])
+        return self
+
+    @classmethod
+    def decode_header(cls, stream):
+        """
+        0                   1                   2                   3
+        0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+        +-+-+-+-+-------+-+-------------+-------------------------------+
+        |F|R|R|R| opcode|M| Payload len |    Extended payload length    |
+        |I|S|S|S|  (4)  |A|     (7)     |             (16/64)           |
+        |N|V|V|V|       |S|             |   (if payload len==126/127)   |
+        | |1|2|3|       |K|             |                               |
+        +-+-+-+-+-------+-+-------------+ - - - - - - - - - - - - - - - +
+        |     Extended payload length continued, if payload len == 127  |
+        + - - - - - - - - - - - - - - - +-------------------------------+
+        |                               |Masking-key, if MASK set to 1  |
+        +-------------------------------+-------------------------------+
+        | Masking-key (continued)       |          Payload Data         |
+        +-------------------------------- - - - - - - - - - - - - - - - +
+        :                     Payload Data continued ...                :
+        + - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - +
+        |                     Payload Data continued ...                |
+        +---------------------------------------------------------------+
+        """
+        read = stream.read
+        # 读前两个字节  16bit
+        data = read(2)
+
+        if len(data) != 2:
+            raise WebSocketError("Unexpected EOF while decoding header")
+
+        first_byte, second_byte = _HEAD.unpack(data)
+
+        header = cls(
+            fin=first_byte & cls.FIN_MASK == cls.FIN_MASK,  # fin 为1 代表结束
+            opcode=first_byte & cls.OPCODE_MASK,   # 获取opcode
+            flags=first_byte & cls.HEADER_FLAG_MASK, # 获取rsv 操作信息
+            length=second_byte & cls.LENGTH_MASK) # 获取payload len 数值
+
+        has_mask = second_byte & cls.MASK_MASK == cls.MASK_MASK # 判断是否对payloadData 进行掩码处理
+
+        header.check_control(data)
+
+        # 如果126 读取后2个字节为长度
+        if header.length == 126:
+            data = read(2)
+
+            if len(data) != 2:
+                raise WebSocketError('Unexpected EOF while decoding header')
+
+            # 获取无符号整形数字
+            header.length = _LEN16.unpack(data)[0]
+        # 如果126 读取后8个字节为长度
+        elif header.length == 127:
+            # 64 bit length
+            data = read(8)
+
+            if len(data) != 8:
+                raise WebSocketError('Unexpected EOF while decoding header')
+
+            # 获取无符号长整形数字
+            header.length = _LEN64.unpack(data)[0]
+
+        if has_mask:
+            mask = read(4)
+
+            if len(mask) != 4:
+                raise WebSocketError('Unexpected EOF while decoding header')
+
+            header.mask = mask
+
+        return header
+
+    @classmethod
+    def encode_header(cls, fin, opcode, mask, length, flags):
+        first_byte = opcode
+        second_byte = 0
+        extra = b""
+        result = bytearray()
+
+        if fin:
+            first_byte |= cls.FIN_MASK
+
+        if flags & cls.RSV0_MASK:
+            first_byte |= cls.RSV0_MASK
+
+        if flags & cls.RSV1_MASK:
+            first_byte |= cls.RSV1_MASK
+
+        if flags & cls.RSV2_MASK:
+            first_byte |= cls.RSV2_MASK
+
+        # now deal with length complexities
+        if length < 126:
+            second_byte += length
+        elif length <= 0xffff:
+            second_byte += 126
+            extra = _LEN16.pack(length)
+        elif length <= 0xffffffffffffffff:
+            second_byte += 127
+            extra = _LEN64.pack(length)
+        else:
+            raise FrameTooLargeException
+
+        if mask:
+            second_byte |= cls.MASK_MASK
+
+        result.append(first_byte)
+        result.append(second_byte)
+        result.extend(extra)
+
+        if mask:
+            result.extend(mask)
+
+        return result
+
+
+def byte_view(view):
+    """memoryview 转成按字节计数的一维视图, 非连续内存只能拷贝
+    """
+    if view.format == 'B' and view.ndim == 1:
+        return view
+    if view.c_contiguous:
+        return view.cast('B')
+    return view.tobytes()
+
+
+def encode_bytes(text):
+    if isinstance(text, (bytes, bytearray)):
+        return text
+
+    if isinstance(text, memoryview):
+        return byte_view(text)
+
+    if not isinstance(text, str):
+        text = str(text or '')
+
+    return text.encode("utf-8")
+
+
+def encode_payload(message, opcode):
+    if opcode in (OPCODE_TEXT, OPCODE_PING):
+        return encode_bytes(message)
+    elif opcode == OPCODE_BINARY:
+        # bytes/bytearray/memoryview 直接发送 不拷贝
+        if isinstance(message, (bytes, bytearray)):
+            return message
+        if isinstance(message, memoryview):
+            return byte_view(message)
+        return bytes(message)
+    return message
+
+
+def encode_frame(message, binary=None):
+    """编码成完整的数据帧(不压缩)
+    """
+    if binary is None:
+        binary = not isinstance(message, str)
+
+    opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+    message = encode_payload(message, opcode)
+
+    frame = Header.encode_header(True, opcode, b'', len(message), 0)
+    frame += message
+    return bytes(frame)
+
+
+def is_valid_close_code(code):
+    """验证关闭close码是否正确
+    """
+    if code < 1000:
+        return False
+
+    if 1004 <= code <= 1006:
+        return False
+
+    # 1012~1014 为IANA登记的 Service Restart/Try Again Later/Bad Gateway,
+    # drain 就用1012关闭; 1015 只在本地表示TLS握手失败, 不能出现在帧里
+    if 1015 <= code <= 1016:
+        return False
+
+    if code == 1100:
+        return False
+
+    if 2000 <= code <= 2999:
+        return False
+
+    return True
+
+
+def parse_close(payload):
+    """解析close帧, 返回 (code, reason), 没有payload时 code 为None
+    reason 不是utf-8时抛出 UnicodeDecodeError
+    """
+    if not payload:
+        return None, ''
+
+    if len(payload) < 2:
+        raise ProtocolError('Invalid close frame: {0!r}'.format(payload))
+
+    code = _CLOSE_CODE.unpack_from(payload)[0]
+    # 如果发送close 信息 肯定是uft编码
+    reason = bytes(payload[2:]).decode('utf-8')
+
+    # 判断close码是否正确
+    if not is_valid_close_code(code):
+        raise ProtocolError('Invalid close code {0}'.format(code))
+    return code, reason
+
+
+def encode_close(code=1000, reason=b''):
+    return _CLOSE_CODE.pack(code) + encode_bytes(reason)
+
+
+# 握手
+
+class HandshakeError(Exception):
+    """握手请求不合法
+    reason: 指标里的失败原因, status 为None时不返回http错误
+    """
+
+    def __init__(self, reason, message=None, status=None, headers=()):
+        super(HandshakeError, self).__init__(message or reason)
+        self.reason = reason
+        self.message = message
+        self.status = status
+        self.headers = headers
+
+
+def check_request(environ, http_version):
+    """检查升级请求, 返回 Sec-WebSocket-Key, 不合法时抛出 HandshakeError
+    """
+    if environ.get('REQUEST_METHOD', '') != 'GET':
+        # websocket 必须是GET方法
+        raise HandshakeError(
+            'method', 'Can only upgrade connection if using GET method.')
+
+    upgrade = environ.get('HTTP_UPGRADE', '').lower()
+    if upgrade != 'websocket':
+        # 不是websocket 连接
+        raise HandshakeError('upgrade', 'Websocket protocol Error')
+
+    connection = environ.get('HTTP_CONNECTION', '').lower()
+    if 'upgrade' not in connection:
+        # 值必须为upgrade
+        raise HandshakeError('connection', 'Websocket protocol Error')
+
+    # websocket 协议必须是http1.1
+    if http_version != 'HTTP/1.1':
+        raise HandshakeError('http_version', 'Bad protocol version',
+                             '402 Bad Request')
+
+    version = environ.get('HTTP_SEC_WEBSOCKET_VERSION')
+    supported = [('Sec-WebSocket-Version', ', '.join(SUPPORTED_VERSIONS))]
+    if not version:
+        raise HandshakeError('no_version',
+                             'No Websocket protocol version defined',
+                             '426 Upgrade Required', supported)
+
+    if version not in SUPPORTED_VERSIONS:
+        raise HandshakeError(
+            'version', 'Unsupported WebSocket Version: {0}'.format(version),
+            '400 Bad Request', supported)
+
+    key = environ.get('HTTP_SEC_WEBSOCKET_KEY', '').strip()
+    if not key:
+        # 5.2.1 (3)
+        raise HandshakeError('missing_key',
+                             'Sec-WebSocket-Key header is missing/empty',
+                             '400 Bad Request')
+
+    try:
+        # 16字节的base64固定为24个字符, 长度不对不用解码
+        key_len = len(base64.b64decode(key)) if len(key) == 24 else 0
+    except (TypeError, ValueError):
+        key_len = 0
+
+    if key_len != 16:
+        raise HandshakeError('invalid_key', 'Invalid key: {0}'.format(key),
+                             '400 Bad Request')
+    return key
+
+
+def requested_protocols(environ):
+    return [p.strip() for p in environ.get(
+        'HTTP_SEC_WEBSOCKET_PROTOCOL', '').split(',') if p.strip()]
+
+
+def accept_key(key):
+    return base64.b64encode(
+        hashlib.sha1((key + GUID).encode('latin-1')).digest())
+
+
+def header_value(value):
+    # 防止响应头注入, 和 start_response 的检查一致
+    if '\r' in value or '\n' in value:
+        raise ValueError('carriage return or newline in header value')
+    return value.encode('latin-1')
+
+
+def handshake_response(key, origin='', protocol=None, extension=None):
+    """101 响应拼成一个bytes, 由客户端带来的值不能包含换行
+    """
+    # 默认支持跨域
+    parts = [HANDSHAKE_HEAD, accept_key(key),
+             b'\r\nAccess-Control-Allow-Origin: ', header_value(origin)]
+
+    if protocol:
+        parts.append(b'\r\nSec-WebSocket-Protocol: ')
+        parts.append(header_value(protocol))
+
+    if extension:
+        parts.append(b'\r\nSec-WebSocket-Extensions: ')
+        parts.append(header_value(extension))
+
+    parts.append(b'\r\n\r\n')
+    return b''.join(parts)
+
+
+# 连接状态机
+
+class Message(object):
+    """一条完整的数据消息, data 为bytes, 文本消息不做utf-8解码
+    """
+    __slots__ = ('binary', 'data')
+
+    def __init__(self, binary, data):
+        self.binary = binary
+        self.data = data
+
+
+class Ping(object):
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Pong(object):
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+
+class Close(object):
+    """连接关闭: 收到close帧, 协议错误(1002/1007/1009) 或者对端断开(1006)
+    """
+    __slots__ = ('code', 'reason')
+
+    def __init__(self, code, reason=''):
+        self.code = code
+        self.reason = reason
+
+
+class MessageParser(object):
+    """收到的帧的协议检查和分片消息状态, 不缓冲payload
+    Connection 和 gevent 的 WebSocket 都用它检查帧, 两个后端的规则相同:
+
+        parser.check_header(header)   # 读payload之前: rsv位, 帧/消息大小
+        if parser.begin(header):      # 控制帧, 由调用者处理ping/pong/close
+            ...
+        done = parser.end(header)     # 消息的最后一帧返回 (binary, compressed)
+    """
+
+    __slots__ = ('deflate', 'max_frame_size', 'max_message_size', 'opcode',
+                 'compressed', 'size')
+
+    def __init__(self, deflate=None, max_frame_size=None,
+                 max_message_size=None):
+        self.deflate = deflate
+        self.max_frame_size = max_frame_size
+        self.max_message_size = max_message_size
+
+        # 正在接收的消息: 第一帧的opcode, 是否压缩, 已经收到的长度
+        self.opcode = None
+        self.compressed = False
+        self.size = 0
+
+    def check_header(self, header):
+        # rsv 只允许协商了压缩扩展时的RSV1
+        if header.flags and (self.deflate is None or
+                             header.flags != Header.RSV0_MASK):
+            raise ProtocolError('Unexpected rsv bits: {0!r}'.format(
+                header.flags))
+
+        # 控制帧长度在 check_control 里已经限制
+        if header.opcode >= 0x08:
+            return
+
+        length = header.length
+        if self.max_frame_size is not None and length > self.max_frame_size:
+            raise FrameTooLargeException(
+                'Frame exceeds max_frame_size {0}: {1}'.format(
+                    self.max_frame_size, length))
+
+        if self.max_message_size is not None and \
+                self.size + length > self.max_message_size:
+            raise FrameTooLargeException(
+                'Message exceeds max_message_size {0}: {1}'.format(
+                    self.max_message_size, self.size + length))
+
+    def begin(self, header):
+        """检查帧在消息里的位置, 控制帧返回True
+        """
+        opcode = header.opcode
+
+        if opcode in (OPCODE_TEXT, OPCODE_BINARY):
+            if self.opcode:
+                raise ProtocolError("The opcode in non-fin frame is "
+                                    "expected to be zero, got "
+                                    "{0!r}".format(opcode))
+            self.opcode = opcode
+            # 压缩标记只在消息的第一帧设置
+            self.compressed = bool(header.flags)
+            return False
+
+        if header.flags:
+            raise ProtocolError("Unexpected rsv bits in frame with "
+                                "opcode={0!r}".format(opcode))
+
+        if opcode == OPCODE_CONTINUATION:
+            if not self.opcode:
+                raise ProtocolError("Unexpected frame with opcode=0")
+            return False
+
+        if opcode in (OPCODE_PING, OPCODE_PONG, OPCODE_CLOSE):
+            return True
+
+        raise ProtocolError("Unexpected opcode={0!r}".format(opcode))
+
+    def end(self, header):
+        """数据帧的payload处理完, 消息结束时返回 (binary, compressed)
+        """
+        self.size += header.length
+        if not header.fin:
+            return None
+
+        result = (self.opcode == OPCODE_BINARY, self.compressed)
+        self.opcode = None
+        self.compressed = False
+        self.size = 0
+        return result
+
+
+class Connection(object):
+    """服务端连接状态机, 不做IO
+    """
+
+    OPEN = 'open'
+    # 已经发出close帧, 等待对端的close
+    CLOSING = 'closing'
+    CLOSED = 'closed'
+
+    def __init__(self, deflate=None, max_frame_size=None,
+                 max_message_size=None):
+        """deflate: 握手协商得到的 deflate.PerMessageDeflate
+        """
+        self.deflate = deflate
+        self.max_frame_size = max_frame_size
+        self.max_message_size = max_message_size
+        self.state = self.OPEN
+
+        self.buffer = bytearray()
+        self.pos = 0
+        self.eof = False
+        self.header = Header()
+        self.outgoing = bytearray()
+
+        self.parser = MessageParser(deflate, max_frame_size, max_message_size)
+        # 正在接收的分片消息
+        self.fragments = None
+
+    def receive_data(self, data):
+        if data:
+            self.buffer += data
+        else:
+            self.eof = True
+
+    def events(self):
+        """解析已收到的数据, 逐个返回事件
+        """
+        while self.state != self.CLOSED:
+            try:
+                event = self._next_event()
+            except UnicodeError as e:
+                event = self._fail(1007, e)
+            except FrameTooLargeException as e:
+                event = self._fail(1009, e)
+            except ProtocolError as e:
+                event = self._fail(1002, e)
+
+            if event is None:
+                break
+            yield event
+
+        # 已经解析的数据从缓冲区删除
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+        if self.eof and self.state != self.CLOSED:
+            self.state = self.CLOSED
+            yield Close(1006, 'connection lost')
+
+    def data_to_send(self):
+        """自动回复的pong和close帧
+        """
+        data = bytes(self.outgoing)
+        del self.outgoing[:]
+        return data
+
+    def _fail(self, code, error):
+        reason = str(error)
+        if self.state == self.OPEN:
+            self.outgoing += self._frame(encode_close(code), OPCODE_CLOSE)
+        self.state = self.CLOSED
+        return Close(code, reason)
+
+    def _next_frame(self):
+        """返回 (header, payload), 数据不够一帧时返回None
+        """
+        buffer = self.buffer
+        pos = self.pos
+        available = len(buffer) - pos
+        if available < 2:
+            return None
+
+        size = Header.size(buffer, pos)
+        if available < size:
+            return None
+        header = self.header.parse(buffer, pos, size)
+        # 在缓冲payload之前检查
+        self.parser.check_header(header)
+
+        length = header.length
+        if available < size + length:
+            return None
+
+        start = pos + size
+        self.pos = start + length
+        payload = buffer[start:start + length]
+        if header.mask:
+            payload = header.unmask_payload(payload)
+        return header, bytes(payload)
+
+    def _next_event(self):
+        parser = self.parser
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return None
+
+            header, payload = frame
+            opcode = header.opcode
+
+            if parser.begin(header):
+                if opcode == OPCODE_PING:
+                    if self.state == self.OPEN:
+                        self.outgoing += self._frame(payload, OPCODE_PONG)
+                    return Ping(payload)
+
+                if opcode == OPCODE_PONG:
+                    return Pong(payload)
+
+                code, reason = parse_close(payload)
+                if self.state == self.OPEN:
+                    # 回复同样的close码
+                    self.outgoing += self._frame(
+                        encode_close(code or 1000), OPCODE_CLOSE)
+                self.state = self.CLOSED
+                return Close(code or 1005, reason)
+
+            done = parser.end(header)
+            if done is None:
+                if self.fragments is None:
+                    self.fragments = bytearray(payload)
+                else:
+                    self.fragments += payload
+                continue
+
+            if self.fragments is not None:
+                self.fragments += payload
+                payload = bytes(self.fragments)
+                self.fragments = None
+
+            binary, compressed = done
+            if compressed:
+                payload = self._decompress(payload)
+            return Message(binary, payload)
+
+    def _decompress(self, payload):
+        try:
+            return self.deflate.decompress(payload, self.max_message_size)
+        except zlib.error as e:
+            raise ProtocolError('Invalid compressed message: {0}'.format(e))
+
+    def _frame(self, payload, opcode, flags=0):
+        payload = encode_payload(payload, opcode)
+        frame = Header.encode_header(True, opcode, b'', len(payload), flags)
+        frame += payload
+        return frame
+
+    def send(self, message, binary=None):
+        """返回要发送的数据帧, 协商了压缩时按大小决定是否压缩
+        """
+        if self.state != self.OPEN:
+            raise WebSocketError('Connection is already closed')
+
+        if binary is None:
+            binary = not isinstance(message, str)
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+
+        flags = 0
+        deflate = self.deflate
+        if deflate is not None:
+            message = encode_payload(message, opcode)
+            if deflate.should_compress(len(message)):
+                message = deflate.compress(message)
+                flags = Header.RSV0_MASK
+        return bytes(self._frame(message, opcode, flags))
+
+    def ping(self, payload=b''):
+        if self.state != self.OPEN:
+            raise WebSocketError('Connection is already closed')
+        return bytes(self._frame(payload, OPCODE_PING))
+
+    def pong(self, payload=b''):
+        if self.state != self.OPEN:
+            raise WebSocketError('Connection is already closed')
+        return bytes(self._frame(payload, OPCODE_PONG))
+
+    def close(self, code=1000, reason=b''):
+        """返回close帧, 之后等待对端回复close; 已经关闭时返回b''
+        """
+        if self.state != self.OPEN:
+            return b''
+        self.state = self.CLOSING
+        return bytes(self._frame(encode_close(code, reason), OPCODE_CLOSE))
@@ -0,0 +1,195 @@
+"""
+连接注册表
+~~~~~~~~~~
+server.clients 按 client_address 保存 Client, 用法和dict相同, 另外维护
+用户/路由/标签三个索引, 按用户或者路由查找连接和计数都是 O(1):
+
+    server.clients.by_user(userid)       # 该用户的所有连接
+    server.clients.count_route('/chat')  # 路由上的连接数
+    server.clients.tag(client, 'room:1') # 打标签, publish 的topic就是标签
+
+握手鉴权得到的用户在注册时自动建立索引, 应用也可以在登录后调用 set_user.
+连接断开时从所有索引中删除.
+"""
+
+
+class Client(object):
+    """一个连接, 使用 __slots__ 减少每个连接的内存
+    """
+
+    __slots__ = ('address', 'ws', 'user', 'route', 'tags',
+                 'rtt', 'missed', 'ping_payload', 'slot', 'inflight')
+
+    def __init__(self, address, ws, user=None, route=None):
+        self.address = address
+        self.ws = ws
+        self.user = user
+        self.route = route
+        # 没有标签时为None, 大部分连接不用分配集合
+        self.tags = None
+
+        # 心跳状态: 最近一次pong的往返时间(秒), 连续未回复的ping数
+        self.rtt = None
+        self.missed = 0
+        self.ping_payload = None
+        self.slot = None
+
+        # 正在处理的消息数, drain 时等它归零再关闭连接
+        self.inflight = 0
+
+
+def _index_add(index, key, client):
+    clients = index.get(key)
+    if clients is None:
+        clients = index[key] = set()
+    clients.add(client)
+
+
+def _index_discard(index, key, client):
+    clients = index.get(key)
+    if clients is not None:
+        clients.discard(client)
+        if not clients:
+            del index[key]
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class ClientRegistry(object):
+    """address -> Client, 兼容dict的读写接口
+    by_* 返回列表副本, 遍历期间连接断开也不影响
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.users = {}
+        self.routes = {}
+        self.tags = {}
+
+    # dict 接口
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def __contains__(self, address):
+        return address in self.clients
+
+    def __getitem__(self, address):
+        return self.clients[address]
+
+    def __setitem__(self, address, client):
+        old = self.clients.get(address)
+        if old is not None and old is not client:
+            self.remove(old)
+        self.add(client, address)
+
+    def __delitem__(self, address):
+        self.remove(self.clients[address])
+
+    def get(self, address, default=None):
+        return self.clients.get(address, default)
+
+    def keys(self):
+        return self.clients.keys()
+
+    def values(self):
+        return self.clients.values()
+
+    def items(self):
+        return self.clients.items()
+
+    def pop(self, address, *default):
+        client = self.clients.get(address)
+        if client is None:
+            if default:
+                return default[0]
+            raise KeyError(address)
+        self.remove(client)
+        return client
+
+    # 注册
+
+    def add(self, client, address=None):
+        if address is None:
+            address = client.address
+        self.clients[address] = client
+
+        if client.user is not None:
+            _index_add(self.users, client.user, client)
+        if client.route is not None:
+            _index_add(self.routes, client.route, client)
+        for tag in client.tags or ():
+            _index_add(self.tags, tag, client)
+
+    def remove(self, client):
+        if self.clients.get(client.address) is client:
+            del self.clients[client.address]
+
+        if client.user is not None:
+            _index_discard(self.users, client.user, client)
+        if client.route is not None:
+            _index_discard(self.routes, client.route, client)
+        for tag in client.tags or ():
+            _index_discard(self.tags, tag, client)
+
+    def set_user(self, client, user):
+        """登录/切换用户, user 必须可以hash(用户id)
+        """
+        if client.user is not None:
+            _index_discard(self.users, client.user, client)
+        client.user = user
+        if user is not None and client.address in self.clients:
+            _index_add(self.users, user, client)
+
+    def tag(self, client, *tags):
+        if client.tags is None:
+            client.tags = set()
+        registered = client.address in self.clients
+        for tag in tags:
+            client.tags.add(tag)
+            if registered:
+                _index_add(self.tags, tag, client)
+
+    def untag(self, client, *tags):
+        if not client.tags:
+            return
+        for tag in tags:
+            client.tags.discard(tag)
+            _index_discard(self.tags, tag, client)
+
+    # 查询
+
+    def by_user(self, user):
+        return list(self.users.get(user, ()))
+
+    def by_route(self, route):
+        return list(self.routes.get(route, ()))
+
+    def by_tag(self, tag):
+        return list(self.tags.get(tag, ()))
+
+    def count_user(self, user):
+        return len(self.users.get(user, ()))
+
+    def count_route(self, route):
+        return len(self.routes.get(route, ()))
+
+    def count_tag(self, tag):
+        return len(self.tags.get(tag, ()))
+
+    @staticmethod
+    def user_key(user):
+        """握手鉴权得到的用户能作为索引时返回它, 否则(比如整个session dict)返回None
+        """
+        if user is None or not _hashable(user):
+            return None
+        return user
@@ -0,0 +1,119 @@
+"""
+路由表
+~~~~~~~~~~
+Resource 的路由按配置顺序用 re.match 匹配, 第一个匹配的生效.
+这里在构造时把路由编译好:
+
+1. 纯字符串路径: 构造时直接算出匹配结果, 查找只需一次dict访问
+2. 正则路径: 按正则开头的固定字符串建前缀树, 查找时沿路径走一遍前缀树
+   只对前缀吻合的路由按原顺序做 re.match
+3. 最近查找过的路径放在有界的LRU缓存里
+
+"""
+
+import re
+
+from collections import OrderedDict
+
+# 正则里的特殊字符, 固定前缀到这里为止
+_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+# 前缀树节点里保存路由编号的key, 路径字符不会是空串
+_ROUTES = ''
+
+
+def _is_literal(path):
+    return isinstance(path, str) and re.escape(path) == path
+
+
+def _literal_prefix(regex):
+    """正则开头的固定字符串, re.match 能匹配的路径一定以它开头
+    """
+    pattern = regex.pattern
+    # 顶层的 | 或者忽略大小写时没法确定前缀
+    if not isinstance(pattern, str) or '|' in pattern or \
+            regex.flags & re.IGNORECASE:
+        return ''
+
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+
+    prefix = []
+    for char in pattern:
+        if char in _SPECIAL:
+            # 后面跟量词时最后一个字符是可选的
+            if char in '*?{' and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class RouteTable(object):
+    """routes: [(pattern, app), ...] 按顺序匹配
+    """
+
+    def __init__(self, routes, cache_size=1024):
+        self.routes = [(re.compile(pattern), app) for pattern, app in routes]
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        self._trie = {}
+        for index, (regex, _) in enumerate(self.routes):
+            node = self._trie
+            for char in _literal_prefix(regex):
+                node = node.setdefault(char, {})
+            node.setdefault(_ROUTES, []).append(index)
+
+        # 纯字符串路径的结果提前算好, 注意前面的正则路由可能先匹配到
+        self._static = {}
+        for pattern, _ in routes:
+            if _is_literal(pattern) and pattern not in self._static:
+                self._static[pattern] = self._lookup(pattern)
+
+    def _lookup(self, path):
+        # 沿前缀树收集前缀吻合的路由
+        node = self._trie
+        candidates = list(node.get(_ROUTES, ()))
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            indexes = node.get(_ROUTES)
+            if indexes:
+                candidates.extend(indexes)
+
+        if len(candidates) > 1:
+            candidates.sort()
+
+        routes = self.routes
+        for index in candidates:
+            regex, app = routes[index]
+            if regex.match(path):
+                return regex.pattern, app
+        return None
+
+    def lookup(self, path):
+        """返回 (路由pattern, app) 没有匹配返回None
+        """
+        try:
+            return self._static[path]
+        except KeyError:
+            pass
+
+        cache = self._cache
+        try:
+            route = cache[path]
+            cache.move_to_end(path)
+            return route
+        except KeyError:
+            pass
+
+        route = self._lookup(path)
+        cache[path] = route
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return route
+
+    def match(self, path):
+        route = self.lookup(path)
+        return route[1] if route is not None else None
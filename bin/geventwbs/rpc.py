@@ -0,0 +1,386 @@
+"""
+RPC 网关
+~~~~~~~~~~
+按 URL_CONF 把websocket消息转发给 RPC_SERVERS 里配置的后端服务:
+
+    class Gateway(RpcGateway):
+        URL_CONF = config.URL_CONF
+        RPC_SERVERS = config.RPC_SERVERS
+        ALLOWED_HEADERS = config.ALLOWED_HEADERS
+        ALLOWED_COOKIES = config.ALLOWED_COOKIES
+
+    Resource([('/rpc', Gateway)])
+
+客户端消息: {"id": 1, "url": "/user/wx/login", "params": {...}}
+返回: {"id": 1, "result": ...} 或 {"id": 1, "error": {"code": 504, "message": "..."}}
+
+URL_CONF 里没有配置 rpc/method 时, url 第一段为rpc名, 其余用.连接为方法名:
+/user/captcha/smscode -> rpc=user method=captcha.smscode
+check 不为空的url需要服务端开启鉴权(auth)并且连接已登录, 否则返回401
+
+后端协议: 4字节大端长度 + json, 一个TCP连接上同时有多个请求, 按id对应响应
+
+    {"id": 1, "method": "captcha.smscode", "params": {...},
+     "context": {"headers": {...}, "cookies": {...}, "user": ...}}
+    {"id": 1, "result": ...} 或 {"id": 1, "error": {"code": 500, "message": "..."}}
+
+每个后端地址最多保持 pool_size 个长连接, 请求轮流使用. 连接或发送失败的
+地址暂停 retry_interval 秒, 请求转给下一个地址; 请求发出之后超时或连接断开
+不再重试, 避免重复执行.
+"""
+
+import time
+import struct
+import logging
+
+from http.cookies import SimpleCookie, CookieError
+
+import gevent
+
+from gevent import socket
+from gevent import Timeout
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+
+from .core import WebSocketApplication
+from .codec import get_codec
+from .exceptions import RpcError, RpcTimeout, RpcUnavailable
+
+log = logging.getLogger()
+
+_LENGTH = struct.Struct('!I')
+
+# 后端单个响应的大小上限
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class RpcConnection(object):
+    """到一个后端地址的长连接, 多个greenlet共用
+    请求整帧写出后释放写锁, 响应由读greenlet按id分发
+    """
+
+    def __init__(self, address, timeout, connect_timeout=3, on_close=None):
+        self.address = address
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.on_close = on_close
+
+        self.sock = None
+        self.closed = False
+        self.pending = {}
+        self.seq = 0
+
+        self.codec = get_codec('json')
+        self._write_lock = Semaphore()
+        self._connect_lock = Semaphore()
+        self._reader = None
+
+    def connect(self):
+        # 并发的第一批请求只有一个去建连接, 其余等待
+        with self._connect_lock:
+            if self.sock is not None or self.closed:
+                return
+
+            try:
+                sock = socket.create_connection(
+                    self.address, self.connect_timeout)
+            except socket.error:
+                self.close()
+                raise
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = sock
+            self._reader = gevent.spawn(self._run, sock.makefile('rb'))
+
+    def call(self, method, params=None, context=None, timeout=None):
+        """连接或发送失败抛出 socket.error, 请求一定没有发出, 可以换地址重试
+        """
+        if self.sock is None:
+            self.connect()
+        if self.closed:
+            raise socket.error('rpc connection closed')
+
+        self.seq += 1
+        req_id = self.seq
+        body = self.codec.encode({
+            'id': req_id,
+            'method': method,
+            'params': params,
+            'context': context,
+        })[0]
+
+        result = self.pending[req_id] = AsyncResult()
+        try:
+            with self._write_lock:
+                self.sock.sendall(_LENGTH.pack(len(body)) + body)
+        except socket.error:
+            self.pending.pop(req_id, None)
+            self.close()
+            raise
+
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return result.get(timeout=timeout)
+        except Timeout:
+            raise RpcTimeout('rpc {0} timeout after {1}s'.format(
+                method, timeout))
+        finally:
+            self.pending.pop(req_id, None)
+
+    def _run(self, rfile):
+        read = rfile.read
+        decode = self.codec.decode
+        try:
+            while True:
+                head = read(4)
+                if len(head) < 4:
+                    break
+                length, = _LENGTH.unpack(head)
+                if length > MAX_FRAME_SIZE:
+                    log.warning('rpc response too large from %s: %d',
+                                self.address, length)
+                    break
+                body = read(length)
+                if len(body) < length:
+                    break
+
+                response = decode(body, True)
+                result = self.pending.pop(response.get('id'), None)
+                if result is None:
+                    # 已经超时的请求
+                    continue
+
+                error = response.get('error')
+                if error:
+                    if not isinstance(error, dict):
+                        error = {'message': error}
+                    result.set_exception(RpcError(
+                        error.get('message', ''), error.get('code') or 500))
+                else:
+                    result.set(response.get('result'))
+        except (socket.error, ValueError, AttributeError) as e:
+            log.warning('rpc connection to %s broken: %s', self.address, e)
+        finally:
+            rfile.close()
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        if self._reader is not None and self._reader is not gevent.getcurrent():
+            self._reader.kill(block=False)
+
+        # 已经发出的请求不知道是否执行了, 直接返回失败
+        pending, self.pending = self.pending, {}
+        for result in pending.values():
+            result.set_exception(RpcUnavailable(
+                'rpc connection to {0} lost'.format(self.address)))
+
+        if self.on_close is not None:
+            self.on_close(self)
+
+
+class RpcBackend(object):
+    """RPC_SERVERS 里的一个服务, 在多个地址之间轮询和故障转移
+    """
+
+    def __init__(self, name, addr, proto='tcp', pool_size=4, connect_timeout=3,
+                 retry_interval=5):
+        """
+        addr: [{'addr': (host, port), 'timeout': 毫秒}, ...]
+        pool_size: 每个地址的最大连接数
+        retry_interval: 地址连接失败后暂停使用的秒数
+        """
+        if proto != 'tcp':
+            raise ValueError('Unsupported rpc proto: {0}'.format(proto))
+        if not addr:
+            raise ValueError('rpc {0} has no address'.format(name))
+
+        self.name = name
+        self.addresses = [
+            (tuple(item['addr']), item.get('timeout', 30000) / 1000.0)
+            for item in addr]
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+
+        self.pools = [[] for _ in self.addresses]
+        self.down_until = [0] * len(self.addresses)
+        self.next = 0
+        self.rr = 0
+
+    def _connection(self, index):
+        conns = self.pools[index]
+        if len(conns) < self.pool_size:
+            address, timeout = self.addresses[index]
+            conn = RpcConnection(address, timeout, self.connect_timeout,
+                                 on_close=self._remove(index))
+            conns.append(conn)
+            return conn
+
+        self.rr += 1
+        return conns[self.rr % len(conns)]
+
+    def _remove(self, index):
+        conns = self.pools[index]
+
+        def remove(conn):
+            if conn in conns:
+                conns.remove(conn)
+        return remove
+
+    def call(self, method, params=None, context=None):
+        count = len(self.addresses)
+        start = self.next
+        self.next = (start + 1) % count
+
+        last_error = None
+        for i in range(count):
+            index = (start + i) % count
+            if self.down_until[index] > time.monotonic():
+                continue
+
+            try:
+                return self._connection(index).call(method, params, context)
+            except socket.error as e:
+                log.warning('rpc %s address %s failed: %s', self.name,
+                            self.addresses[index][0], e)
+                self.down_until[index] = time.monotonic() + self.retry_interval
+                last_error = e
+
+        raise RpcUnavailable('rpc {0} unavailable: {1}'.format(
+            self.name, last_error or 'all addresses down'))
+
+    def close(self):
+        for conns in self.pools:
+            for conn in list(conns):
+                conn.close()
+
+
+class RpcClients(object):
+    """RPC_SERVERS 配置的所有服务, 按名字懒创建 RpcBackend
+    """
+
+    def __init__(self, servers, **options):
+        """options: RpcBackend 参数, 对所有服务生效
+        """
+        self.servers = servers or {}
+        self.options = options
+        self.backends = {}
+
+    def get(self, name):
+        backend = self.backends.get(name)
+        if backend is None:
+            conf = self.servers.get(name)
+            if conf is None:
+                raise RpcError('unknown rpc {0}'.format(name), 404)
+            options = dict(self.options)
+            options.update(conf)
+            backend = self.backends[name] = RpcBackend(name, **options)
+        return backend
+
+    def call(self, name, method, params=None, context=None):
+        return self.get(name).call(method, params, context)
+
+    def close(self):
+        for backend in self.backends.values():
+            backend.close()
+
+
+class RpcGateway(WebSocketApplication):
+    """按 URL_CONF 转发消息到后端rpc, 同一个连接上的请求并发处理, 谁先返回先发送
+    """
+
+    CODEC = 'json'
+    CONCURRENCY = 64
+    ORDERED = False
+    # 允许匿名连接, 按 URL_CONF 里的 check 逐个url检查
+    AUTH_REQUIRED = False
+
+    URL_CONF = None
+    RPC_SERVERS = None
+    # 转发给后端的握手请求头和cookie
+    ALLOWED_HEADERS = ()
+    ALLOWED_COOKIES = ()
+    # RpcBackend 参数, 如 {'pool_size': 8}
+    RPC_OPTIONS = None
+
+    # 连接的 headers/cookies, 第一条消息时生成
+    context = None
+
+    @classmethod
+    def rpc_clients(cls):
+        """同一个网关类的所有连接共用后端连接池
+        """
+        clients = cls.__dict__.get('_rpc_clients')
+        if clients is None:
+            clients = RpcClients(cls.RPC_SERVERS, **(cls.RPC_OPTIONS or {}))
+            cls._rpc_clients = clients
+        return clients
+
+    @classmethod
+    def route(cls, url):
+        """返回 (rpc名, 方法名, 是否需要登录), 没有配置的url返回None
+        """
+        conf = (cls.URL_CONF or {}).get(url)
+        if conf is None:
+            return None
+
+        parts = url.strip('/').split('/')
+        rpc = conf.get('rpc') or parts[0]
+        method = conf.get('method') or '.'.join(parts[1:])
+        return rpc, method, bool(conf.get('check'))
+
+    def make_context(self):
+        environ = self.ws.environ
+        headers = {}
+        for name in self.ALLOWED_HEADERS:
+            value = environ.get('HTTP_' + name.upper().replace('-', '_'))
+            if value is not None:
+                headers[name] = value
+
+        cookies = {}
+        if self.ALLOWED_COOKIES and environ.get('HTTP_COOKIE'):
+            try:
+                parsed = SimpleCookie(environ['HTTP_COOKIE'])
+            except CookieError:
+                parsed = {}
+            for name in self.ALLOWED_COOKIES:
+                if name in parsed:
+                    cookies[name] = parsed[name].value
+
+        return {'headers': headers, 'cookies': cookies, 'user': self.user}
+
+    def on_message(self, message, *args, **kwargs):
+        if not isinstance(message, dict) or not isinstance(
+                message.get('url'), str):
+            return self.error(None, 400, 'invalid request')
+
+        req_id = message.get('id')
+        target = self.route(message['url'])
+        if target is None:
+            return self.error(req_id, 404, 'unknown url')
+        if target[2] and self.user is None:
+            return self.error(req_id, 401, 'login required')
+
+        if self.context is None:
+            self.context = self.make_context()
+
+        try:
+            result = self.rpc_clients().call(
+                target[0], target[1], message.get('params'), self.context)
+        except RpcError as e:
+            return self.error(req_id, e.code, e.message)
+        return {'id': req_id, 'result': result}
+
+    @staticmethod
+    def error(req_id, code, message):
+        return {'id': req_id, 'error': {'code': code, 'message': message}}
@@ -0,0 +1,319 @@
+"""
+连接发送队列
+~~~~~~~~~~
+默认情况下 WebSocket.send 在调用者的greenlet里直接 sendall, 对端TCP窗口
+满了就会一直阻塞调用者. 开启发送队列后每个连接有一个独立的writer greenlet,
+业务只负责入队, 队列按字节数和消息数限制大小, 超出时按策略处理:
+
+block: 阻塞等待队列有空间, 超过 block_timeout 抛出 SendQueueFull
+drop_oldest: 丢弃最早入队的消息
+drop_newest: 丢弃当前消息
+(开启压缩时两种丢弃策略会让server使用 server_no_context_takeover, 见 WebSocketServer)
+close: 用 close_code(1008/1013) 关闭连接
+
+writer 单次写超过 write_timeout 认为对端卡死, 直接断开连接.
+控制帧(close/ping/pong)不受大小限制, 也不会被丢弃.
+队列里积压多帧时writer一次取出一批合并写出, 减少系统调用.
+
+Coalescer 在写出(或入队)之前合并: 帧先攒在内存里, 超过 max_bytes 或者
+第一帧等待超过 max_delay 秒时一次写出, 见 WebSocket.cork/send_many.
+
+"""
+
+import logging
+
+from collections import deque
+from socket import error
+
+import gevent
+
+from gevent import Timeout
+from gevent import getcurrent
+from gevent.event import Event
+
+from .exceptions import SendQueueFull
+
+log = logging.getLogger()
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+CLOSE = 'close'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, CLOSE)
+
+MSG_QUEUE_CLOSED = "Send queue is closed"
+
+
+def _is_control(header):
+    # 帧第一个字节的opcode >= 0x08 为控制帧
+    return header[0] & 0x08
+
+
+class SendQueue(object):
+
+    __slots__ = ('writev', 'writemany', 'on_close', 'on_abort', 'max_bytes',
+                 'max_messages', 'policy', 'block_timeout', 'close_code',
+                 'write_timeout', 'items', 'size', 'dropped', 'closing', 'dead',
+                 '_ready', '_space', '_writer')
+
+    # writer 一次合并写出的上限
+    BATCH_FRAMES = 64
+    BATCH_BYTES = 64 * 1024
+
+    def __init__(self, writev, on_close, on_abort, max_bytes=1024 * 1024,
+                 max_messages=1024, policy=BLOCK, block_timeout=5,
+                 close_code=1013, write_timeout=30, writemany=None):
+        """
+        writev: 实际写socket的方法 writev(header, payload)
+        on_close: close策略触发时调用 on_close(code) 关闭websocket
+        on_abort: 写超时时调用, 直接断开底层连接
+        writemany: 一次写多帧的方法 writemany([(header, payload)]), 为空时逐帧写
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown send queue policy: {0}'.format(policy))
+
+        self.writev = writev
+        self.writemany = writemany
+        self.on_close = on_close
+        self.on_abort = on_abort
+
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.close_code = close_code
+        self.write_timeout = write_timeout
+
+        self.items = deque()
+        self.size = 0
+        self.dropped = 0
+
+        # closing: 不再接收新消息 发完队列后writer退出
+        # dead: 写失败或超时 队列作废
+        self.closing = False
+        self.dead = False
+
+        self._ready = Event()
+        self._space = Event()
+        self._writer = gevent.spawn(self._run)
+
+    def _full(self, length):
+        # 队列为空时超大的单条消息也允许入队, 否则永远发不出去
+        if not self.items:
+            return False
+        return (len(self.items) >= self.max_messages or
+                self.size + length > self.max_bytes)
+
+    def put(self, header, payload=b''):
+        """入队一帧, header 为帧头(或完整的帧), payload 不会被拷贝
+        """
+        if self.dead or self.closing:
+            raise error(MSG_QUEUE_CLOSED)
+
+        length = len(header) + len(payload)
+
+        if not _is_control(header) and self._full(length):
+            policy = self.policy
+
+            if policy == BLOCK:
+                self._wait_space(length)
+
+            elif policy == DROP_OLDEST:
+                self._drop_oldest(length)
+
+            elif policy == DROP_NEWEST:
+                self.dropped += 1
+                log.debug('send queue full, drop newest message')
+                return
+
+            else:
+                log.warning('send queue full, close connection with %s',
+                            self.close_code)
+                # 积压的消息对端已经收不动了 直接丢弃, 让close帧尽快发出
+                self._discard()
+                self.on_close(self.close_code)
+                return
+
+        self.items.append((header, payload, length))
+        self.size += length
+        self._ready.set()
+
+    def put_many(self, frames):
+        for header, payload in frames:
+            self.put(header, payload)
+
+    def _wait_space(self, length):
+        with Timeout(self.block_timeout, False):
+            while self._full(length):
+                self._space.clear()
+                self._space.wait()
+                if self.dead or self.closing:
+                    raise error(MSG_QUEUE_CLOSED)
+
+        if self._full(length):
+            raise SendQueueFull('Send queue is full')
+
+    def _drop_oldest(self, length):
+        items = self.items
+        kept = []
+
+        # 取出的控制帧还要放回队列, 仍然计入消息数
+        while items and (len(items) + len(kept) >= self.max_messages or
+                         self.size + length > self.max_bytes):
+            item = items.popleft()
+            if _is_control(item[0]):
+                kept.append(item)
+                continue
+            self.size -= item[2]
+            self.dropped += 1
+
+        items.extendleft(reversed(kept))
+        log.debug('send queue full, dropped=%d', self.dropped)
+
+    def _discard(self):
+        self.dropped += len(self.items)
+        self.items.clear()
+        self.size = 0
+
+    def _run(self):
+        items = self.items
+        while True:
+            while not items:
+                if self.closing:
+                    return
+                self._ready.clear()
+                self._ready.wait()
+
+            header, payload, length = items.popleft()
+            self.size -= length
+
+            batch = None
+            if items and self.writemany is not None:
+                batch = [(header, payload)]
+                batch_size = length
+                while items and len(batch) < self.BATCH_FRAMES and \
+                        batch_size < self.BATCH_BYTES:
+                    header, payload, length = items.popleft()
+                    self.size -= length
+                    batch_size += length
+                    batch.append((header, payload))
+
+            self._space.set()
+
+            timeout = Timeout(self.write_timeout)
+            timeout.start()
+            try:
+                if batch is None:
+                    self.writev(header, payload)
+                else:
+                    self.writemany(batch)
+            except Timeout as e:
+                if e is not timeout:
+                    raise
+                log.warning('write timeout after %ss, abort connection',
+                            self.write_timeout)
+                self._abort()
+                return
+            except error:
+                self._abort()
+                return
+            finally:
+                timeout.close()
+
+    def _abort(self):
+        self.dead = True
+        self._discard()
+        self._space.set()
+        try:
+            self.on_abort()
+        except error:
+            pass
+
+    def close(self):
+        """不再接收新消息, writer发完已入队的消息后退出
+        """
+        self.closing = True
+        self._ready.set()
+        self._space.set()
+
+    def join(self, timeout=None):
+        """等待writer退出, 超时则断开连接
+        """
+        if timeout is None:
+            timeout = self.write_timeout
+
+        self._writer.join(timeout)
+        if not self._writer.dead:
+            self._writer.kill()
+            self._abort()
+
+
+class Coalescer(object):
+    """合并写, 替换 WebSocket 的 raw_write/raw_writev
+    帧先放进列表, 攒够 max_bytes 或者第一帧等了 max_delay 秒后一次写出;
+    控制帧连同之前攒下的数据立即写出. max_delay 为 None 时只在 flush 时写出
+    """
+
+    __slots__ = ('writemany', 'on_abort', 'max_bytes', 'max_delay',
+                 'frames', 'size', 'depth', '_timer')
+
+    MAX_BYTES = 64 * 1024
+    MAX_DELAY = 0.005
+
+    def __init__(self, writemany, on_abort, max_bytes=MAX_BYTES,
+                 max_delay=MAX_DELAY):
+        """
+        writemany: 实际写出的方法 writemany([(header, payload)])
+        on_abort: 定时写出失败时调用, 断开底层连接
+        """
+        self.writemany = writemany
+        self.on_abort = on_abort
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self.frames = []
+        self.size = 0
+        # 嵌套的 cork 层数, 常驻合并时为1不会被解除
+        self.depth = 0
+        self._timer = None
+
+    def put(self, header, payload=b''):
+        self.frames.append((header, payload))
+        self.size += len(header) + len(payload)
+
+        if _is_control(header) or self.size >= self.max_bytes:
+            self.flush()
+        elif self._timer is None and self.max_delay is not None:
+            self._timer = gevent.spawn_later(self.max_delay, self._expire)
+
+    def flush(self):
+        self._cancel()
+
+        frames = self.frames
+        if not frames:
+            return
+        self.frames = []
+        self.size = 0
+        self.writemany(frames)
+
+    def _cancel(self):
+        timer = self._timer
+        if timer is not None:
+            self._timer = None
+            if timer is not getcurrent():
+                timer.kill(block=False)
+
+    def _expire(self):
+        self._timer = None
+        try:
+            self.flush()
+        except error:
+            # 没有调用者可以处理异常, 断开连接让读greenlet退出
+            log.debug('coalesced write failed, abort connection')
+            self.on_abort()
+
+    def close(self):
+        self._cancel()
+        self.frames = []
+        self.size = 0
@@ -22,14 +22,33 @@ websocket 报文协议
 
 """
 
-import struct
+import zlib
+import codecs
 import logging
+import time
 
+from contextlib import contextmanager
 from socket import error
+from socket import SHUT_RDWR
+
+from gevent.lock import Semaphore
 
 from .exceptions import ProtocolError
 from .exceptions import WebSocketError
 from .exceptions import FrameTooLargeException
+from .exceptions import SendQueueFull
+from .mask import mask_payload
+from .deflate import EMPTY_BLOCK
+from .protocol import Header
+from .protocol import MessageParser
+from .protocol import encode_bytes
+from .protocol import encode_close
+from .protocol import encode_frame
+from .protocol import encode_payload
+from .protocol import is_valid_close_code
+from .protocol import parse_close
+from .sender import SendQueue
+from .sender import Coalescer
 
 log = logging.getLogger()
 
@@ -39,9 +58,23 @@ MSG_ALREADY_CLOSED = "Connection is already closed"
 MSG_CLOSED = "Connection closed"
 
 
+class _NullApp(object):
+    """没有 current_app 时使用, 避免每次关闭都临时创建类
+    """
+
+    def on_close(self, *args):
+        pass
+
+
+_NULL_APP = _NullApp()
+
+
 class WebSocket(object):
 
-    __slots__ = ('environ', 'closed', 'stream', 'raw_write', 'raw_read', 'handler')
+    __slots__ = ('environ', 'closed', 'stream', 'raw_write', 'raw_writev',
+                 'raw_read', 'handler', 'deflate', 'send_queue', 'reader',
+                 'max_frame_size', 'max_message_size', 'last_active', 'metrics',
+                 'coalescer', 'parser')
 
     OPCODE_CONTINUATION = 0x00  # 附加数据帧
     OPCODE_TEXT = 0x01  # 文本数据帧 utf-8编码
@@ -50,14 +83,39 @@ class WebSocket(object):
     OPCODE_PING = 0x09 # ping
     OPCODE_PONG = 0x0a # pong
 
-    def __init__(self, environ, stream, handler):
+    def __init__(self, environ, stream, handler, deflate=None,
+                 max_frame_size=None, max_message_size=None, metrics=None):
         self.environ = environ
         self.closed = False
 
+        # 单帧和单条消息的大小限制, 超过时在读payload之前以1009关闭连接
+        self.max_frame_size = max_frame_size
+        self.max_message_size = max_message_size
+
+        # 握手协商成功的 permessage-deflate 上下文
+        self.deflate = deflate
+
+        # 收到的帧的协议检查, 和asyncio后端的 protocol.Connection 相同
+        self.parser = MessageParser(deflate, max_frame_size, max_message_size)
+
+        # metrics.WebSocketMetrics, 统计收发的帧数和字节数
+        self.metrics = metrics
+
+        # 开启发送队列后由writer greenlet负责写socket
+        self.send_queue = None
+
+        # 合并写, 见 cork/coalesce
+        self.coalescer = None
+
         self.stream = stream
 
         self.raw_write = stream.write
+        self.raw_writev = stream.writev
         self.raw_read = stream.read
+        self.reader = FrameReader(stream.read_into, data=stream.take_pending())
+
+        # 最后一次收到数据帧的时间(time.monotonic), 心跳用来判断空闲
+        self.last_active = time.monotonic()
 
         self.handler = handler
 
@@ -68,6 +126,87 @@ class WebSocket(object):
             # close() may fail if __init__ didn't complete
             pass
 
+    def start_send_queue(self, **options):
+        """开启发送队列, 之后所有帧都经过队列由writer greenlet发送
+        options 参考 SendQueue
+        """
+        stream = self.stream
+        self.send_queue = SendQueue(
+            stream.writev, self.close, stream.shutdown,
+            writemany=stream.writemany, **options)
+        self.raw_write = self.send_queue.put
+        self.raw_writev = self.send_queue.put
+
+    def _start_coalescing(self, **options):
+        if self.send_queue is not None:
+            writemany = self.send_queue.put_many
+        else:
+            writemany = self.stream.writemany
+
+        coalescer = self.coalescer = Coalescer(
+            writemany, self.stream.shutdown, **options)
+        self.raw_write = coalescer.put
+        self.raw_writev = coalescer.put
+        return coalescer
+
+    def _stop_coalescing(self):
+        self.coalescer = None
+        if self.send_queue is not None:
+            self.raw_write = self.send_queue.put
+            self.raw_writev = self.send_queue.put
+        else:
+            self.raw_write = self.stream.write
+            self.raw_writev = self.stream.writev
+
+    def coalesce(self, **options):
+        """常驻的合并写, 之后发送的帧攒够 max_bytes 或等待 max_delay 秒后
+        一次写出, 用小的延迟换更少的系统调用和TCP包. options 参考 Coalescer
+        """
+        if self.coalescer is None:
+            self._start_coalescing(**options)
+        self.coalescer.depth += 1
+
+    @contextmanager
+    def cork(self, **options):
+        """with块内发送的帧(包括其他greenlet发给该连接的)攒在一起,
+        退出时一次写出; 中途超过 max_bytes/max_delay 也会提前写出
+
+            with ws.cork():
+                for update in updates:
+                    ws.send(update)
+
+        """
+        coalescer = self.coalescer
+        if coalescer is None:
+            coalescer = self._start_coalescing(**options)
+        coalescer.depth += 1
+
+        try:
+            yield
+        finally:
+            coalescer.depth -= 1
+            if not coalescer.depth and not self.closed:
+                self._stop_coalescing()
+            # 出错时也要把已经攒下的帧写出, 异常继续往上抛
+            self._flush(coalescer)
+
+    def flush(self):
+        """立即写出合并写攒下的帧
+        """
+        if self.coalescer is not None:
+            self._flush(self.coalescer)
+
+    def _flush(self, coalescer):
+        if self.closed:
+            return
+
+        try:
+            coalescer.flush()
+        except WebSocketError:
+            raise
+        except error:
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
     def _decode_bytes(self, bytestring):
         if not bytestring:
             return ''
@@ -79,151 +218,248 @@ class WebSocket(object):
 
             raise
 
-    def _encode_bytes(self, text):
-        if not isinstance(text, str):
-            text = str(text or '')
-
-        return text.encode("utf-8")
+    _encode_bytes = staticmethod(encode_bytes)
 
     def _is_valid_close_code(self, code):
         """验证关闭close码是否正确
         """
-        if code < 1000:
-            return False
-
-        if 1004 <= code <= 1006:
-            return False
-
-        if 1012 <= code <= 1016:
-            return False
-
-        if code == 1100:
-            return False
-
-        if 2000 <= code <= 2999:
-            return False
-
-        return True
+        return is_valid_close_code(code)
 
     @property
     def current_app(self):
-        if hasattr(self.handler.server.application, 'current_app'):
-            return self.handler.server.application.current_app
-        else:
-            class MockApp():
-                def on_close(self, *args):
-                    pass
-
-            return MockApp()
+        app = getattr(self.handler.server.application, 'current_app', None)
+        return app if app is not None else _NULL_APP
 
     def handle_close(self, header, payload):
-        if not payload:
+        # reason 不是utf-8时抛出 UnicodeDecodeError, 以1007关闭
+        code, reason = parse_close(payload)
+        if code is None:
             self.close(1000, None)
-
             return
-
-        if len(payload) < 2:
-            raise ProtocolError('Invalid close frame: {0} {1}'.format(
-                header, payload))
-
-        code = struct.unpack('!H', payload[:2])[0]
-        payload = payload[2:]
-
-        if payload:
-            # 如果发送close 信息 肯定是uft编码
-            self._decode_bytes(payload)
-
-        # 判断close码是否正确
-        if not self._is_valid_close_code(code):
-            raise ProtocolError('Invalid close code {0}'.format(code))
-        self.close(code, payload)
+        self.close(code, reason)
 
     def handle_ping(self, header, payload):
         self.send_frame(payload, self.OPCODE_PONG)
 
     def handle_pong(self, header, payload):
-        pass
+        heartbeat = getattr(self.handler.server, 'heartbeat', None)
+        if heartbeat is None:
+            return
 
-    def read_frame(self):
+        client = self.handler.server.clients.get(self.handler.client_address)
+        if client is not None:
+            heartbeat.on_pong(client, payload)
 
-        header = Header.decode_header(self.stream)
+    def read_header(self):
+        """读取帧头, 在读payload之前检查
+        """
+        header = self.reader.read_header()
+        if self.metrics is not None:
+            self.metrics.frame_received(header.opcode, header.length)
+
+        self.parser.check_header(header)
+        if header.opcode < 0x08:
+            self.last_active = time.monotonic()
+        return header
 
-        # 不处理rsv 信息
-        if header.flags:
-            raise ProtocolError
+    def read_frame(self):
+        header = self.read_header()
 
         # 没有长度
         if not header.length:
             return header, b''
 
-        try:
-            payload = self.raw_read(header.length)
-        except error:
-            payload = b''
-        except Exception:
-            # TODO log out this exception
-            payload = b''
-
-        if len(payload) != header.length:
-            raise WebSocketError('Unexpected EOF reading frame payload')
+        payload = self.reader.read_payload(header.length)
 
+        # payload 可能是读缓冲区的视图, 下次读取前必须转成独立的bytes
         if header.mask:
             payload = header.unmask_payload(payload)
+        else:
+            payload = bytes(payload)
 
         return header, payload
 
     def read_message(self):
-        opcode = None
-        message = bytearray()
+        result = self.read_raw_message()
+        if result is None:
+            return None
+
+        binary, message = result
+        if binary:
+            return message
+        return self._decode_bytes(message)
+
+    def _handle_control(self, header, payload):
+        """处理控制帧, 收到close帧返回True
+        """
+        f_opcode = header.opcode
+        if f_opcode == self.OPCODE_PING:
+            self.handle_ping(header, payload)
+        elif f_opcode == self.OPCODE_PONG:
+            self.handle_pong(header, payload)
+        else:
+            self.handle_close(header, payload)
+            return True
+        return False
+
+    def read_raw_message(self):
+        """返回 (binary, payload), 文本消息不做utf-8解码, 收到close帧返回None
+        """
+        parser = self.parser
+        message = None
         while True:
             header, payload = self.read_frame()
-            log.debug('opcode:%s|payload:%s', header.opcode, payload)
-            f_opcode = header.opcode
-
-            if f_opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY):
-                # TODO shusheng 2022-03-26 理论上读一次就行了 这里做了特殊判断 
-                if opcode:
-                    raise ProtocolError("The opcode in non-fin frame is "
-                                        "expected to be zero, got "
-                                        "{0!r}".format(f_opcode))
-                opcode = f_opcode
-
-            elif f_opcode == self.OPCODE_CONTINUATION:
-                if not opcode:
-                    raise ProtocolError("Unexpected frame with opcode=0")
-
-            elif f_opcode == self.OPCODE_PING:
-                self.handle_ping(header, payload)
+
+            if parser.begin(header):
+                if self._handle_control(header, payload):
+                    return
                 continue
 
-            elif f_opcode == self.OPCODE_PONG:
-                self.handle_pong(header, payload)
+            # 单帧消息直接使用payload, 分片消息才需要拼接
+            if message is None:
+                message = payload if header.fin else bytearray(payload)
+            else:
+                message += payload
+
+            done = parser.end(header)
+            if done is not None:
+                break
+
+        binary, compressed = done
+        if compressed:
+            message = self.deflate.decompress(message, self.max_message_size)
+        return binary, message
+
+    def _iter_message(self):
+        """逐块读取一条消息, 返回 (opcode, chunk), 消息结束时chunk为None
+        控制帧在内部处理, 收到close帧时直接结束
+        """
+        reader = self.reader
+        parser = self.parser
+        opcode = None
+        inflater = None
+        inflated = 0
+
+        while True:
+            header = self.read_header()
+
+            if parser.begin(header):
+                payload = reader.read_payload(header.length) if header.length else b''
+                if header.mask:
+                    payload = header.unmask_payload(payload)
+                else:
+                    payload = bytes(payload)
+
+                if self._handle_control(header, payload):
+                    return
                 continue
 
-            elif f_opcode == self.OPCODE_CLOSE:
-                self.handle_close(header, payload)
+            if opcode is None:
+                opcode = header.opcode
+                if parser.compressed:
+                    inflater = self.deflate.decompressor()
+
+            mask = header.mask
+            offset = 0
+            for view in reader.iter_payload(header.length):
+                chunk = mask_payload(mask, view, offset) if mask else bytes(view)
+                offset += len(view)
+
+                if inflater is None:
+                    yield opcode, chunk
+                    continue
+
+                for chunk in self._inflate(inflater, chunk):
+                    inflated += len(chunk)
+                    self._check_inflated(inflated)
+                    yield opcode, chunk
+
+            if parser.end(header) is not None:
+                if inflater is not None:
+                    for chunk in self._inflate(inflater, EMPTY_BLOCK):
+                        inflated += len(chunk)
+                        self._check_inflated(inflated)
+                        yield opcode, chunk
+                yield opcode, None
                 return
 
-            else:
-                raise ProtocolError("Unexpected opcode={0!r}".format(f_opcode))
-            message += payload
-            if header.fin:
-                break
-        if opcode == self.OPCODE_TEXT:
-            return self._decode_bytes(message)
-        else:
-            return message
+    def _inflate(self, inflater, data):
+        # 限制每次解压输出的大小, 避免一小块数据解压出大量内存
+        try:
+            while data:
+                chunk = inflater.decompress(data, FrameReader.BUFFER_SIZE)
+                data = inflater.unconsumed_tail
+                if chunk:
+                    yield chunk
+        except zlib.error as e:
+            raise ProtocolError('Invalid compressed message: {0}'.format(e))
+
+    def _check_inflated(self, size):
+        if self.max_message_size is not None and size > self.max_message_size:
+            raise FrameTooLargeException(
+                'Message exceeds max_message_size {0}'.format(
+                    self.max_message_size))
+
+    def receive_stream(self):
+        """流式接收一条消息, 数据到达后立即返回, 不在内存里拼接整条消息
+        文本消息返回增量解码的str块, 二进制消息返回bytes块
+
+            for chunk in ws.receive_stream():
+                f.write(chunk)
+
+        对端在消息开始前关闭连接时直接结束(ws.closed 为True),
+        消息传输到一半出错时关闭连接并抛出 WebSocketError
+        """
+        if self.closed:
+            self.current_app.on_close(MSG_ALREADY_CLOSED)
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        decoder = None
+        started = finished = False
+        try:
+            for opcode, chunk in self._iter_message():
+                started = True
+                end = chunk is None
+                if opcode == self.OPCODE_TEXT:
+                    if decoder is None:
+                        decoder = codecs.getincrementaldecoder('utf-8')()
+                    chunk = decoder.decode(chunk or b'', end)
+                finished = end
+                if chunk:
+                    yield chunk
+        except UnicodeError:
+            self.close(1007)
+        except FrameTooLargeException:
+            self.close(1009)
+        except ProtocolError:
+            self.close(1002)
+        except error:
+            self.close()
+            self.current_app.on_close(MSG_CLOSED)
+
+        if started and not finished:
+            # 消息不完整
+            raise WebSocketError(MSG_CLOSED)
 
     def receive(self):
+        return self._receive(self.read_message)
+
+    def receive_raw(self):
+        """返回 (binary, payload), 由调用者解码, 连接关闭时返回None
+        """
+        return self._receive(self.read_raw_message)
+
+    def _receive(self, read):
         if self.closed:
             self.current_app.on_close(MSG_ALREADY_CLOSED)
             raise WebSocketError(MSG_ALREADY_CLOSED)
 
         try:
-            data = self.read_message()
-            return data
+            return read()
         except UnicodeError:
             self.close(1007)
+        except FrameTooLargeException:
+            self.close(1009)
         except ProtocolError:
             self.close(1002)
         except error:
@@ -231,26 +467,45 @@ class WebSocket(object):
             self.current_app.on_close(MSG_CLOSED)
         return None
 
+    @staticmethod
+    def _encode_payload(message, opcode):
+        return encode_payload(message, opcode)
+
+    @staticmethod
+    def encode_frame(message, binary=None):
+        """编码成完整的数据帧(不压缩), 广播时只编码一次
+        """
+        return encode_frame(message, binary)
+
     def send_frame(self, message, opcode):
         if self.closed:
             self.current_app.on_close(MSG_ALREADY_CLOSED)
             raise WebSocketError(MSG_ALREADY_CLOSED)
 
-        if opcode in (self.OPCODE_TEXT, self.OPCODE_PING):
-            message = self._encode_bytes(message)
-        elif opcode == self.OPCODE_BINARY:
-            message = bytes(message)
+        message = self._encode_payload(message, opcode)
 
-        header = Header.encode_header(True, opcode, b'', len(message), 0)
+        flags = 0
+        deflate = self.deflate
+        if deflate is not None and opcode in (self.OPCODE_TEXT, self.OPCODE_BINARY) \
+                and deflate.should_compress(len(message)):
+            message = deflate.compress(message)
+            flags = Header.RSV0_MASK
+
+        header = Header.encode_header(True, opcode, b'', len(message), flags)
+        if self.metrics is not None:
+            self.metrics.frame_sent(opcode, len(message))
 
         try:
-            self.raw_write(header + message)
+            self.raw_writev(header, message)
+        except WebSocketError:
+            raise
         except error:
             raise WebSocketError(MSG_SOCKET_DEAD)
-        except:
-            raise
 
     def send(self, message, binary=None):
+        """发送消息, bytes/bytearray/memoryview 不会被拷贝
+        开启发送队列时队列直接引用该buffer, 发送完成前调用者不要修改它
+        """
         if binary is None:
             binary = not isinstance(message, str)
 
@@ -258,16 +513,42 @@ class WebSocket(object):
 
         try:
             self.send_frame(message, opcode)
+        except SendQueueFull:
+            raise
         except WebSocketError:
             self.current_app.on_close(MSG_SOCKET_DEAD)
             raise WebSocketError(MSG_SOCKET_DEAD)
 
+    def send_many(self, messages, binary=None):
+        """发送多条消息, 编码后合并成尽量少的写操作
+        攒下的数据超过 Coalescer.MAX_BYTES 时分批写出
+        """
+        with self.cork(max_delay=None):
+            for message in messages:
+                self.send(message, binary)
+
+    def send_raw(self, frame):
+        """发送encode_frame编码好的帧
+        """
+        if self.closed:
+            raise WebSocketError(MSG_ALREADY_CLOSED)
+
+        if self.metrics is not None:
+            self.metrics.raw_frame_sent(frame)
+
+        try:
+            self.raw_write(frame)
+        except WebSocketError:
+            raise
+        except error:
+            raise WebSocketError(MSG_SOCKET_DEAD)
+
     def close(self, code=1000, message=b''):
         if self.closed:
             self.current_app.on_close(MSG_ALREADY_CLOSED)
 
         try:
-            message = self._encode_bytes(message)
+            message = encode_close(code, message)
 
             self.send_frame(message, opcode=self.OPCODE_CLOSE)
         except WebSocketError:
@@ -277,8 +558,16 @@ class WebSocket(object):
         finally:
             self.closed = True
 
+            if self.coalescer is not None:
+                self.coalescer.close()
+                self.coalescer = None
+
+            if self.send_queue is not None:
+                self.send_queue.close()
+
             self.stream = None
             self.raw_write = None
+            self.raw_writev = None
             self.raw_read = None
 
             self.environ = None
@@ -286,166 +575,273 @@ class WebSocket(object):
 
 class Stream(object):
 
-    __slots__ = ('handler', 'read', 'write')
-
-    def __init__(self, handler):
-        self.handler = handler
-        self.read = handler.rfile.read
-        self.write = handler.socket.sendall
-
-
-class Header(object):
-    __slots__ = ('fin', 'mask', 'opcode', 'flags', 'length')
-
-    FIN_MASK = 0x80
-    OPCODE_MASK = 0x0f
-    MASK_MASK = 0x80
-    LENGTH_MASK = 0x7f
-
-    RSV0_MASK = 0x40
-    RSV1_MASK = 0x20
-    RSV2_MASK = 0x10
-
-    HEADER_FLAG_MASK = RSV0_MASK | RSV1_MASK | RSV2_MASK
+    __slots__ = ('handler', 'read_into', 'pending', 'sendall', 'sendmsg',
+                 'lock')
 
-    def __init__(self, fin=0, opcode=0, flags=0, length=0):
-        self.mask = ''
-        self.fin = fin
-        self.opcode = opcode
-        self.flags = flags
-        self.length = length
+    # payload 小于这个长度时拼接后一次sendall, 拷贝比分散写更划算
+    WRITEV_THRESHOLD = 8 * 1024
 
-    def mask_payload(self, payload):
-        payload = bytearray(payload)
-        mask = bytearray(self.mask)
+    # sendmsg 单次最多的buffer数(linux UIO_MAXIOV)
+    IOV_MAX = 1024
 
-        for i in range(self.length):
-            payload[i] ^= mask[i % 4]
+    def __init__(self, handler):
+        self.handler = handler
+        # 握手之后直接从socket读, 最多一次recv
+        self.read_into = handler.socket.recv_into
+        # rfile 在握手时可能多读了客户端紧接着发来的数据
+        self.pending = self._detach(handler)
+        self.sendall = handler.socket.sendall
+        self.sendmsg = getattr(handler.socket, 'sendmsg', None)
+        # 广播和业务greenlet会同时写同一个连接, 整帧写完才释放, 避免帧交错
+        self.lock = Semaphore()
+
+    @staticmethod
+    def _detach(handler):
+        """取出rfile里已经缓冲的数据后关闭rfile, 每个连接省下它的读缓冲区
+        """
+        rfile = handler.rfile
+        sock = handler.socket
+        timeout = sock.gettimeout()
+        # 非阻塞peek: 有缓冲时直接返回, 没有时最多一次不等待的recv
+        sock.settimeout(0.0)
+        try:
+            data = rfile.peek()
+        except error:
+            data = b''
+        finally:
+            sock.settimeout(timeout)
+        if data:
+            data = rfile.read(len(data))
 
-        return payload
+        rfile.close()
+        return data
 
-    unmask_payload = mask_payload
+    def take_pending(self):
+        pending, self.pending = self.pending, b''
+        return pending
 
-    @classmethod
-    def decode_header(cls, stream):
-        """
-        0                   1                   2                   3
-        0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
-        +-+-+-+-+-------+-+-------------+-------------------------------+
-        |F|R|R|R| opcode|M| Payload len |    Extended payload length    |
-        |I|S|S|S|  (4)  |A|     (7)     |             (16/64)           |
-        |N|V|V|V|       |S|             |   (if payload len==126/127)   |
-        | |1|2|3|       |K|             |                               |
-        +-+-+-+-+-------+-+-------------+ - - - - - - - - - - - - - - - +
-        |     Extended payload length continued, if payload len == 127  |
-        + - - - - - - - - - - - - - - - +-------------------------------+
-        |                               |Masking-key, if MASK set to 1  |
-        +-------------------------------+-------------------------------+
-        | Masking-key (continued)       |          Payload Data         |
-        +-------------------------------- - - - - - - - - - - - - - - - +
-        :                     Payload Data continued ...                :
-        + - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - +
-        |                     Payload Data continued ...                |
-        +---------------------------------------------------------------+
+    def read(self, size):
+        """读满size字节或者到EOF为止, 和 rfile.read 相同
         """
-        read = stream.read
-        # 读前两个字节  16bit
-        data = read(2)
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        count = len(self.pending)
+        if count:
+            count = min(count, size)
+            view[:count] = self.pending[:count]
+            self.pending = self.pending[count:]
+
+        while count < size:
+            received = self.read_into(view[count:])
+            if not received:
+                break
+            count += received
+        return bytes(view[:count])
 
-        if len(data) != 2:
-            raise WebSocketError("Unexpected EOF while decoding header")
+    def write(self, data):
+        with self.lock:
+            self.sendall(data)
 
-        first_byte, second_byte = struct.unpack('!BB', data)
+    def writev(self, header, payload=b''):
+        """帧头和payload分开写, 大payload通过sendmsg避免拼接拷贝
+        """
+        with self.lock:
+            if len(payload) < self.WRITEV_THRESHOLD or self.sendmsg is None:
+                self.sendall(header + payload)
+                return
 
-        header = cls(
-            fin=first_byte & cls.FIN_MASK == cls.FIN_MASK,  # fin 为1 代表结束
-            opcode=first_byte & cls.OPCODE_MASK,   # 获取opcode
-            flags=first_byte & cls.HEADER_FLAG_MASK, # 获取rsv 操作信息
-            length=second_byte & cls.LENGTH_MASK) # 获取payload len 数值
+            self._sendmsg([memoryview(header), memoryview(payload)])
 
-        has_mask = second_byte & cls.MASK_MASK == cls.MASK_MASK # 判断是否对payloadData 进行掩码处理
+    def writemany(self, frames):
+        """一次写出多帧 frames: [(header, payload)]
+        小帧拼成一个buffer sendall, 有大payload时用sendmsg分散写
+        """
+        buffers = []
+        large = False
+        for header, payload in frames:
+            buffers.append(header)
+            if payload:
+                buffers.append(payload)
+                if len(payload) >= self.WRITEV_THRESHOLD:
+                    large = True
+
+        with self.lock:
+            if not large or self.sendmsg is None:
+                self.sendall(b''.join(buffers))
+                return
 
-        # 0x07 之后都是 连接关闭 ping pong 所以都是fin都应该是消息结果 并且length不应该超过125
-        if header.opcode > 0x07:
-            if not header.fin:
-                raise ProtocolError(
-                    "Received fragmented control frame: {0!r}".format(data))
+            self._sendmsg([memoryview(b) for b in buffers])
+
+    def _sendmsg(self, buffers):
+        # 处理部分写, 单次最多 IOV_MAX 个buffer
+        start = 0
+        while start < len(buffers):
+            sent = self.sendmsg(buffers[start:start + self.IOV_MAX])
+            while sent:
+                first = len(buffers[start])
+                if sent < first:
+                    buffers[start] = buffers[start][sent:]
+                    break
+                sent -= first
+                start += 1
+
+    def shutdown(self):
+        """断开底层连接, 阻塞在读上的greenlet会立即收到EOF
+        """
+        try:
+            self.handler.socket.shutdown(SHUT_RDWR)
+        except (error, AttributeError):
+            pass
 
-            # Control frames MUST have a payload length of 125 bytes or less
-            if header.length > 125:
-                raise FrameTooLargeException(
-                    "Control frame cannot be larger than 125 bytes: "
-                    "{0!r}".format(data))
 
-        # 如果126 读取后2个字节为长度
-        if header.length == 126:
-            data = read(2)
+# 读缓冲区的空闲列表, 读空的缓冲区放回这里, 收到数据时再取
+_BUFFER_POOL = []
 
-            if len(data) != 2:
-                raise WebSocketError('Unexpected EOF while decoding header')
 
-            # 获取无符号整形数字
-            header.length = struct.unpack('!H', data)[0]
-        # 如果126 读取后8个字节为长度
-        elif header.length == 127:
-            # 64 bit length
-            data = read(8)
+class FrameReader(object):
+    """带缓冲的帧解析
+    一次尽量读入一大块数据到复用的缓冲区, 缓冲区里已有的完整帧直接解析,
+    不再逐个字段调用read; 返回的payload是缓冲区的视图, 下次读取前有效
 
-            if len(data) != 8:
-                raise WebSocketError('Unexpected EOF while decoding header')
+    缓冲区读空后放回空闲列表, 阻塞等待数据时读进进程共用的 _IDLE_VIEW,
+    空闲连接不占用读缓冲区. read_into 返回之后到拷贝出数据之间没有greenlet
+    切换, 所以共用一块内存是安全的
+    """
 
-            # 获取无符号长整形数字
-            header.length = struct.unpack('!Q', data)[0]
+    __slots__ = ('read_into', 'size', 'buffer', 'view', 'start', 'end',
+                 'header')
 
-        if has_mask:
-            mask = read(4)
+    # 超过缓冲区大小的帧单独分配内存直接读入
+    BUFFER_SIZE = 16 * 1024
 
-            if len(mask) != 4:
-                raise WebSocketError('Unexpected EOF while decoding header')
+    # 空闲列表最多保留的缓冲区个数
+    POOL_SIZE = 256
 
-            header.mask = mask
+    def __init__(self, read_into, buffer_size=None, data=b''):
+        """data: 已经读到的数据(握手时rfile里剩下的)
+        """
+        self.read_into = read_into
+        self.size = max(buffer_size or self.BUFFER_SIZE, len(data))
+        self.buffer = None
+        self.view = None
+        # [start, end) 为已读入未解析的数据
+        self.start = 0
+        self.end = 0
+        # 每帧复用同一个Header对象
+        self.header = Header()
+
+        if data:
+            self._acquire()
+            self.end = len(data)
+            self.view[:self.end] = data
+
+    def _acquire(self):
+        if self.size == FrameReader.BUFFER_SIZE and _BUFFER_POOL:
+            self.buffer, self.view = _BUFFER_POOL.pop()
+        else:
+            self.buffer = bytearray(self.size)
+            self.view = memoryview(self.buffer)
+
+    def _release(self):
+        if self.size == FrameReader.BUFFER_SIZE and \
+                len(_BUFFER_POOL) < self.POOL_SIZE:
+            _BUFFER_POOL.append((self.buffer, self.view))
+        self.buffer = None
+        self.view = None
+        self.start = 0
+        self.end = 0
+
+    def _wait(self):
+        """缓冲区已经读空, 不持有缓冲区阻塞等待下一批数据
+        """
+        if self.buffer is not None:
+            self._release()
+
+        idle = _IDLE_VIEW
+        if self.size < len(idle):
+            idle = idle[:self.size]
+        count = self.read_into(idle)
+        if not count:
+            raise WebSocketError('Unexpected EOF while reading frame')
+
+        self._acquire()
+        self.view[:count] = idle[:count]
+        self.end = count
+
+    def _fill(self, size):
+        """保证缓冲区里至少有size字节未解析的数据
+        """
+        available = self.end - self.start
+        if available >= size:
+            return
 
-        return header
+        if not available:
+            self._wait()
+        elif self.start + size > self.size:
+            # 尾部空间不够, 未解析的数据移到缓冲区开头
+            self.buffer[:available] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = available
+
+        read_into = self.read_into
+        view = self.view
+        while self.end - self.start < size:
+            count = read_into(view[self.end:])
+            if not count:
+                raise WebSocketError('Unexpected EOF while reading frame')
+            self.end += count
+
+    def read_header(self):
+        if self.end - self.start < 2:
+            self._fill(2)
+        size = Header.size(self.buffer, self.start)
+        if self.end - self.start < size:
+            # _fill 可能移动了数据
+            self._fill(size)
+
+        start = self.start
+        self.start = start + size
+        return self.header.parse(self.buffer, start, size)
+
+    def read_payload(self, length):
+        if length <= self.size:
+            self._fill(length)
+            start = self.start
+            self.start = start + length
+            if self.start == self.end:
+                self.start = self.end = 0
+            return self.view[start:start + length]
+
+        # 大帧: 已缓冲的部分拷贝过去, 剩下的直接读入
+        payload = bytearray(length)
+        available = self.end - self.start
+        if available:
+            payload[:available] = self.view[self.start:self.end]
+            self.start = self.end = 0
+
+        view = memoryview(payload)
+        read_into = self.read_into
+        while available < length:
+            count = read_into(view[available:])
+            if not count:
+                raise WebSocketError('Unexpected EOF reading frame payload')
+            available += count
 
-    @classmethod
-    def encode_header(cls, fin, opcode, mask, length, flags):
-        first_byte = opcode
-        second_byte = 0
-        extra = b""
-        result = bytearray()
-
-        if fin:
-            first_byte |= cls.FIN_MASK
-
-        if flags & cls.RSV0_MASK:
-            first_byte |= cls.RSV0_MASK
-
-        if flags & cls.RSV1_MASK:
-            first_byte |= cls.RSV1_MASK
-
-        if flags & cls.RSV2_MASK:
-            first_byte |= cls.RSV2_MASK
-
-        # now deal with length complexities
-        if length < 126:
-            second_byte += length
-        elif length <= 0xffff:
-            second_byte += 126
-            extra = struct.pack('!H', length)
-        elif length <= 0xffffffffffffffff:
-            second_byte += 127
-            extra = struct.pack('!Q', length)
-        else:
-            raise FrameTooLargeException
+        return payload
 
-        if mask:
-            second_byte |= cls.MASK_MASK
+    def iter_payload(self, length):
+        """分块读取payload, 每块是缓冲区视图, 大小取决于数据到达情况
+        """
+        while length:
+            if self.start == self.end:
+                self._fill(1)
 
-        result.append(first_byte)
-        result.append(second_byte)
-        result.extend(extra)
+            start = self.start
+            count = min(self.end - start, length)
+            self.start = start + count
+            length -= count
+            yield self.view[start:start + count]
 
-        if mask:
-            result.extend(mask)
 
-        return result
+# 等待数据时共用的读缓冲区
+_IDLE_VIEW = memoryview(bytearray(FrameReader.BUFFER_SIZE))
@@ -1,10 +1,19 @@
 # vim: set ts=4 et sw=4 sts=4 fileencoding=utf-8 :
+"""
+python server.py [workers]
+
+workers 大于1时用 multiproc.Supervisor 启动多个worker进程, 共同监听同一个端口
+(SO_REUSEPORT), publish/broadcast 经主进程的总线转发到所有worker
+"""
+import sys
+
 from gevent import monkey
 monkey.patch_all()
 from zbase3.base.logger import install
 log = install('stdout')
 
 from geventwbs.core import WebSocketApplication, Resource, WebSocketServer
+from geventwbs.multiproc import Supervisor
 
 class EchoApplication(WebSocketApplication):
     def on_open(self):
@@ -17,8 +26,12 @@ class EchoApplication(WebSocketApplication):
         print(reason)
 
 
-server = WebSocketServer(
-    ('0.0.0.0', 8000),
-    application=Resource([('/con/msg', EchoApplication)])
-)
-server.serve_forever()
+ADDRESS = ('0.0.0.0', 8000)
+application = Resource([('/con/msg', EchoApplication)])
+
+workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+if workers > 1:
+    Supervisor(ADDRESS, application, workers=workers).run()
+else:
+    server = WebSocketServer(ADDRESS, application=application)
+    server.serve_forever()
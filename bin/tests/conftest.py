@@ -0,0 +1,116 @@
+"""
+测试公用的server和websocket客户端
+"""
+
+import os
+import base64
+import struct
+
+import pytest
+
+from gevent import socket
+
+from geventwbs.core import WebSocketApplication, WebSocketServer, Resource
+from geventwbs.mask import mask_payload
+
+
+class Echo(WebSocketApplication):
+
+    def on_message(self, message):
+        return message
+
+
+class Client(object):
+    """最简单的websocket客户端, 帧都是手工编码的, 不依赖被测代码的实现
+    """
+
+    def __init__(self, address, path='/echo', headers=(), timeout=5,
+                 early=b''):
+        """early: 和握手请求一起发出的数据(比如第一帧)
+        """
+        self.sock = socket.create_connection(address, timeout=timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+        lines = ['GET {0} HTTP/1.1'.format(path), 'Host: test',
+                 'Upgrade: websocket', 'Connection: Upgrade',
+                 'Sec-WebSocket-Key: ' + key, 'Sec-WebSocket-Version: 13']
+        lines.extend(headers)
+        self.sock.sendall(
+            ('\r\n'.join(lines) + '\r\n\r\n').encode() + early)
+
+        buf = b''
+        while b'\r\n\r\n' not in buf:
+            data = self.sock.recv(4096)
+            if not data:
+                break
+            buf += data
+        head, _, self.buf = buf.partition(b'\r\n\r\n')
+        self.response = head.decode('latin-1')
+        self.status = int(self.response.split(' ', 2)[1])
+
+    @staticmethod
+    def frame(payload, opcode=1, fin=True, rsv=0):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        first = (0x80 if fin else 0) | rsv | opcode
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', first, 0x80 | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', first, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', first, 0x80 | 127, length)
+        key = os.urandom(4)
+        return header + key + bytes(mask_payload(key, payload))
+
+    def send(self, payload, opcode=1, fin=True, rsv=0):
+        self.sock.sendall(self.frame(payload, opcode, fin, rsv))
+
+    def _read(self, size):
+        while len(self.buf) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError
+            self.buf += data
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def recv_frame(self):
+        """返回 (opcode, rsv, fin, payload)
+        """
+        first, second = self._read(2)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        return first & 0x0f, first & 0x70, bool(first & 0x80), \
+            self._read(length)
+
+    def recv(self):
+        """跳过ping/pong, 返回下一个数据帧或close帧的 (opcode, payload)
+        """
+        while True:
+            opcode, _, _, payload = self.recv_frame()
+            if opcode not in (0x9, 0xA):
+                return opcode, payload
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def serve():
+    """serve(apps, **server_options) 启动server, 返回 (server, address)
+    """
+    servers = []
+
+    def start(apps=None, **options):
+        server = WebSocketServer(
+            ('127.0.0.1', 0), Resource(apps or [('/echo', Echo)]), **options)
+        server.start()
+        servers.append(server)
+        return server, ('127.0.0.1', server.server_port)
+
+    yield start
+    for server in servers:
+        server.stop(timeout=1)
@@ -0,0 +1,91 @@
+"""
+访问日志测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import json
+
+import gevent
+
+from geventwbs.accesslog import AccessLog
+from geventwbs.core import WebSocketApplication
+
+from conftest import Client, Echo
+
+
+class Lines(object):
+    """代替logger收集写出的日志行
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def info(self, text):
+        self.lines.extend(json.loads(line) for line in text.split('\n'))
+
+
+class JsonEcho(WebSocketApplication):
+    CODEC = 'json'
+
+    def on_message(self, message):
+        return {'echo': message}
+
+
+class Silent(WebSocketApplication):
+
+    def on_message(self, message):
+        return None
+
+
+def _records(server, count):
+    """等待处理完的消息写出
+    """
+    lines = server.access_log.logger.lines
+    for _ in range(100):
+        server.access_log.flush()
+        if len(lines) >= count:
+            break
+        gevent.sleep(0.01)
+    return lines
+
+
+def test_record_sizes_from_payload():
+    logger = Lines()
+    access_log = AccessLog(logger=logger)
+    access_log.record(('1', '/echo', '127.0.0.1'), '你好', {'a': 1}, 0.001,
+                      '你好'.encode('utf-8'), b'{"a":1}')
+    access_log.record(('2', '/echo', '127.0.0.1'), {'a': 1}, None, 0.001)
+    access_log.flush()
+
+    first, second = logger.lines
+    assert (first['req_size'], first['resp_size']) == (6, 7)
+    assert first['req'] == '你好' and first['resp'] == "{'a': 1}"
+    assert (second['req_size'], second['resp_size']) == (0, 0)
+
+
+def test_sizes_are_wire_bytes(serve):
+    server, address = serve(
+        [('/echo', Echo), ('/json', JsonEcho), ('/silent', Silent)],
+        access_log=AccessLog(logger=Lines()))
+
+    client = Client(address, '/echo')
+    client.send('你好')
+    assert client.recv() == (0x1, '你好'.encode('utf-8'))
+    client.send(b'\x00\x01\x02', opcode=0x2)
+    assert client.recv() == (0x2, b'\x00\x01\x02')
+    client.close()
+
+    client = Client(address, '/json')
+    client.send('[1,2]')
+    opcode, payload = client.recv()
+    client.close()
+
+    client = Client(address, '/silent')
+    client.send('abcd')
+    client.close()
+
+    records = _records(server, 4)
+    sizes = dict(((r['route'], r['req_size']), r['resp_size'])
+                 for r in records)
+    # 文本按utf-8字节数, 解码成对象的请求和编码后的响应按帧长度
+    assert sizes == {('/echo', 6): 6, ('/echo', 3): 3,
+                     ('/json', 5): len(payload), ('/silent', 4): 0}
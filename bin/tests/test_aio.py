@@ -0,0 +1,230 @@
+"""
+asyncio 后端测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import time
+import struct
+import asyncio
+import threading
+
+from geventwbs.core import Resource
+from geventwbs.aio import AsyncWebSocketServer, AsyncWebSocketApplication
+from geventwbs.aio import AsyncSessionAuthenticator
+from geventwbs.auth import MemorySessionStore, SessionAuthenticator
+
+import pytest
+
+from conftest import Client
+
+
+class Echo(AsyncWebSocketApplication):
+
+    async def on_message(self, message, *args, **kwargs):
+        await asyncio.sleep(0)
+        return message
+
+
+class WhoAmI(AsyncWebSocketApplication):
+    CODEC = 'json'
+    AUTH_REQUIRED = False
+
+    def on_message(self, message, *args, **kwargs):
+        return {'user': self.user}
+
+
+class SlowStore(MemorySessionStore):
+    """在线程池里执行的store, 记录调用次数和线程
+    """
+
+    def __init__(self, sessions=None, delay=0, error=None):
+        super(SlowStore, self).__init__(sessions)
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.threads = set()
+
+    def get_user(self, sid):
+        self.calls += 1
+        self.threads.add(threading.get_ident())
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return super(SlowStore, self).get_user(sid)
+
+
+async def _start(apps=None, **options):
+    server = AsyncWebSocketServer(
+        ('127.0.0.1', 0), Resource(apps or [('/echo', Echo)]), **options)
+    await server.start()
+    return server
+
+
+async def _connect(server, path='/echo', headers=()):
+    reader, writer = await asyncio.open_connection(
+        '127.0.0.1', server.server_port)
+    lines = ['GET {0} HTTP/1.1'.format(path), 'Host: test',
+             'Upgrade: websocket', 'Connection: Upgrade',
+             'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==',
+             'Sec-WebSocket-Version: 13']
+    lines.extend(headers)
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1')
+    return reader, writer, int(head.split(' ', 2)[1])
+
+
+async def _stop(server):
+    # 等连接的任务都结束再关闭事件循环
+    for _ in range(100):
+        if not server.clients:
+            break
+        await asyncio.sleep(0.01)
+    server.close()
+
+
+async def _recv(reader):
+    first, second = await reader.readexactly(2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    return first & 0x0f, await reader.readexactly(length)
+
+
+def test_echo_and_close():
+    async def run():
+        server = await _start()
+        reader, writer, status = await _connect(server)
+        assert status == 101
+        assert len(server.clients) == 1
+
+        # 分片的文本消息, 中间夹一个ping
+        writer.write(Client.frame('hel', fin=False))
+        writer.write(Client.frame(b'p', opcode=0x9))
+        writer.write(Client.frame('lo', opcode=0x0))
+        assert await _recv(reader) == (0xA, b'p')
+        assert await _recv(reader) == (0x1, b'hello')
+
+        writer.write(Client.frame(b'\x00\x01', opcode=0x2))
+        assert await _recv(reader) == (0x2, b'\x00\x01')
+
+        writer.write(Client.frame(struct.pack('!H', 1000), opcode=0x8))
+        assert await _recv(reader) == (0x8, struct.pack('!H', 1000))
+        assert await reader.read() == b''
+        writer.close()
+
+        await _stop(server)
+        assert len(server.clients) == 0
+
+    asyncio.run(run())
+
+
+def test_protocol_error_closes_1002():
+    async def run():
+        server = await _start()
+        reader, writer, _ = await _connect(server)
+        writer.write(Client.frame('x', opcode=0x0))
+        assert await _recv(reader) == (0x8, struct.pack('!H', 1002))
+        writer.close()
+        await _stop(server)
+
+    asyncio.run(run())
+
+
+def test_handshake_errors():
+    async def run():
+        server = await _start()
+        _, writer, status = await _connect(server, '/nope')
+        assert status == 404
+        writer.close()
+
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', server.server_port)
+        writer.write(b'GET /echo HTTP/1.1\r\nHost: test\r\n'
+                     b'Upgrade: websocket\r\nConnection: Upgrade\r\n\r\n')
+        head = await reader.readuntil(b'\r\n\r\n')
+        assert head.split(b' ')[1] == b'426'
+        writer.close()
+        await _stop(server)
+
+    asyncio.run(run())
+
+
+def test_auth_runs_store_in_executor():
+    store = SlowStore({'s1': 7}, delay=0.1)
+    auth = AsyncSessionAuthenticator(store)
+    loop_thread = threading.get_ident()
+
+    async def run():
+        server = await _start([('/who', WhoAmI)], auth=auth)
+        cookie = ('Cookie: sessionid=s1',)
+
+        # 查询期间事件循环还在运行
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.get_running_loop().create_task(tick())
+        clients = await asyncio.gather(
+            *[_connect(server, '/who', cookie) for _ in range(5)])
+        ticker.cancel()
+
+        assert [status for _, _, status in clients] == [101] * 5
+        assert store.calls == 1
+        assert loop_thread not in store.threads
+        assert len(ticks) >= 5
+        assert set(server.clients.by_user(7)) == set(server.clients.values())
+
+        reader, writer, _ = clients[0]
+        writer.write(Client.frame('{}'))
+        assert await _recv(reader) == (0x1, b'{"user":7}')
+
+        # 匿名连接
+        reader, writer, status = await _connect(server, '/who')
+        assert status == 101
+        writer.write(Client.frame('{}'))
+        assert await _recv(reader) == (0x1, b'{"user":null}')
+
+        for _, writer, _ in clients:
+            writer.close()
+        writer.close()
+        await _stop(server)
+
+    asyncio.run(run())
+
+
+def test_auth_required_and_unavailable():
+    async def run():
+        server = await _start(auth=AsyncSessionAuthenticator(
+            SlowStore({'s1': 7})))
+        _, writer, status = await _connect(server)
+        assert status == 401
+        writer.close()
+
+        _, writer, status = await _connect(
+            server, headers=('Cookie: sessionid=s1',))
+        assert status == 101
+        writer.close()
+        await _stop(server)
+
+        store = SlowStore(error=IOError('redis down'))
+        server = await _start(auth=AsyncSessionAuthenticator(store))
+        for _ in range(2):
+            _, writer, status = await _connect(
+                server, headers=('Cookie: sessionid=s1',))
+            assert status == 503
+            writer.close()
+        # 出错不缓存
+        assert store.calls == 2
+        await _stop(server)
+
+    asyncio.run(run())
+
+
+def test_sync_session_authenticator_rejected():
+    with pytest.raises(TypeError):
+        AsyncWebSocketServer(('127.0.0.1', 0), Resource([('/echo', Echo)]),
+                             auth=SessionAuthenticator(MemorySessionStore()))
@@ -0,0 +1,141 @@
+"""
+握手鉴权测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import types
+
+import gevent
+import pytest
+
+from geventwbs import auth
+from geventwbs.auth import Authenticator, SessionStore
+from geventwbs.auth import SessionAuthenticator, MemorySessionStore
+from geventwbs.auth import ZbaseSessionStore, AuthUnavailable
+
+
+def _environ(sid):
+    return {'HTTP_COOKIE': 'theme=dark; sessionid={0}; lang=zh'.format(sid)}
+
+
+class CountingStore(MemorySessionStore):
+
+    def __init__(self, sessions=None, delay=0):
+        super(CountingStore, self).__init__(sessions)
+        self.delay = delay
+        self.calls = 0
+
+    def get_user(self, sid):
+        self.calls += 1
+        if self.delay:
+            gevent.sleep(self.delay)
+        return super(CountingStore, self).get_user(sid)
+
+
+class FakeSession(object):
+    """按 zbase3 session 的用法: 构造时传入sid, get 取字段
+    """
+
+    data = {}
+
+    def __init__(self, sid=None, expire=3600, **options):
+        self.options = options
+        self.values = self.data.get(sid) or {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+def test_session_cookie():
+    authenticator = SessionAuthenticator(MemorySessionStore({'s1': 42}))
+    assert authenticator.authenticate(_environ('s1')) == 42
+    assert authenticator.authenticate(_environ('nope')) is None
+    assert authenticator.authenticate({}) is None
+
+
+def test_cache_and_invalidate():
+    store = CountingStore({'s1': 'alice'})
+    authenticator = SessionAuthenticator(store, ttl=60)
+    for _ in range(3):
+        assert authenticator.authenticate(_environ('s1')) == 'alice'
+    assert store.calls == 1
+
+    store.delete('s1')
+    assert authenticator.authenticate(_environ('s1')) == 'alice'
+    authenticator.invalidate('s1')
+    assert authenticator.authenticate(_environ('s1')) is None
+    assert store.calls == 2
+
+
+def test_negative_cache():
+    store = CountingStore()
+    authenticator = SessionAuthenticator(store, negative_ttl=60)
+    assert authenticator.authenticate(_environ('s1')) is None
+    store.set('s1', 'bob')
+    assert authenticator.authenticate(_environ('s1')) is None
+    assert store.calls == 1
+
+
+def test_concurrent_handshakes_share_lookup():
+    store = CountingStore({'s1': 'carol'}, delay=0.05)
+    authenticator = SessionAuthenticator(store)
+    jobs = [gevent.spawn(authenticator.authenticate, _environ('s1'))
+            for _ in range(5)]
+    gevent.joinall(jobs, raise_error=True)
+    assert [job.value for job in jobs] == ['carol'] * 5
+    assert store.calls == 1
+
+
+def test_store_error_not_cached():
+    class BrokenStore(CountingStore):
+        def get_user(self, sid):
+            super(BrokenStore, self).get_user(sid)
+            raise IOError('redis down')
+
+    store = BrokenStore()
+    authenticator = SessionAuthenticator(store)
+    for _ in range(2):
+        with pytest.raises(AuthUnavailable):
+            authenticator.authenticate(_environ('s1'))
+    assert store.calls == 2
+
+
+def test_unhashable_user_rejected():
+    store = MemorySessionStore({'s1': {'userid': 1, 'name': 'x'}})
+    authenticator = SessionAuthenticator(store)
+    assert authenticator.authenticate(_environ('s1')) is None
+
+
+def test_zbase_session_store(monkeypatch):
+    FakeSession.data = {'s1': {'userid': 7, 'name': 'dave'}}
+    monkeypatch.setattr(auth, 'zsession', types.SimpleNamespace(
+        SessionUser=FakeSession, SessionRedis=FakeSession))
+
+    authenticator = SessionAuthenticator.from_config({
+        'store': 'SessionUser',
+        'expire': 100,
+        'cookie_name': 'sessionid',
+        'config': {'redis_conf': {}, 'user_key': 'userid'},
+    })
+    assert authenticator.authenticate(_environ('s1')) == 7
+    assert authenticator.authenticate(_environ('s2')) is None
+
+    # SessionRedis 没有配置 user_key 时也只取用户id
+    store = ZbaseSessionStore.from_config(
+        {'store': 'SessionRedis', 'server': {'host': '127.0.0.1'}})
+    assert store.user_key == 'userid'
+    assert store.get_user('s1') == 7
+
+    with pytest.raises(ValueError):
+        ZbaseSessionStore.from_config({'store': 'SessionNope'})
+
+
+def test_abstract_interfaces():
+    class Store(SessionStore):
+        pass
+
+    class Auth(Authenticator):
+        pass
+
+    for cls in (Store, Auth):
+        with pytest.raises(TypeError):
+            cls()
@@ -0,0 +1,87 @@
+"""
+backplane 测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import gevent
+import pytest
+
+from geventwbs.backplane import Backplane, MemoryBackplane, PUBLISH, BROADCAST
+from geventwbs.backplane import encode_batch, decode_batch
+
+
+class FakeServer(object):
+    """只记录总线投递过来的消息
+    """
+
+    def __init__(self):
+        self.received = []
+
+    def publish_local(self, topic, message, binary=None):
+        self.received.append(('publish', topic, message))
+
+    def broadcast_local(self, message, binary=None):
+        self.received.append(('broadcast', message))
+
+    def send_local(self, address, message, binary=None):
+        self.received.append(('send', address, message))
+
+    def send_user_local(self, user, message, binary=None):
+        self.received.append(('send_user', user, message))
+
+
+def _wait(*servers):
+    with gevent.Timeout(1):
+        while not all(server.received for server in servers):
+            gevent.sleep(0.01)
+
+
+def test_batch_roundtrip():
+    messages = [(PUBLISH, ('room', b'\x00hi', True)),
+                (BROADCAST, ('text', None))]
+    origin, decoded = decode_batch(encode_batch(b'o' * 8, messages))
+    assert origin == b'o' * 8
+    assert decoded == messages
+
+
+def test_two_nodes_receive_each_other():
+    a, b = MemoryBackplane('t1'), MemoryBackplane('t1')
+    sa, sb = FakeServer(), FakeServer()
+    a.attach(sa)
+    b.attach(sb)
+    try:
+        a.publish('room', 'from a')
+        b.broadcast('from b')
+        _wait(sa, sb)
+        assert sb.received == [('publish', 'room', 'from a')]
+        assert sa.received == [('broadcast', 'from b')]
+    finally:
+        a.close()
+        b.close()
+
+
+def test_forked_workers_get_own_origin():
+    # Supervisor 把主进程创建的实例传给每个worker, fork后origin相同
+    worker1, worker2 = MemoryBackplane('t2'), MemoryBackplane('t2')
+    worker2.origin = worker1.origin
+
+    s1, s2 = FakeServer(), FakeServer()
+    worker1.attach(s1)
+    worker2.attach(s2)
+    try:
+        assert worker1.origin != worker2.origin
+        worker1.publish('room', 'w1')
+        worker2.publish('room', 'w2')
+        _wait(s1, s2)
+        assert s1.received == [('publish', 'room', 'w2')]
+        assert s2.received == [('publish', 'room', 'w1')]
+    finally:
+        worker1.close()
+        worker2.close()
+
+
+def test_backplane_requires_write():
+    class Incomplete(Backplane):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,121 @@
+"""
+消息编解码测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import struct
+
+import pytest
+
+from geventwbs import codec
+from geventwbs.codec import Codec, JsonCodec, get_codec
+from geventwbs.core import WebSocketApplication
+
+from conftest import Client
+
+MESSAGE = {'id': 1, 'text': '你好', 'items': [1, 2.5, None, True]}
+
+
+@pytest.mark.parametrize('backend', ['json', 'orjson'])
+def test_json_roundtrip(backend):
+    if backend == 'orjson':
+        pytest.importorskip('orjson')
+    json_codec = JsonCodec(backend)
+    payload, binary = json_codec.encode(MESSAGE)
+    assert isinstance(payload, bytes) and binary is False
+    assert json_codec.decode(payload, binary) == MESSAGE
+
+    with pytest.raises(ValueError):
+        json_codec.decode(b'{"id": ', False)
+    with pytest.raises(ValueError):
+        json_codec.decode(b'\xff', False)
+
+
+def test_raw_roundtrip():
+    raw = get_codec('raw')
+    assert raw.decode('你好'.encode('utf-8'), False) == '你好'
+    assert raw.decode(b'\xff', True) == b'\xff'
+    assert raw.encode(b'\xff') == (b'\xff', None)
+    with pytest.raises(ValueError):
+        raw.decode(b'\xff', False)
+
+
+def test_msgpack_roundtrip():
+    pytest.importorskip('msgpack')
+    packer = get_codec('msgpack')
+    payload, binary = packer.encode(dict(MESSAGE, blob=b'\x00'))
+    assert binary is True
+    assert packer.decode(payload, binary) == dict(MESSAGE, blob=b'\x00')
+    with pytest.raises(ValueError):
+        packer.decode(b'\xc1', True)
+
+
+def test_msgpack_missing(monkeypatch):
+    monkeypatch.setattr(codec, 'msgpack', None)
+    monkeypatch.setattr(codec, '_instances', {})
+
+    class Packed(WebSocketApplication):
+        CODECS = {'v1+msgpack': 'msgpack'}
+
+    # 构造路由时就报错, 而不是握手之后
+    with pytest.raises(RuntimeError):
+        Packed.check_codecs()
+
+
+def test_codec_requires_decode_and_encode():
+    class DecodeOnly(Codec):
+        def decode(self, data, binary):
+            return data
+
+    with pytest.raises(TypeError):
+        DecodeOnly()
+
+
+class Chat(WebSocketApplication):
+    CODEC = 'json'
+    CODECS = {'chat.v1+raw': 'raw', 'chat.v1+json': 'json'}
+
+    def on_message(self, message, *args, **kwargs):
+        if message == {'bad': 1}:
+            # 无法编码的响应只记录, 不断开连接
+            return {'bad': object()}
+        return message
+
+
+def test_subprotocol_selects_codec(serve):
+    _, address = serve([('/chat', Chat)])
+
+    client = Client(address, '/chat',
+                    ('Sec-WebSocket-Protocol: chat.v2, chat.v1+raw',))
+    assert 'Sec-WebSocket-Protocol: chat.v1+raw' in client.response
+    client.send('not json')
+    assert client.recv() == (0x1, b'not json')
+    client.close()
+
+    # 没有请求支持的子协议时使用 CODEC
+    client = Client(address, '/chat')
+    client.send('{"a": [1]}')
+    assert client.recv() == (0x1, b'{"a":[1]}')
+    client.close()
+
+
+@pytest.mark.parametrize('apps', [
+    [('/chat', Chat)],
+    [('/chat', type('Concurrent', (Chat,), {'CONCURRENCY': 4}))],
+])
+def test_unencodable_response_keeps_connection(serve, apps):
+    _, address = serve(apps)
+    client = Client(address, '/chat')
+    client.send('{"bad": 1}')
+    client.send('{"ok": 1}')
+    assert client.recv() == (0x1, b'{"ok":1}')
+    client.close()
+
+
+def test_invalid_message_closes_1007(serve):
+    _, address = serve([('/chat', Chat)])
+    client = Client(address, '/chat')
+    client.send('{"ok": 1}')
+    client.send('{"ok": ')
+    assert client.recv() == (0x1, b'{"ok":1}')
+    assert client.recv() == (0x8, struct.pack('!H', 1007))
+    client.close()
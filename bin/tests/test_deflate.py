@@ -0,0 +1,167 @@
+"""
+permessage-deflate 测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import zlib
+import struct
+
+import pytest
+
+from geventwbs.deflate import PerMessageDeflateFactory, parse_extensions
+from geventwbs.exceptions import FrameTooLargeException
+
+from conftest import Client
+
+NAME = 'permessage-deflate'
+
+
+def _compress(data, bits=15):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -bits)
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+
+def test_parse_extensions():
+    assert parse_extensions(
+        'permessage-deflate; client_max_window_bits, foo; a="1" , ,x') == [
+        (NAME, [('client_max_window_bits', None)]),
+        ('foo', [('a', '1')]),
+        ('x', []),
+    ]
+
+
+@pytest.mark.parametrize('options, offer, response', [
+    ({}, NAME, NAME),
+    ({}, NAME + '; client_max_window_bits', NAME),
+    ({'client_max_window_bits': 10}, NAME + '; client_max_window_bits',
+     NAME + '; client_max_window_bits=10'),
+    # 客户端没有声明支持时不能限制客户端窗口
+    ({'client_max_window_bits': 10}, NAME, NAME),
+    ({}, NAME + '; client_max_window_bits=12',
+     NAME + '; client_max_window_bits=12'),
+    ({}, NAME + '; server_max_window_bits=10',
+     NAME + '; server_max_window_bits=10'),
+    ({'server_max_window_bits': 11}, NAME + '; server_max_window_bits=13',
+     NAME + '; server_max_window_bits=11'),
+    ({'server_max_window_bits': 11}, NAME, NAME + '; server_max_window_bits=11'),
+    ({}, NAME + '; server_no_context_takeover',
+     NAME + '; server_no_context_takeover'),
+    ({'server_no_context_takeover': True}, NAME,
+     NAME + '; server_no_context_takeover'),
+    ({}, NAME + '; client_no_context_takeover',
+     NAME + '; client_no_context_takeover'),
+    # 第一个方案不可接受时选择下一个
+    ({}, 'x-webkit-deflate-frame, ' + NAME + '; server_max_window_bits=8, ' +
+     NAME + '; server_no_context_takeover',
+     NAME + '; server_no_context_takeover'),
+])
+def test_negotiate(options, offer, response):
+    result = PerMessageDeflateFactory(**options).negotiate(offer)
+    assert result is not None
+    assert result[0] == response
+
+
+@pytest.mark.parametrize('offer', [
+    'x-webkit-deflate-frame',
+    NAME + '; server_max_window_bits=8',
+    NAME + '; server_max_window_bits=16',
+    NAME + '; server_max_window_bits',
+    NAME + '; server_max_window_bits=010',
+    NAME + '; client_max_window_bits=7',
+    NAME + '; client_max_window_bits=abc',
+    NAME + '; server_no_context_takeover=1',
+    NAME + '; client_no_context_takeover; client_no_context_takeover',
+    NAME + '; unknown',
+])
+def test_reject_bad_offers(offer):
+    assert PerMessageDeflateFactory().negotiate(offer) is None
+
+
+def test_factory_options_checked():
+    with pytest.raises(ValueError):
+        PerMessageDeflateFactory(server_max_window_bits=8)
+    with pytest.raises(ValueError):
+        PerMessageDeflateFactory(client_max_window_bits=16)
+
+
+def _deflate(offer, **options):
+    return PerMessageDeflateFactory(min_size=0, **options).negotiate(offer)[1]
+
+
+def test_server_context_takeover():
+    message = b'context takeover ' * 20
+
+    deflate = _deflate(NAME)
+    first, second = deflate.compress(message), deflate.compress(message)
+    # 第二条消息引用第一条的窗口
+    assert len(second) < len(first)
+    decompressor = zlib.decompressobj(-15)
+    assert decompressor.decompress(first + b'\x00\x00\xff\xff') == message
+    assert decompressor.decompress(second + b'\x00\x00\xff\xff') == message
+
+    deflate = _deflate(NAME + '; server_no_context_takeover')
+    first, second = deflate.compress(message), deflate.compress(message)
+    assert first == second
+    assert zlib.decompressobj(-15).decompress(
+        second + b'\x00\x00\xff\xff') == message
+
+
+def test_client_context_takeover():
+    message = b'client context ' * 20
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    frames = [(compressor.compress(message) +
+               compressor.flush(zlib.Z_SYNC_FLUSH))[:-4] for _ in range(2)]
+
+    deflate = _deflate(NAME)
+    assert [deflate.decompress(frame) for frame in frames] == [message] * 2
+
+    # 客户端不接管上下文时每条消息独立解压
+    deflate = _deflate(NAME + '; client_no_context_takeover')
+    assert deflate.decompress(_compress(message)) == message
+    assert deflate.decompress(_compress(message)) == message
+
+
+def test_client_window_bits():
+    message = b'window ' * 100
+    deflate = _deflate(NAME + '; client_max_window_bits',
+                       client_max_window_bits=9)
+    assert deflate.client_max_window_bits == 9
+    assert deflate.decompress(_compress(message, 9)) == message
+
+
+def test_decompress_limit():
+    bomb = _compress(b'\x00' * 1000000)
+    deflate = _deflate(NAME)
+    with pytest.raises(FrameTooLargeException):
+        deflate.decompress(bomb, 1000)
+
+    deflate = _deflate(NAME)
+    assert len(deflate.decompress(_compress(b'a' * 1000), 1000)) == 1000
+
+
+def test_server_roundtrip_and_limit(serve):
+    _, address = serve(compression={'min_size': 0}, max_message_size=1000)
+    client = Client(address, headers=(
+        'Sec-WebSocket-Extensions: ' + NAME + '; client_max_window_bits',))
+    assert 'Sec-WebSocket-Extensions: ' + NAME in client.response
+
+    client.send(_compress(b'hello'), rsv=0x40)
+    opcode, rsv, _, payload = client.recv_frame()
+    assert (opcode, rsv) == (0x1, 0x40)
+    assert zlib.decompressobj(-15).decompress(
+        payload + b'\x00\x00\xff\xff') == b'hello'
+
+    # 解压后超过 max_message_size 以1009关闭
+    client.send(_compress(b'a' * 100000), rsv=0x40)
+    assert client.recv() == (0x8, struct.pack('!H', 1009))
+    client.close()
+
+
+def test_server_without_compression_rejects_rsv1(serve):
+    _, address = serve()
+    client = Client(address, headers=(
+        'Sec-WebSocket-Extensions: ' + NAME,))
+    assert 'Sec-WebSocket-Extensions' not in client.response
+    client.send(_compress(b'hello'), rsv=0x40)
+    assert client.recv() == (0x8, struct.pack('!H', 1002))
+    client.close()
@@ -0,0 +1,85 @@
+"""
+广播发送测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import gevent
+import pytest
+
+from gevent.event import Event
+
+from geventwbs.core import WebSocketServer, Resource
+
+
+class SlowWebSocket(object):
+    """send_raw 在 release 之前一直阻塞
+    """
+
+    def __init__(self, gate):
+        self.gate = gate
+        self.frames = []
+
+    def send_raw(self, frame):
+        self.gate.wait()
+        self.frames.append(frame)
+
+
+def _wait_sent(server):
+    with gevent.Timeout(1):
+        while server._fanout_runner is not None or server.fanout_group:
+            gevent.sleep(0.01)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(WebSocketServer, 'FANOUT_CONCURRENCY', 2)
+    return WebSocketServer(('127.0.0.1', 0), Resource([]))
+
+
+def test_publisher_never_blocks(server):
+    gate = Event()
+    sockets = [SlowWebSocket(gate) for _ in range(5)]
+
+    # 并发数占满后发布者也立即返回
+    with gevent.Timeout(0.5):
+        for i in range(3):
+            assert server._fanout(sockets, 'm%d' % i, None) == 5
+    gevent.sleep(0.01)
+    assert len(server.fanout_group) == 2
+    assert server.fanout_backlog
+
+    gate.set()
+    _wait_sent(server)
+
+    # 每个连接都按发布顺序收到
+    expected = [b'\x81\x02m0', b'\x81\x02m1', b'\x81\x02m2']
+    assert [ws.frames for ws in sockets] == [expected] * 5
+    assert not server.fanout_backlog
+    assert server.fanout_slots.counter == 2
+
+
+def test_fast_path_without_backlog(server):
+    gate = Event()
+    gate.set()
+    sockets = [SlowWebSocket(gate) for _ in range(2)]
+    server._fanout(sockets, 'x', None)
+    assert server._fanout_runner is None
+    _wait_sent(server)
+    assert [ws.frames for ws in sockets] == [[b'\x81\x01x']] * 2
+
+
+def test_timeout_releases_slot(server, monkeypatch):
+    monkeypatch.setattr(WebSocketServer, 'FANOUT_TIMEOUT', 0.05)
+
+    class Handler(object):
+        client_address = ('127.0.0.1', 1)
+
+    stuck = SlowWebSocket(Event())
+    stuck.handler = Handler()
+    stuck.stream = None
+    fast = SlowWebSocket(Event())
+    fast.gate.set()
+
+    server._fanout([stuck, stuck, fast], 'x', None)
+    _wait_sent(server)
+    assert fast.frames == [b'\x81\x01x']
+    assert server.fanout_slots.counter == 2
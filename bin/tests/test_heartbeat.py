@@ -0,0 +1,52 @@
+"""
+心跳测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import struct
+
+import gevent
+
+from conftest import Client
+
+HEARTBEAT = {'interval': 0.2, 'tick': 0.05, 'max_missed': 1,
+             'close_code': 1001}
+
+
+def _wait_empty(server):
+    with gevent.Timeout(2):
+        while server.clients:
+            gevent.sleep(0.05)
+
+
+def test_reap_unresponsive_peer(serve):
+    server, address = serve(heartbeat=HEARTBEAT)
+    client = Client(address)
+
+    # 不回复pong, 先收到ping, 然后是1001的close帧
+    opcode, _, _, _ = client.recv_frame()
+    assert opcode == 0x9
+    assert client.recv() == (0x8, struct.pack('!H', 1001))
+    _wait_empty(server)
+    client.close()
+
+
+def test_reap_with_send_queue_sends_close(serve):
+    # 开启发送队列时close帧先入队, 要等writer写出后再断开
+    server, address = serve(heartbeat=HEARTBEAT, send_queue={})
+    client = Client(address)
+    assert client.recv() == (0x8, struct.pack('!H', 1001))
+    _wait_empty(server)
+    client.close()
+
+
+def test_pong_keeps_connection(serve):
+    server, address = serve(heartbeat=HEARTBEAT)
+    client = Client(address)
+    for _ in range(3):
+        opcode, _, _, payload = client.recv_frame()
+        assert opcode == 0x9
+        client.send(payload, opcode=0xA)
+
+    assert len(server.clients) == 1
+    assert next(iter(server.clients.values())).rtt is not None
+    client.close()
@@ -0,0 +1,60 @@
+"""
+掩码测试, 和逐字节异或的参考实现比较, 在bin目录下执行: python -m pytest tests
+"""
+
+import os
+
+import pytest
+
+from geventwbs import mask
+from geventwbs.mask import mask_payload, MASK_CHUNK, NUMPY_THRESHOLD
+
+KEY = b'\x9a\x0f\x31\xe7'
+
+LENGTHS = [1, 3, 4, 7, 8, 9, 125, 126, NUMPY_THRESHOLD - 1, NUMPY_THRESHOLD,
+           NUMPY_THRESHOLD + 5, MASK_CHUNK, MASK_CHUNK + 3, 3 * MASK_CHUNK + 7]
+
+
+def _reference(key, data, offset=0):
+    return bytes(b ^ key[(offset + i) % 4] for i, b in enumerate(data))
+
+
+@pytest.fixture(params=['numpy', 'int'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(mask, 'numpy', None)
+    return request.param
+
+
+@pytest.mark.parametrize('length', LENGTHS)
+@pytest.mark.parametrize('offset', [0, 1, 2, 3, 6])
+def test_matches_reference(backend, length, offset):
+    data = os.urandom(length)
+    assert mask_payload(KEY, data, offset) == _reference(KEY, data, offset)
+
+
+@pytest.mark.parametrize('wrap', [bytes, bytearray, memoryview])
+def test_buffer_types(backend, wrap):
+    data = os.urandom(NUMPY_THRESHOLD + 3)
+    assert mask_payload(bytearray(KEY), wrap(data)) == _reference(KEY, data)
+    # 非0起点的memoryview切片
+    view = memoryview(data)[5:]
+    assert mask_payload(KEY, view) == _reference(KEY, data[5:])
+
+
+def test_chunks_with_offset(backend):
+    # 分块反掩码, 每块用它在payload里的偏移
+    data = os.urandom(MASK_CHUNK + 2001)
+    masked = _reference(KEY, data)
+    parts, pos = [], 0
+    for size in (3, 1000, MASK_CHUNK - 2, 0, 1000):
+        parts.append(mask_payload(KEY, masked[pos:pos + size], pos))
+        pos += size
+    assert b''.join(parts) == data
+
+
+def test_empty(backend):
+    assert mask_payload(KEY, b'') == b''
+    assert mask_payload(KEY, b'', 3) == b''
@@ -0,0 +1,52 @@
+"""
+指标测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import gc
+
+import gevent
+
+from geventwbs.metrics import Registry, WebSocketMetrics
+
+from conftest import Client
+
+
+class FakeServer(object):
+
+    def __init__(self, clients):
+        self.clients = clients
+
+
+def _connections(registry):
+    return list(registry.metrics['websocket_connections'].samples())[0][2]
+
+
+def test_connections_summed_across_servers(serve):
+    registry = Registry()
+    first, first_address = serve(metrics=registry)
+    second, second_address = serve(metrics=registry)
+
+    clients = [Client(first_address), Client(second_address),
+               Client(second_address)]
+    for _ in range(100):
+        if len(first.clients) + len(second.clients) == 3:
+            break
+        gevent.sleep(0.01)
+    assert _connections(registry) == 3
+    assert 'websocket_connections 3\n' in registry.expose()
+
+    for client in clients:
+        client.close()
+
+
+def test_collected_server_counts_zero():
+    registry = Registry()
+    server = FakeServer({1: None, 2: None})
+    WebSocketMetrics(server, registry)
+    WebSocketMetrics(FakeServer({3: None}), registry)
+    gc.collect()
+    assert _connections(registry) == 2
+
+    del server
+    gc.collect()
+    assert _connections(registry) == 0
@@ -0,0 +1,97 @@
+"""
+多进程模式测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import os
+import sys
+import signal
+import subprocess
+
+import gevent
+import pytest
+
+from gevent import socket
+
+from conftest import Client
+
+WORKER = '''
+import os, sys
+from gevent import monkey
+monkey.patch_all()
+from geventwbs.core import WebSocketApplication, Resource
+from geventwbs.multiproc import Supervisor
+
+class Room(WebSocketApplication):
+    def on_message(self, message):
+        if message == 'pid':
+            return str(os.getpid())
+        if message == 'sub':
+            self.server.subscribe('room', self.ws)
+            return 'ok'
+        return 'sent %d' % self.server.publish('room', message)
+
+Supervisor(('127.0.0.1', int(sys.argv[1])), Resource([('/room', Room)]),
+           workers=2, stop_timeout=3).run()
+'''
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _connect(address):
+    with gevent.Timeout(10):
+        while True:
+            try:
+                return Client(address, '/room')
+            except (socket.error, IndexError):
+                gevent.sleep(0.1)
+
+
+@pytest.fixture
+def supervisor():
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        pytest.skip('SO_REUSEPORT is not supported')
+
+    port = _free_port()
+    bin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, '-c', WORKER, str(port)],
+                               cwd=bin_dir)
+    yield ('127.0.0.1', port)
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        raise
+
+
+def _ask(client, message):
+    client.send(message)
+    return client.recv()[1].decode()
+
+
+def test_publish_across_workers(supervisor):
+    # 内核按连接分配worker, 连到两个不同的worker为止
+    clients = {}
+    with gevent.Timeout(20):
+        while len(clients) < 2:
+            client = _connect(supervisor)
+            pid = _ask(client, 'pid')
+            if pid in clients:
+                client.close()
+            else:
+                clients[pid] = client
+
+    subscriber, publisher = clients.values()
+    assert _ask(subscriber, 'sub') == 'ok'
+    # 订阅者在另一个worker里, 本worker的订阅者数为0
+    assert _ask(publisher, 'hello') == 'sent 0'
+    assert subscriber.recv() == (0x1, b'hello')
+
+    for client in clients.values():
+        client.close()
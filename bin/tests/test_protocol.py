@@ -0,0 +1,150 @@
+"""
+协议测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import struct
+
+import pytest
+
+from geventwbs.protocol import Connection, MessageParser, Header
+from geventwbs.protocol import Close, Message, Ping
+from geventwbs.protocol import is_valid_close_code, parse_close
+from geventwbs.protocol import OPCODE_CLOSE, OPCODE_TEXT, OPCODE_BINARY
+from geventwbs.protocol import OPCODE_CONTINUATION, OPCODE_PING
+from geventwbs.exceptions import ProtocolError, FrameTooLargeException
+from geventwbs.exceptions import WebSocketError
+from geventwbs.mask import mask_payload
+
+KEY = b'\x01\x02\x03\x04'
+
+
+def _close_frame(code):
+    payload = struct.pack('!H', code)
+    header = Header.encode_header(True, OPCODE_CLOSE, KEY, len(payload), 0)
+    return bytes(header) + mask_payload(KEY, payload)
+
+
+@pytest.mark.parametrize('code', [1000, 1001, 1011, 1012, 1013, 1014, 3000,
+                                  4999])
+def test_valid_close_codes(code):
+    assert is_valid_close_code(code)
+    assert parse_close(struct.pack('!H', code)) == (code, '')
+
+
+@pytest.mark.parametrize('code', [999, 1004, 1005, 1006, 1015, 1016, 1100,
+                                  2000])
+def test_invalid_close_codes(code):
+    assert not is_valid_close_code(code)
+    with pytest.raises(ProtocolError):
+        parse_close(struct.pack('!H', code))
+
+
+def test_client_echoes_service_restart():
+    # drain 发出1012后, 客户端回复同样的close码是正常关闭
+    conn = Connection()
+    conn.close(1012)
+    conn.receive_data(_close_frame(1012))
+    events = list(conn.events())
+    assert len(events) == 1
+    assert isinstance(events[0], Close)
+    assert events[0].code == 1012
+    assert conn.data_to_send() == b''
+
+
+def _frame(payload, opcode=0x1, fin=True, flags=0):
+    header = Header.encode_header(fin, opcode, KEY, len(payload), flags)
+    return bytes(header) + mask_payload(KEY, payload)
+
+
+def _header(opcode, fin=True, flags=0, length=0):
+    return Header(fin, opcode, flags, length)
+
+
+def test_parser_fragments():
+    parser = MessageParser()
+    first = _header(OPCODE_TEXT, fin=False, length=3)
+    assert parser.begin(first) is False
+    assert parser.end(first) is None
+
+    # 分片之间的控制帧不影响消息状态
+    assert parser.begin(_header(OPCODE_PING)) is True
+
+    last = _header(OPCODE_CONTINUATION, length=2)
+    assert parser.begin(last) is False
+    assert parser.end(last) == (False, False)
+    assert parser.opcode is None and parser.size == 0
+
+
+@pytest.mark.parametrize('headers', [
+    [_header(OPCODE_CONTINUATION)],
+    [_header(OPCODE_TEXT, fin=False), _header(OPCODE_BINARY)],
+    [_header(0x3)],
+    [_header(OPCODE_PING, flags=Header.RSV0_MASK)],
+])
+def test_parser_protocol_errors(headers):
+    parser = MessageParser()
+    with pytest.raises(ProtocolError):
+        for header in headers:
+            if not parser.begin(header):
+                parser.end(header)
+
+
+def test_parser_limits():
+    parser = MessageParser(max_frame_size=10, max_message_size=15)
+    with pytest.raises(FrameTooLargeException):
+        parser.check_header(_header(OPCODE_TEXT, length=11))
+
+    first = _header(OPCODE_TEXT, fin=False, length=10)
+    parser.check_header(first)
+    parser.begin(first)
+    parser.end(first)
+    with pytest.raises(FrameTooLargeException):
+        parser.check_header(_header(OPCODE_CONTINUATION, length=6))
+
+    # 没有协商压缩时不允许rsv位
+    with pytest.raises(ProtocolError):
+        parser.check_header(_header(OPCODE_TEXT, flags=Header.RSV0_MASK))
+
+
+def test_connection_events_across_reads():
+    conn = Connection()
+    data = _frame(b'hel', fin=False) + _frame(b'ping', OPCODE_PING) + \
+        _frame(b'lo', OPCODE_CONTINUATION)
+
+    events = []
+    for i in range(len(data)):
+        conn.receive_data(data[i:i + 1])
+        events.extend(conn.events())
+
+    assert [type(event) for event in events] == [Ping, Message]
+    assert events[1].binary is False and events[1].data == b'hello'
+    # 自动回复pong
+    assert conn.data_to_send() == conn.pong(b'ping')
+
+
+@pytest.mark.parametrize('data, code', [
+    (_frame(b'x', OPCODE_CONTINUATION), 1002),
+    (_frame(b'x' * 20), 1009),
+    (_frame(struct.pack('!H', 999), OPCODE_CLOSE), 1002),
+])
+def test_connection_fails_with_close_code(data, code):
+    conn = Connection(max_frame_size=10)
+    conn.receive_data(data)
+    events = list(conn.events())
+    assert isinstance(events[-1], Close) and events[-1].code == code
+    assert conn.state == Connection.CLOSED
+    assert conn.data_to_send() == conn._frame(
+        struct.pack('!H', code), OPCODE_CLOSE)
+
+
+def test_connection_eof_and_send():
+    conn = Connection()
+    frame = conn.send('hi')
+    assert frame == b'\x81\x02hi'
+    assert conn.send(b'\x00') == b'\x82\x01\x00'
+
+    conn.receive_data(b'')
+    events = list(conn.events())
+    assert isinstance(events[0], Close) and events[0].code == 1006
+    with pytest.raises(WebSocketError):
+        conn.send('late')
@@ -0,0 +1,154 @@
+"""
+帧读取测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import os
+
+import gevent
+import pytest
+
+from geventwbs import websocket
+from geventwbs.websocket import FrameReader
+from geventwbs.core import WebSocketApplication
+from geventwbs.exceptions import WebSocketError
+
+from conftest import Client
+
+SMALL = 64
+
+
+class Feed(object):
+    """按给定的分块返回数据, 模拟每次recv只收到一部分
+    """
+
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = list(sizes)
+        self.pos = 0
+
+    def read_into(self, view):
+        size = self.sizes.pop(0) if self.sizes else len(view)
+        size = min(size, len(view), len(self.data) - self.pos)
+        view[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+
+def _unmasked(payload, opcode=0x2, fin=True):
+    # 服务端读取不要求掩码, 方便直接比较payload
+    first = (0x80 if fin else 0) | opcode
+    if len(payload) < 126:
+        return bytes([first, len(payload)]) + payload
+    return bytes([first, 126]) + len(payload).to_bytes(2, 'big') + payload
+
+
+def _read_all(reader, count):
+    frames = []
+    for _ in range(count):
+        header = reader.read_header()
+        payload = reader.read_payload(header.length) if header.length else b''
+        frames.append((header.opcode, header.fin, bytes(payload)))
+    return frames
+
+
+PAYLOADS = [b'', b'a', os.urandom(125), os.urandom(126), os.urandom(SMALL),
+            os.urandom(SMALL + 1), os.urandom(1000)]
+STREAM = b''.join(_unmasked(payload) for payload in PAYLOADS)
+
+
+@pytest.mark.parametrize('sizes', [
+    [len(STREAM)],
+    [1] * len(STREAM),
+    [3, 1, 200, 7, 64, 2],
+    [SMALL - 1, SMALL + 1, 5],
+])
+def test_frames_split_across_reads(sizes):
+    reader = FrameReader(Feed(STREAM, sizes).read_into, SMALL)
+    assert _read_all(reader, len(PAYLOADS)) == \
+        [(0x2, True, payload) for payload in PAYLOADS]
+    # 读完后不持有缓冲区
+    with pytest.raises(WebSocketError):
+        reader.read_header()
+    assert reader.buffer is None
+
+
+def test_initial_data_from_handshake():
+    # 握手时rfile里多读的数据先于socket里的数据
+    split = len(_unmasked(PAYLOADS[2])) + 3
+    reader = FrameReader(Feed(STREAM[split:], [2, 50]).read_into, SMALL,
+                         data=STREAM[:split])
+    assert _read_all(reader, len(PAYLOADS) - 2) == \
+        [(0x2, True, payload) for payload in PAYLOADS[:-2]]
+
+
+def test_iter_payload_chunks():
+    payload = os.urandom(300)
+    reader = FrameReader(Feed(_unmasked(payload), [4, 100, 1, 500]).read_into,
+                         SMALL)
+    header = reader.read_header()
+    chunks = [bytes(view) for view in reader.iter_payload(header.length)]
+    assert len(chunks) > 1
+    assert b''.join(chunks) == payload
+
+
+def test_shared_idle_view_not_aliased(monkeypatch):
+    # 两个reader交替等待数据, 共用 _IDLE_VIEW 和缓冲区空闲列表
+    monkeypatch.setattr(websocket, '_BUFFER_POOL', [])
+    first = [os.urandom(20) for _ in range(5)]
+    second = [os.urandom(20) for _ in range(5)]
+    readers = [
+        FrameReader(Feed(b''.join(map(_unmasked, first)), [22] * 5).read_into),
+        FrameReader(Feed(b''.join(map(_unmasked, second)), [22] * 5).read_into),
+    ]
+    got = [[], []]
+    for _ in range(5):
+        for reader, out in zip(readers, got):
+            header = reader.read_header()
+            out.append(bytes(reader.read_payload(header.length)))
+    assert got == [first, second]
+    assert readers[0].buffer is not readers[1].buffer
+
+
+class Collect(WebSocketApplication):
+    received = []
+
+    def on_message(self, message):
+        self.received.append(message)
+        return str(len(self.received))
+
+
+def test_messages_are_independent_copies(serve):
+    # 多个连接交替收消息, 之前收到的消息不能被之后的读取覆盖
+    Collect.received = []
+    _, address = serve([('/collect', Collect)])
+    clients = [Client(address, '/collect') for _ in range(3)]
+    expected = []
+
+    for i in range(30):
+        client = clients[i % 3]
+        size = (1, 100, FrameReader.BUFFER_SIZE + 10)[i % 3]
+        payload = os.urandom(size)
+        if i % 4 == 0:
+            client.send(payload[:size // 2], opcode=0x2, fin=False)
+            gevent.sleep(0.001)
+            client.send(payload[size // 2:], opcode=0x0)
+        else:
+            client.send(payload, opcode=0x2)
+        expected.append(payload)
+        assert client.recv() == (0x1, str(i + 1).encode())
+
+    assert Collect.received == expected
+    for client in clients:
+        client.close()
+
+
+def test_frame_sent_with_handshake(serve):
+    # 第一帧和握手请求在同一个包里, 留在rfile的缓冲区里
+    _, address = serve()
+    client = Client(address, early=Client.frame('early') + Client.frame('x'))
+    assert client.status == 101
+    assert client.recv() == (0x1, b'early')
+    assert client.recv() == (0x1, b'x')
+    client.send('after')
+    assert client.recv() == (0x1, b'after')
+    client.close()
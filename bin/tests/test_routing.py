@@ -0,0 +1,123 @@
+"""
+路由表测试, resolve 的结果必须和原来按顺序 re.match 的结果相同,
+在bin目录下执行: python -m pytest tests
+"""
+
+import re
+import random
+
+import pytest
+
+from geventwbs.core import Resource, WebSocketApplication
+from geventwbs.routing import RouteTable, _literal_prefix
+
+PATTERNS = [
+    '/slow',
+    '/slowly/(?P<id>\\d+)',
+    '/chat',
+    '/chat/room',
+    '^/api/v1/.*',
+    '/api/v1/users',
+    '/api/v[12]/items',
+    '/ab*c',
+    '/ab?d',
+    '/x{2,3}y',
+    '/a+b',
+    '(?i)/CaSe',
+    '/alt|/other',
+    '/dot.',
+    '/',
+    '/chat',
+]
+
+PATHS = [
+    '', '/', '/slow', '/slowu', '/slow/', '/slowly/12', '/slowly/x', '/chat',
+    '/chat/room', '/chat/roomy', '/chatter', '/api/v1/', '/api/v1/users',
+    '/api/v2/items', '/api/v3/items', '/ac', '/abbbc', '/ad', '/abd', '/xxy',
+    '/xxxy', '/xy', '/ab', '/aab', '/case', '/CASE/x', '/alt', '/other',
+    '/dotx', '/dot', 'slow', '/sl',
+]
+
+
+def _linear(patterns, path):
+    # 原来的实现: 按配置顺序, 第一个 re.match 的生效
+    for index, pattern in enumerate(patterns):
+        if re.match(pattern, path):
+            return index
+    return None
+
+
+def _table(patterns):
+    return RouteTable([(pattern, index)
+                       for index, pattern in enumerate(patterns)])
+
+
+def _resolve(table, path):
+    route = table.lookup(path)
+    return route[1] if route is not None else None
+
+
+@pytest.mark.parametrize('path', PATHS)
+def test_same_as_linear_scan(path):
+    table = _table(PATTERNS)
+    assert _resolve(table, path) == _linear(PATTERNS, path)
+    # 第二次走缓存
+    assert _resolve(table, path) == _linear(PATTERNS, path)
+
+
+def test_order_preserved_when_regex_shadows_literal():
+    # 前面的正则先匹配到纯字符串路径
+    patterns = ['/a.*', '/abc', '/abc']
+    table = _table(patterns)
+    assert _resolve(table, '/abc') == 0
+    assert _table(['/abc', '/a.*']).lookup('/abc') == ('/abc', 0)
+
+
+def test_random_paths():
+    rand = random.Random(7)
+    table = RouteTable([(pattern, index) for index, pattern in
+                        enumerate(PATTERNS)], cache_size=8)
+    alphabet = 'abcdxy/lowhtrmpiv12.'
+    for _ in range(3000):
+        path = rand.choice(PATHS) + ''.join(
+            rand.choice(alphabet) for _ in range(rand.randint(0, 4)))
+        assert _resolve(table, path) == _linear(PATTERNS, path), path
+    assert len(table._cache) <= 8
+
+
+@pytest.mark.parametrize('pattern, prefix', [
+    ('/slow', '/slow'),
+    ('^/api/v1/.*', '/api/v1/'),
+    ('/ab*c', '/a'),
+    ('/ab?d', '/a'),
+    ('/x{2,3}y', '/'),
+    ('/a+b', '/a'),
+    ('(?i)/CaSe', ''),
+    ('/alt|/other', ''),
+])
+def test_literal_prefix(pattern, prefix):
+    assert _literal_prefix(re.compile(pattern)) == prefix
+
+
+class Chat(WebSocketApplication):
+    pass
+
+
+def _wsgi(environ, start_response):
+    return []
+
+
+def test_resource_resolve():
+    resource = Resource([('/ws/chat', Chat), ('/ws', _wsgi), ('/m.*', _wsgi)])
+
+    environ = {'PATH_INFO': '/ws/chatroom'}
+    assert resource.resolve(environ) is Chat
+    assert environ['wsgi.websocket_route'] == '/ws/chat'
+    # 已经匹配过的结果直接使用
+    environ['PATH_INFO'] = '/nope'
+    assert resource.resolve(environ) is Chat
+
+    # websocket 和普通http请求分开匹配
+    assert resource.resolve({'PATH_INFO': '/ws/x'}) is None
+    assert resource.resolve({'PATH_INFO': '/ws/x'}, False) is _wsgi
+    assert resource.resolve({'PATH_INFO': '/metrics'}, False) is _wsgi
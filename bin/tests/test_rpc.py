@@ -0,0 +1,214 @@
+"""
+RPC 网关测试, 后端是本地的 StreamServer, 在bin目录下执行: python -m pytest tests
+"""
+
+import json
+import time
+import struct
+
+import gevent
+import pytest
+
+from gevent import socket
+from gevent.server import StreamServer
+
+from geventwbs.rpc import RpcBackend, RpcGateway
+from geventwbs.exceptions import RpcError, RpcTimeout, RpcUnavailable
+
+_LENGTH = struct.Struct('!I')
+
+
+class StandIn(object):
+    """后端替身, 每个请求一个greenlet处理, 响应顺序和请求顺序无关
+
+    echo: 返回 params 和 context
+    sleep: 等待 params 秒后返回
+    fail: 返回错误
+    """
+
+    def __init__(self):
+        self.server = StreamServer(('127.0.0.1', 0), self.handle)
+        self.server.start()
+        self.address = ('127.0.0.1', self.server.server_port)
+        self.requests = []
+
+    def handle(self, sock, address):
+        rfile = sock.makefile('rb')
+        try:
+            while True:
+                head = rfile.read(4)
+                if len(head) < 4:
+                    break
+                body = rfile.read(_LENGTH.unpack(head)[0])
+                gevent.spawn(self.reply, sock, json.loads(body))
+        finally:
+            rfile.close()
+
+    def reply(self, sock, request):
+        self.requests.append(request)
+        method = request['method']
+        if method == 'sleep':
+            gevent.sleep(request['params'])
+            response = {'id': request['id'], 'result': request['params']}
+        elif method == 'fail':
+            response = {'id': request['id'],
+                        'error': {'code': 418, 'message': 'teapot'}}
+        else:
+            response = {'id': request['id'], 'result': {
+                'params': request['params'], 'context': request['context']}}
+
+        body = json.dumps(response).encode('utf-8')
+        try:
+            sock.sendall(_LENGTH.pack(len(body)) + body)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.server.stop(timeout=0)
+
+
+def _closed_address():
+    # 绑定后立刻关闭, 连接会被拒绝
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+class FakeWebSocket(object):
+
+    def __init__(self, environ=None):
+        self.environ = environ or {}
+
+
+@pytest.fixture
+def backend():
+    server = StandIn()
+    yield server
+    server.close()
+
+
+def _addr(address, timeout=1000):
+    return {'addr': address, 'timeout': timeout}
+
+
+def test_out_of_order_replies(backend):
+    rpc = RpcBackend('svc', [_addr(backend.address)], pool_size=1)
+    done = []
+
+    def call(delay):
+        result = rpc.call('sleep', delay)
+        done.append(result)
+        return result
+
+    jobs = [gevent.spawn(call, delay) for delay in (0.2, 0.1, 0)]
+    gevent.joinall(jobs, raise_error=True)
+    rpc.close()
+
+    # 同一个连接上, 先返回的响应先交给对应的请求
+    assert [job.value for job in jobs] == [0.2, 0.1, 0]
+    assert done == [0, 0.1, 0.2]
+
+
+def test_error_passthrough(backend):
+    rpc = RpcBackend('svc', [_addr(backend.address)])
+    with pytest.raises(RpcError) as e:
+        rpc.call('fail')
+    rpc.close()
+    assert e.value.code == 418
+    assert e.value.message == 'teapot'
+
+
+def test_timeout_is_504(backend):
+    rpc = RpcBackend('svc', [_addr(backend.address, timeout=50)])
+    with pytest.raises(RpcTimeout) as e:
+        rpc.call('sleep', 0.5)
+    assert e.value.code == 504
+
+    # 超时后连接仍然可用, 迟到的响应被丢弃
+    assert rpc.call('sleep', 0) == 0
+    rpc.close()
+
+
+def test_failover_and_retry_interval(backend):
+    down = _closed_address()
+    rpc = RpcBackend('svc', [_addr(down), _addr(backend.address)],
+                     retry_interval=0.2)
+
+    assert rpc.call('echo', 1)['params'] == 1
+    marked = rpc.down_until[0]
+    assert marked > time.monotonic()
+
+    # retry_interval 之内不再尝试失败的地址
+    for i in range(4):
+        assert rpc.call('echo', i)['params'] == i
+    assert rpc.down_until[0] == marked
+
+    # 之后重新尝试, 仍然失败时再次暂停
+    gevent.sleep(0.25)
+    for i in range(2):
+        assert rpc.call('echo', i)['params'] == i
+    assert rpc.down_until[0] > marked
+    rpc.close()
+
+
+def test_all_addresses_down():
+    rpc = RpcBackend('svc', [_addr(_closed_address())])
+    with pytest.raises(RpcUnavailable) as e:
+        rpc.call('echo')
+    assert e.value.code == 503
+
+
+def _gateway(address):
+
+    class Gateway(RpcGateway):
+        URL_CONF = {
+            '/user/info': {'check': 1},
+            '/user/captcha/smscode': {},
+            '/pay': {'rpc': 'user', 'method': 'pay.create', 'check': 0},
+        }
+        RPC_SERVERS = {'user': {'addr': [_addr(address)]}}
+        ALLOWED_HEADERS = ('User-Agent',)
+
+    return Gateway
+
+
+def test_gateway_check_requires_login(backend):
+    gateway = _gateway(backend.address)
+    try:
+        anonymous = gateway(FakeWebSocket())
+        resp = anonymous.on_message({'id': 1, 'url': '/user/info'})
+        assert resp == {'id': 1, 'error': {
+            'code': 401, 'message': 'login required'}}
+        assert backend.requests == []
+
+        # 不需要登录的url照常转发
+        resp = anonymous.on_message(
+            {'id': 2, 'url': '/user/captcha/smscode', 'params': {'a': 1}})
+        assert resp['result']['params'] == {'a': 1}
+        assert backend.requests[-1]['method'] == 'captcha.smscode'
+
+        logged_in = gateway(FakeWebSocket({
+            'wsgi.websocket_user': 9, 'HTTP_USER_AGENT': 'test'}))
+        resp = logged_in.on_message({'id': 3, 'url': '/user/info'})
+        assert resp['id'] == 3
+        assert resp['result']['context'] == {
+            'headers': {'User-Agent': 'test'}, 'cookies': {}, 'user': 9}
+        assert backend.requests[-1]['method'] == 'info'
+    finally:
+        gateway.rpc_clients().close()
+
+
+def test_gateway_routes(backend):
+    gateway = _gateway(backend.address)
+    try:
+        app = gateway(FakeWebSocket())
+        resp = app.on_message({'id': 1, 'url': '/pay'})
+        assert 'result' in resp
+        assert backend.requests[-1]['method'] == 'pay.create'
+
+        assert app.on_message({'id': 2, 'url': '/nope'})['error']['code'] == 404
+        assert app.on_message('bad')['error']['code'] == 400
+    finally:
+        gateway.rpc_clients().close()
@@ -0,0 +1,159 @@
+"""
+发送队列测试, 在bin目录下执行: python -m pytest tests
+"""
+
+import logging
+
+import gevent
+import pytest
+
+from gevent.event import Event
+
+from geventwbs.core import WebSocketApplication, _Pipeline
+from geventwbs.sender import SendQueue, BLOCK, DROP_OLDEST, DROP_NEWEST
+from geventwbs.sender import CLOSE
+from geventwbs.metrics import Registry, WebSocketMetrics
+from geventwbs.exceptions import SendQueueFull
+
+# 帧第一个字节: 文本帧 / ping
+TEXT = b'\x81'
+PING = b'\x89'
+
+
+class Peer(object):
+    """writer 写到这里, release 之前所有写操作阻塞
+    """
+
+    def __init__(self):
+        self.frames = []
+        self.open = Event()
+        self.closed = []
+        self.aborted = 0
+
+    def writev(self, header, payload):
+        self.open.wait()
+        self.frames.append(payload)
+
+    def on_close(self, code):
+        self.closed.append(code)
+
+    def on_abort(self):
+        self.aborted += 1
+
+    def queue(self, **options):
+        options.setdefault('max_messages', 2)
+        return SendQueue(self.writev, self.on_close, self.on_abort, **options)
+
+
+def _fill(queue, *payloads):
+    # 第一条被writer取走后卡在写上, 之后的留在队列里
+    queue.put(TEXT, b'0')
+    gevent.sleep(0)
+    for payload in payloads:
+        queue.put(TEXT, payload)
+
+
+def _drain(peer, queue):
+    peer.open.set()
+    queue.close()
+    queue.join(1)
+
+
+def test_block_waits_then_raises():
+    peer = Peer()
+    queue = peer.queue(policy=BLOCK, block_timeout=0.05)
+    _fill(queue, b'1', b'2')
+    with pytest.raises(SendQueueFull):
+        queue.put(TEXT, b'3')
+
+    # 有空间后继续入队
+    gevent.spawn_later(0.01, peer.open.set)
+    queue.block_timeout = 1
+    queue.put(TEXT, b'3')
+    _drain(peer, queue)
+    assert peer.frames == [b'0', b'1', b'2', b'3']
+
+
+def test_drop_oldest_keeps_control_frames():
+    peer = Peer()
+    queue = peer.queue(policy=DROP_OLDEST)
+    _fill(queue, b'1')
+    queue.put(PING, b'p')
+    queue.put(TEXT, b'2')
+    queue.put(TEXT, b'3')
+    _drain(peer, queue)
+    assert peer.frames == [b'0', b'p', b'3']
+    assert queue.dropped == 2
+
+
+def test_drop_newest():
+    peer = Peer()
+    queue = peer.queue(policy=DROP_NEWEST)
+    _fill(queue, b'1', b'2', b'3')
+    _drain(peer, queue)
+    assert peer.frames == [b'0', b'1', b'2']
+    assert queue.dropped == 1
+
+
+def test_control_frames_ignore_limits():
+    peer = Peer()
+    queue = peer.queue(policy=DROP_NEWEST, max_bytes=3)
+    _fill(queue, b'1', b'2')
+    for _ in range(3):
+        queue.put(PING, b'p' * 10)
+    _drain(peer, queue)
+    assert peer.frames == [b'0', b'1'] + [b'p' * 10] * 3
+
+
+def test_close_policy():
+    peer = Peer()
+    queue = peer.queue(policy=CLOSE, close_code=1008)
+    _fill(queue, b'1', b'2', b'3')
+    assert peer.closed == [1008]
+    # 积压的消息被丢弃, close帧不用排在它们后面
+    assert not queue.items and queue.dropped == 2
+    _drain(peer, queue)
+
+
+def test_write_timeout_aborts():
+    peer = Peer()
+    queue = peer.queue(write_timeout=0.05)
+    _fill(queue, b'1')
+    gevent.sleep(0.1)
+    assert peer.aborted == 1
+    assert queue.dead and not queue.items
+    with pytest.raises(IOError):
+        queue.put(TEXT, b'2')
+
+
+class FakeWebSocket(object):
+
+    def __init__(self, error):
+        self.error = error
+        self.metrics = WebSocketMetrics(FakeServer(), Registry())
+        self.environ = {}
+
+    def send(self, payload, binary):
+        raise self.error
+
+
+class FakeServer(object):
+    clients = ()
+
+
+class Echo(WebSocketApplication):
+    pass
+
+
+def test_app_reports_full_queue(caplog):
+    ws = FakeWebSocket(SendQueueFull('Send queue is full'))
+    app = Echo(ws)
+    app.codec = app.select_codec(None)
+
+    pipeline = _Pipeline(app, 2, True)
+    with caplog.at_level(logging.WARNING):
+        app._handle_message('hi', 0)
+        pipeline.submit('hi', 0)
+        pipeline.join()
+    assert caplog.text.count('send queue full') == 2
+    assert ws.metrics.queue_full.children[()].value == 2
@@ -12,6 +12,8 @@ import config as myconfig
 bind = '%s:%s' % (myconfig.HOST, myconfig.PORT)
 chdir = BIN
 #daemon = True
+# websocket连接和订阅只存在于接受它的进程里, gunicorn的多个worker之间不能互相
+# publish; 需要多进程时用 bin/server.py <workers>(multiproc.Supervisor)
 workers = 1
 threads = 8
 #worker_class = 'sync'